@@ -1,5 +1,10 @@
 from __future__ import division
 
+import numpy
+from xarray import DataArray
+
+from datacube_ows.expression import evaluate
+
 # Style index functions
 def scale_data(imgband_data, scale_from, scale_to):
     sc_min, sc_max = scale_from
@@ -13,36 +18,25 @@ def sum_bands(data, band1, band2, product_cfg=None):
     if product_cfg:
         band1=product_cfg.band_idx.band(band1)
         band2=product_cfg.band_idx.band(band2)
-    return data[band1] + data[band2]
+    return evaluate(data, "band1 + band2", band1=band1, band2=band2)
 
 
 def delta_bands(data, band1, band2, product_cfg=None):
     if product_cfg:
         band1=product_cfg.band_idx.band(band1)
         band2=product_cfg.band_idx.band(band2)
-    typ1 = data[band1].dtype
-    typ2 = data[band2].dtype
-    if typ1.name.startswith('uint'):
-        nodata = data[band1].nodata
-        data[band1] = data[band1].astype('int32')
-        data[band1].attrs["nodata"] = nodata
-    if typ2.name.startswith('uint'):
-        nodata = data[band2].nodata
-        data[band2] = data[band2].astype('int32')
-        data[band2].attrs["nodata"] = nodata
-    # if typ1.name.startswith('uint') or typ2.name.startswith('uint'):
-        # data = data.astype('int32', copy=False)
-    return data[band1] - data[band2]
+    # Evaluated in floating point, so unsigned band data cannot underflow.
+    return evaluate(data, "band1 - band2", band1=band1, band2=band2)
 
 
 # N.B. Modifying scale_to would be dangerous - don't do it.
 # pylint: disable=dangerous-default-value
 def norm_diff(data, band1, band2, product_cfg=None, scale_from=None, scale_to=[0,255]):
     # Calculate a normalised difference index.
-    # unscaled = delta_bands(data, band1,band2, product_cfg) / sum_bands(data, band1, band2, product_cfg)
-    # delta_data = delta_bands(data, band1,band2, product_cfg)
-    # sum_data = sum_bands(data, band1, band2, product_cfg)
-    unscaled = delta_bands(data, band1,band2, product_cfg) / sum_bands(data, band1, band2, product_cfg)
+    if product_cfg:
+        band1=product_cfg.band_idx.band(band1)
+        band2=product_cfg.band_idx.band(band2)
+    unscaled = evaluate(data, "(band1 - band2) / (band1 + band2)", band1=band1, band2=band2)
     if scale_from:
         scaled = scale_data(unscaled, scale_from, scale_to)
     else:
@@ -72,19 +66,21 @@ def band_quotient(data, band1, band2, product_cfg=None):
     if product_cfg:
         band1=product_cfg.band_idx.band(band1)
         band2=product_cfg.band_idx.band(band2)
-    return data[band1] / data[band2]
+    return evaluate(data, "band1 / band2", band1=band1, band2=band2)
 
 
 def band_quotient_sum(data, band1a, band1b, band2a, band2b, product_cfg=None):
-    return band_quotient(data, band1a, band1b, product_cfg) + band_quotient(data, band2a, band2b, product_cfg)
+    if product_cfg:
+        band1a, band1b, band2a, band2b = (product_cfg.band_idx.band(b) for b in (band1a, band1b, band2a, band2b))
+    return evaluate(data, "band1a / band1b + band2a / band2b",
+                    band1a=band1a, band1b=band1b, band2a=band2a, band2b=band2b)
 
 
 def sentinel2_ndci(data, b_red_edge, b_red, b_green, b_swir, product_cfg=None):
-    red_delta = delta_bands(data, b_red_edge, b_red, product_cfg)
-    red_sum = sum_bands(data,b_red_edge, b_red, product_cfg)
+    ndci = norm_diff(data, b_red_edge, b_red, product_cfg)
     mndwi = norm_diff(data, b_green, b_swir, product_cfg)
 
-    return red_delta / red_sum.where(mndwi > 0.1)
+    return ndci.where(mndwi > 0.1)
 
 
 def multi_date_delta(data):
@@ -97,6 +93,109 @@ def multi_date_delta(data):
 def single_band_log(data, band, scale_factor, exponent, product_cfg=None):
     if product_cfg:
         band = product_cfg.band_idx.band(band)
-    return scale_factor * ( (data[band] ** exponent) - 1.0)
+    return evaluate(data, "scale_factor * (band ** exponent - 1.0)",
+                    band=band, scale_factor=scale_factor, exponent=exponent)
+
+
+# Streaming multi-date aggregators.
+#
+# A streaming aggregator folds the per-date input to a multi-date handler (e.g. the index
+# function value) one date at a time, so only the running aggregate needs to be held in memory,
+# rather than the whole (time, y, x) stack.  Aggregators hold no per-request state:
+#
+#   state = aggregator.init()
+#   for each date (in time order):
+#       state = aggregator.update(state, data)   # data: a DataArray with no time dimension
+#   result = aggregator.finalise(state)          # a DataArray with no time dimension
+
+class StreamingAggregator(object):
+    def init(self):
+        return None
+
+    def update(self, state, data):
+        raise NotImplementedError()
+
+    def finalise(self, state):
+        raise NotImplementedError()
+
+    @staticmethod
+    def result(template, values):
+        return DataArray(values, dims=template.dims, coords=template.coords)
+
+
+class StreamingMean(StreamingAggregator):
+    # Mean of the valid (non-NaN) values at each pixel.
+    def update(self, state, data):
+        vals = data.values
+        valid = ~numpy.isnan(vals)
+        if state is None:
+            state = (data, numpy.zeros(vals.shape), numpy.zeros(vals.shape, dtype="int32"))
+        template, total, count = state
+        numpy.add(total, vals, out=total, where=valid)
+        count += valid
+        return state
+
+    def finalise(self, state):
+        template, total, count = state
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+        mean[count == 0] = numpy.nan
+        return self.result(template, mean)
+
+
+class StreamingMin(StreamingAggregator):
+    # Minimum of the valid (non-NaN) values at each pixel.
+    reduce = staticmethod(numpy.fmin)
+
+    def update(self, state, data):
+        if state is None:
+            return (data, numpy.array(data.values, dtype="float64"))
+        template, agg = state
+        self.reduce(agg, data.values, out=agg)
+        return state
+
+    def finalise(self, state):
+        template, agg = state
+        return self.result(template, agg)
+
+
+class StreamingMax(StreamingMin):
+    # Maximum of the valid (non-NaN) values at each pixel.
+    reduce = staticmethod(numpy.fmax)
+
+
+class StreamingCount(StreamingAggregator):
+    # Number of dates with a valid (non-NaN) value at each pixel.
+    def update(self, state, data):
+        if state is None:
+            state = (data, numpy.zeros(data.shape, dtype="int32"))
+        template, count = state
+        count += ~numpy.isnan(data.values)
+        return state
+
+    def finalise(self, state):
+        template, count = state
+        return self.result(template, count)
+
+
+class StreamingDelta(StreamingAggregator):
+    # Value at the last date minus value at the first date.  As for multi_date_delta.
+    def update(self, state, data):
+        if state is None:
+            return (data, data)
+        return (state[0], data)
+
+    def finalise(self, state):
+        first, last = state
+        return self.result(first, last.values - first.values)
+
+
+STREAMING_AGGREGATORS = {
+    "mean": StreamingMean,
+    "min": StreamingMin,
+    "max": StreamingMax,
+    "count": StreamingCount,
+    "delta": StreamingDelta,
+}
 
 
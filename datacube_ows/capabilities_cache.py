@@ -0,0 +1,99 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+
+from datacube_ows.ogc_utils import etag_matches, json_digest
+from datacube_ows.ows_configuration import get_config
+from datacube_ows.single_flight import SingleFlight
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Rendered capabilities documents, keyed on (service, version, section, base_url).
+# Each entry is a (version digest, document) tuple, and is replaced when the version changes.
+_CAPABILITIES_CACHE = {}
+CAPABILITIES_FLIGHTS = SingleFlight("capabilities")
+
+# Range digests per layer, recalculated only when a layer's ranges are replaced.
+_RANGES_DIGESTS = {}
+
+
+def ranges_digest(layer):
+    ranges = layer.ranges
+    cached = _RANGES_DIGESTS.get(layer.name)
+    if cached is None or cached[0] is not ranges:
+        cached = (ranges, json_digest(ranges))
+        _RANGES_DIGESTS[layer.name] = cached
+    return cached[1]
+
+
+def capabilities_version(cfg):
+    """A digest of everything capabilities documents are rendered from.
+
+    That is, the configuration and the current ranges (and visibility) of every layer.  Used as
+    the updateSequence of capabilities documents.
+    """
+    version = hashlib.sha1(cfg.config_digest.encode("utf-8"))
+    for name, layer in cfg.product_index.items():
+        version.update(("%s:%s:%s;" % (name, ranges_digest(layer), layer.hide)).encode("utf-8"))
+    return version.hexdigest()
+
+
+def capabilities_etag(key, version):
+    return '"%s"' % hashlib.sha1(("%s:%r" % (version, key)).encode("utf-8")).hexdigest()
+
+
+def capabilities_document(key, version, render):
+    entry = _CAPABILITIES_CACHE.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    def render_and_cache():
+        document = render(version)
+        _CAPABILITIES_CACHE[key] = (version, document)
+        return document
+    return CAPABILITIES_FLIGHTS.do((key, version), render_and_cache)
+
+
+def capabilities_response(args, key, render, exception_class,
+                          content_type="application/xml", cache_control="no-cache, max-age=0"):
+    """A GetCapabilities response, rendered at most once per document version.
+
+    key is a (service, version, section, base_url) tuple identifying the document and
+    render is a function taking the document version (its updateSequence) and returning the
+    document.
+
+    If the request's updateSequence is the current version, a CurrentUpdateSequence exception
+    is raised.  If the request's If-None-Match header matches the document's ETag, a 304 Not
+    Modified response is returned.
+
+    If content_type is None, render returns a (document, content type) tuple instead, for
+    encoders that choose the content type themselves.
+    """
+    cfg = get_config()
+    version = capabilities_version(cfg)
+    if args.get("updatesequence") == version:
+        raise exception_class("Capabilities document is unchanged since updateSequence %s" % version,
+                              exception_class.CURRENT_UPDATE_SEQUENCE,
+                              locator="UpdateSequence parameter")
+    etag = capabilities_etag(key, version)
+    if etag_matches(args.get("if_none_match"), etag):
+        return (
+            "",
+            304,
+            cfg.response_headers({"ETag": etag, "Cache-Control": cache_control})
+        )
+    document = capabilities_document(key, version, render)
+    if content_type is None:
+        document, content_type = document
+    return (
+        document,
+        200,
+        cfg.response_headers({
+            "Content-Type": content_type,
+            "Cache-Control": cache_control,
+            "ETag": etag,
+        })
+    )
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
 
 import numpy
@@ -15,17 +18,22 @@ import re
 import datacube
 from datacube.utils import geometry
 from datacube.storage.masking import mask_to_dict
+from sqlalchemy.exc import SQLAlchemyError
 
 from datacube_ows.cube_pool import cube
+from datacube_ows.fuser import Mosaic
 from datacube_ows.ogc_exceptions import WMSException
 
 from datacube_ows.ows_configuration import get_config
 from datacube_ows.wms_utils import img_coords_to_geopoint, GetMapParameters, \
-    GetFeatureInfoParameters, solar_correct_data, collapse_datasets_to_times
+    GetFeatureInfoParameters, solar_correct_data, collapse_datasets_to_times, \
+    overview_decimation, decimated_geobox, resample_image_band
 from datacube_ows.ogc_utils import local_solar_date_range, dataset_center_time, ConfigException, tz_for_geometry, \
-    solar_date, year_date_range, month_date_range
+    solar_date, year_date_range, month_date_range, etag_matches, json_digest
 
-from datacube_ows.utils import log_call, group_by_statistical
+from datacube_ows.low_zoom_mosaic import read_mosaic
+from datacube_ows.slim_search import search_datasets
+from datacube_ows.utils import log_call, group_by_statistical, get_index_sqlconn
 
 import logging
 
@@ -34,12 +42,20 @@ _LOG = logging.getLogger(__name__)
 
 class DataStacker(object):
     @log_call
-    def __init__(self, product, geobox, times, resampling=None, style=None, bands=None, **kwargs):
+    def __init__(self, product, geobox, times, resampling=None, style=None, bands=None, zf=None,
+                 reduced_resolution=False, **kwargs):
         super(DataStacker, self).__init__(**kwargs)
         self._product = product
+        # Read from a coarser product from the layer's resolution ladder if the zoom factor allows it.
+        if zf is not None:
+            self._source = product.ladder_rung(zf) or product
+        else:
+            self._source = product
         self.cfg = product.global_cfg
         self._geobox = geobox
         self._resampling = resampling if resampling is not None else Resampling.nearest
+        # Reading at a reduced resolution for an overview zoom request.
+        self._reduced_resolution = reduced_resolution
         if style:
             self._needed_bands = style.needed_bands
         elif bands:
@@ -61,34 +77,141 @@ class DataStacker(object):
     def needed_bands(self):
         return self._needed_bands
 
+    def load_resampling(self, measurements):
+        # Resampling for load_data: averaged for reduced resolution reads (except flag bands, which
+        # stay nearest neighbour), otherwise the ODC default.
+        if not self._reduced_resolution or not measurements:
+            return None
+        return {
+            name: "nearest" if measurement.get("flags_definition") else "average"
+            for name, measurement in measurements.items()
+        }
+
     @log_call
-    def datasets(self, index, mask=False, all_time=False, point=None):
+    def datasets(self, index, mask=False, all_time=False, point=None, max_datasets=None):
         # Return datasets as a time-grouped xarray DataArray. (or None if no datasets)
+        #
+        # If max_datasets is set, the search stops as soon as max_datasets is exceeded, so
+        # at most max_datasets + 1 datasets are returned.
         # No PQ product, so no PQ datasets.
         if not self._product.pq_name and mask:
             return None
 
         if self._product.multi_product:
-            prod_name = self._product.pq_names if mask and self._product.pq_name else self._product.product_names
+            prod_name = self._product.pq_names if mask and self._product.pq_name else self._source.product_names
             query_args = {
                 "geopolygon": self._geobox.extent
             }
         else:
-            prod_name = self._product.pq_name if mask and self._product.pq_name else self._product.product_name
+            prod_name = self._product.pq_name if mask and self._product.pq_name else self._source.product_name
             query_args = {
                 "product": prod_name,
                 "geopolygon": self._geobox.extent
             }
-        if all_time or (mask and self._product.pq_ignore_time):
-            all_datasets = self._dataset_query(index, prod_name, query_args)
+        # Feature info needs full metadata documents.
+        slim = point is None and getattr(self._product, "slim_search", False)
+        limit = max_datasets + 1 if max_datasets else None
+        if getattr(self._product, "batch_search", False) and getattr(self._product, "dataset_catalogue", None) is None:
+            prod_names = prod_name if self._product.multi_product else [prod_name]
+            if all_time or (mask and self._product.pq_ignore_time):
+                time_ranges = None
+            else:
+                time_ranges = self._times
+            all_datasets = self._batched_query(index, prod_names, time_ranges, slim, limit=limit)
+        elif all_time or (mask and self._product.pq_ignore_time):
+            all_datasets = self._dataset_query(index, prod_name, query_args, slim=slim, limit=limit)
         else:
             all_datasets = []
             for th in self._times:
+                if limit is not None and len(all_datasets) >= limit:
+                    break
                 query_args["time"] = th
-                all_datasets.extend(self._dataset_query(index, prod_name, query_args))
+                remaining = None if limit is None else limit - len(all_datasets)
+                all_datasets.extend(self._dataset_query(index, prod_name, query_args, slim=slim, limit=remaining))
         return datacube.Datacube.group_datasets(all_datasets, self.group_by)
 
-    def _dataset_query(self, index, prod_name, query_args):
+    def count_datasets_over(self, index, max_datasets, precount=False):
+        # Optional pre-check of a max_datasets limit that does not build Dataset objects.  Returns the
+        # dataset count if it exceeds the limit, otherwise None (including if the pre-check is not
+        # enabled, there is no limit or the count could not be obtained).
+        #
+        # The count comes from the space-time view, so it is approximate in both directions: datasets
+        # indexed since the view was last refreshed by update_ranges are missed, and eo3 datasets with
+        # a single timestamp are padded to a day in the view, so may be counted for the following day.
+        # Requests that pass must still be checked against the full dataset search.
+        if not precount or max_datasets <= 0:
+            return None
+        n_datasets = self.count_datasets(index)
+        if n_datasets is not None and n_datasets > max_datasets:
+            return n_datasets
+        return None
+
+    def count_datasets(self, index):
+        # Count the datasets a (non-mask) search would return, using the space-time view rather than
+        # building Dataset objects.  Returns None if the count could not be obtained.
+        if getattr(self._product, "dataset_catalogue", None) is not None:
+            # Searching the in-memory catalogue is cheaper still.
+            return None
+        if self._product.multi_product:
+            prod_names = self._source.product_names
+        else:
+            prod_names = [self._source.product_name]
+        # The view's extents are in lon/lat, mostly without an SRID.  && only compares bounding boxes,
+        # so the envelope is left without an SRID too and the bare column can use its GiST index.
+        bbox = self._geobox.extent.to_crs(geometry.CRS("EPSG:4326")).boundingbox
+        query_params = {
+            "products": prod_names,
+            "minx": bbox.left,
+            "miny": bbox.bottom,
+            "maxx": bbox.right,
+            "maxy": bbox.top,
+        }
+        time_clauses = []
+        for i, (start, end) in enumerate(self._times):
+            time_clauses.append("stv.temporal_extent && tstzrange(%%(start%d)s, %%(end%d)s, '[]')" % (i, i))
+            query_params["start%d" % i] = start
+            query_params["end%d" % i] = end
+        conn = get_index_sqlconn(index)
+        try:
+            results = conn.execute("""
+                SELECT COUNT(*)
+                FROM public.space_time_view stv, agdc.dataset_type p, agdc.dataset ds
+                WHERE stv.dataset_type_ref = p.id
+                AND p.name = ANY(%%(products)s)
+                AND ds.id = stv.id
+                AND ds.archived IS NULL
+                AND stv.spatial_extent && ST_MakeEnvelope(%%(minx)s, %%(miny)s, %%(maxx)s, %%(maxy)s)
+                AND (%s)
+                """ % " OR ".join(time_clauses),
+                query_params)
+            return list(results)[0][0]
+        except SQLAlchemyError as e:
+            _LOG.warning("Dataset count failed for layer %s: %s", self._product.name, str(e))
+            return None
+        finally:
+            conn.close()
+
+    def _dataset_query(self, index, prod_name, query_args, slim=False, limit=None):
+        catalogue = getattr(self._product, "dataset_catalogue", None)
+        if catalogue is not None:
+            # In-memory catalogue query
+            prod_names = prod_name if self._product.multi_product else [prod_name]
+            _LOG.debug("catalogue query start %s", datetime.now().time())
+            datasets = catalogue.search(index, prod_names, query_args["geopolygon"], query_args.get("time"),
+                                        limit=limit)
+            _LOG.debug("catalogue query stop %s", datetime.now().time())
+            return datasets
+        if slim:
+            # Slim ODC Dataset Query
+            prod_names = prod_name if self._product.multi_product else [prod_name]
+            products = self._products_by_name()
+            search_terms = datacube.api.query.Query(**{
+                k: v for k, v in query_args.items() if k != "product"
+            }).search_terms
+            _LOG.debug("slim query start %s", datetime.now().time())
+            datasets = search_datasets(index, [products[pn] for pn in prod_names], search_terms, limit=limit)
+            _LOG.debug("slim query stop %s", datetime.now().time())
+            return datasets
         # ODC Dataset Query
         if self._product.multi_product:
             queries = []
@@ -98,16 +221,35 @@ class DataStacker(object):
             _LOG.debug("query start %s", datetime.now().time())
             datasets = []
             for q in queries:
-                datasets.extend(index.datasets.search_eager(**q.search_terms))
+                if limit is not None and len(datasets) >= limit:
+                    break
+                remaining = None if limit is None else limit - len(datasets)
+                datasets.extend(index.datasets.search(limit=remaining, **q.search_terms))
             _LOG.debug("query stop %s", datetime.now().time())
         else:
             query = datacube.api.query.Query(**query_args)
             _LOG.debug("query start %s", datetime.now().time())
-            datasets = index.datasets.search_eager(**query.search_terms)
+            datasets = list(index.datasets.search(limit=limit, **query.search_terms))
             _LOG.debug("query stop %s", datetime.now().time())
 
         return datasets
 
+    def _batched_query(self, index, prod_names, time_ranges, slim, limit=None):
+        # Search all products and times with a single query.  The results are split into dates by
+        # group_datasets.
+        products = self._products_by_name()
+        search_terms = datacube.api.query.Query(geopolygon=self._geobox.extent).search_terms
+        if time_ranges is not None:
+            time_ranges = [datacube.api.query.Query(time=th).search_terms["time"] for th in time_ranges]
+        _LOG.debug("batched query start %s", datetime.now().time())
+        datasets = search_datasets(index, [products[pn] for pn in prod_names], search_terms,
+                                   time_ranges=time_ranges, slim=slim, limit=limit)
+        _LOG.debug("batched query stop %s", datetime.now().time())
+        return datasets
+
+    def _products_by_name(self):
+        return {prod.name: prod for prod in chain(self._source.products, self._product.pq_products)}
+
     @log_call
     def data(self, datasets, mask=False, manual_merge=False, skip_corrections=False, **kwargs):
         # pylint: disable=too-many-locals, consider-using-enumerate
@@ -116,22 +258,29 @@ class DataStacker(object):
             prod = self._product.pq_product
             measurements = prod.lookup_measurements([self._product.pq_band])
         else:
-            prod = self._product.product
+            prod = self._source.product
             measurements = prod.lookup_measurements(self.needed_bands())
 
-        if manual_merge:
+        if getattr(self._product, "native_mosaic", False) and (
+                manual_merge or (self._product.solar_correction and not mask and not skip_corrections)):
+            return self.native_mosaic_stack(datasets, measurements, mask, skip_corrections,
+                                            extent_masks=manual_merge, **kwargs)
+        elif manual_merge:
             return self.manual_data_stack(datasets, measurements, mask, skip_corrections, **kwargs)
         elif self._product.solar_correction and not mask and not skip_corrections:
             # Merge performed already by dataset extent, but we need to
             # process the data for the datasets individually to do solar correction.
-            merged = None
-            for ds in datasets:
+            def read_corrected(ds):
                 d = self.read_data(ds, measurements, self._geobox, **kwargs)
                 for band in self.needed_bands():
                     if band != self._product.pq_band:
                         # No idea why pylint suddenly doesn't like this statement
                         # pylint: disable=unsupported-assignment-operation, unsubscriptable-object
                         d[band] = solar_correct_data(d[band], ds)
+                return d
+
+            merged = None
+            for d in self.map_datasets(read_corrected, datasets):
                 if merged is None:
                     merged = d
                 else:
@@ -141,6 +290,30 @@ class DataStacker(object):
             data = self.read_data(datasets, measurements, self._geobox, self._resampling, **kwargs)
             return data
 
+    def map_datasets(self, func, datasets):
+        # Apply func to each dataset, yielding the results in the original dataset order as they
+        # become available, so callers can merge each result before the next is read.
+        # Reads are performed concurrently if the layer is configured with multiple read threads,
+        # with at most read_threads reads in flight at once.
+        datasets = list(datasets)
+        threads = min(self._product.read_threads, len(datasets))
+        if threads <= 1:
+            for ds in datasets:
+                yield func(ds)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            try:
+                for ds in datasets:
+                    if len(pending) >= threads:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(func, ds))
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
     @log_call
     def manual_data_stack(self, datasets, measurements, mask, skip_corrections, **kwargs):
         # pylint: disable=too-many-locals, too-many-branches
@@ -150,26 +323,30 @@ class DataStacker(object):
             bands = [self._product.pq_band]
         else:
             bands = self.needed_bands()
+
+        def read_masked(ds):
+            d = self.read_data_for_single_dataset(ds, measurements, self._geobox, **kwargs)
+            # Squeeze upconverts uints to int32
+            d = d.squeeze(["time"], drop=True)
+            extent_mask = None
+            for band in bands:
+                for f in self._product.extent_mask_func:
+                    if extent_mask is None:
+                        extent_mask = f(d, band)
+                    else:
+                        extent_mask &= f(d, band)
+            dm = d.where(extent_mask)
+            if self._product.solar_correction and not mask and not skip_corrections:
+                for band in bands:
+                    if band != self._product.pq_band:
+                        dm[band] = solar_correct_data(dm[band], ds)
+            return dm, {band: d[band].attrs for band in bands}
+
         time_slices = []
         for dt in datasets.time.values:
             tds = datasets.sel(time=dt)
             merged = None
-            for ds in tds.values.item():
-                d = self.read_data_for_single_dataset(ds, measurements, self._geobox, **kwargs)
-                # Squeeze upconverts uints to int32
-                d = d.squeeze(["time"], drop=True)
-                extent_mask = None
-                for band in bands:
-                    for f in self._product.extent_mask_func:
-                        if extent_mask is None:
-                            extent_mask = f(d, band)
-                        else:
-                            extent_mask &= f(d, band)
-                dm = d.where(extent_mask)
-                if self._product.solar_correction and not mask and not skip_corrections:
-                    for band in bands:
-                        if band != self._product.pq_band:
-                            dm[band] = solar_correct_data(dm[band], ds)
+            for dm, attrs in self.map_datasets(read_masked, tds.values.item()):
                 if merged is None:
                     merged = dm
                 else:
@@ -177,12 +354,49 @@ class DataStacker(object):
             if mask:
                 merged = merged.astype('uint8', copy=True)
                 for band in bands:
-                    merged[band].attrs = d[band].attrs
+                    merged[band].attrs = attrs[band]
             time_slices.append(merged)
 
         result = xarray.concat(time_slices, datasets.time)
         return result
 
+    @log_call
+    def native_mosaic_stack(self, datasets, measurements, mask, skip_corrections, extent_masks=True, **kwargs):
+        # Read datasets one at a time and fuse them into preallocated arrays in the native dtype,
+        # rather than merging with combine_first.
+        if mask:
+            bands = [self._product.pq_band]
+            fuse_func = self._product.pq_fuse_func
+        else:
+            bands = self.needed_bands()
+            fuse_func = self._product.fuse_func
+        correct = self._product.solar_correction and not mask and not skip_corrections
+
+        def read_valid(ds):
+            d = self.read_data_for_single_dataset(ds, measurements, self._geobox, **kwargs)
+            d = d.isel(time=0, drop=True)
+            valid = None
+            if extent_masks:
+                for band in bands:
+                    for f in self._product.extent_mask_func:
+                        band_valid = f(d, band).values
+                        if valid is None:
+                            valid = band_valid
+                        else:
+                            valid &= band_valid
+            if correct:
+                for band in bands:
+                    if band != self._product.pq_band:
+                        d[band] = solar_correct_data(d[band], ds)
+            return d, valid
+
+        mosaic = Mosaic(len(datasets.time), fuse_func=fuse_func)
+        for t_idx, dt in enumerate(datasets.time.values):
+            tds = datasets.sel(time=dt)
+            for d, valid in self.map_datasets(read_valid, tds.values.item()):
+                mosaic.add(t_idx, d, valid)
+        return mosaic.result(datasets.time)
+
     # Read data for given datasets and measurements per the output_geobox
     @log_call
     def read_data(self, datasets, measurements, geobox, resampling=Resampling.nearest, **kwargs):
@@ -190,6 +404,7 @@ class DataStacker(object):
                 datasets,
                 geobox,
                 measurements=measurements,
+                resampling=self.load_resampling(measurements),
                 fuse_func=kwargs.get('fuse_func', None))
 
     # Read data for single datasets and measurements per the output_geobox
@@ -204,6 +419,7 @@ class DataStacker(object):
             dc_datasets,
             geobox,
             measurements=measurements,
+            resampling=self.load_resampling(measurements),
             fuse_func=kwargs.get('fuse_func', None))
 
 
@@ -217,11 +433,70 @@ def bbox_to_geom(bbox, crs):
     return datacube.utils.geometry.box(bbox.left, bbox.bottom, bbox.right, bbox.top, crs)
 
 
+def too_many_datasets_message(max_datasets, n_datasets, at_least=False):
+    return ("This request processes too much data to be served in a reasonable amount of time. "
+            "Please reduce the bounds of your request and try again. "
+            "(max: %d, this request requires%s: %d)" % (max_datasets, " at least" if at_least else "", n_datasets))
+
+
+def dataset_ids(datasets):
+    # Sorted ids of the datasets in a time-grouped xarray DataArray (or None).
+    if datasets is None:
+        return []
+    return sorted(str(ds.id) for tds in datasets.values for ds in tds)
+
+
+def map_etag(params, datasets, pq_datasets=None):
+    # A strong ETag for a rendered map, from everything that decides its content: the configuration,
+    # layer, style, dates and output geobox, and the data and PQ datasets it is rendered from.
+    geobox = params.geobox
+    global_cfg = getattr(params.product, "global_cfg", None)
+    return '"%s"' % json_digest([
+        getattr(global_cfg, "config_digest", None),
+        params.product.name,
+        params.style.name,
+        [str(t) for t in params.times],
+        str(geobox.crs),
+        list(geobox.affine)[:6],
+        [geobox.width, geobox.height],
+        dataset_ids(datasets),
+        dataset_ids(pq_datasets),
+    ])
+
+
+class NotModified(Exception):
+    """Raised by render_map when the client already has the map, as identified by its ETag."""
+    def __init__(self, etag):
+        super().__init__(etag)
+        self.etag = etag
+
+
 @log_call
 def get_map(args):
-    # pylint: disable=too-many-nested-blocks, too-many-branches, too-many-statements, too-many-locals
     # Parse GET parameters
     params = GetMapParameters(args)
+    cfg = get_config()
+    try:
+        bands, etag = render_map(params, args["requestid"], if_none_match=args.get("if_none_match"))
+    except NotModified as e:
+        return "", 304, cfg.response_headers({"ETag": e.etag})
+    headers = {"Content-Type": "image/png"}
+    if etag is not None:
+        headers["ETag"] = etag
+    return write_png(bands), 200, cfg.response_headers(headers)
+
+
+def render_map(params, request_id, metatile=False, if_none_match=None, etag_for=None):
+    # Render a GetMap request to a list of uint8 image bands.
+    #
+    # Returns the bands and the map's ETag (None if the map is rendered from a low zoom mosaic or a
+    # placeholder for too many datasets, which dataset ids do not identify).  Raises NotModified,
+    # after the dataset search but before any data is read, if if_none_match matches the ETag, or
+    # the ETag derived from it by etag_for if given.
+    #
+    # For metatiles, returns (None, None) if the request exceeds the dataset limit, as the individual
+    # tiles may not.
+    # pylint: disable=too-many-nested-blocks, too-many-branches, too-many-statements, too-many-locals
     n_dates = len(params.times)
     if n_dates == 1:
         mdh = None
@@ -231,21 +506,64 @@ def get_map(args):
             raise WMSException("Style %s does not support GetMap requests with %d dates" % (params.style.name, n_dates),
                                WMSException.INVALID_DIMENSION_VALUE, locator="Time parameter")
 
-    with cube() as dc:
+    separate_pq = bool(params.style.masks) and params.product.pq_name != params.product.name
+    with cube() as dc, _pq_executor(separate_pq) as executor:
         if not dc:
             raise WMSException("Database connectivity failure")
-        # Tiling.
-        stacker = DataStacker(params.product, params.geobox, params.times, params.resampling, style=params.style)
-        datasets = stacker.datasets(dc.index)
-        n_datasets = datasets_in_xarray(datasets)
         zoomed_out = params.zf < params.product.min_zoom
-        too_many_datasets = (params.product.max_datasets_wms > 0
-                             and n_datasets > params.product.max_datasets_wms
-        )
+        if zoomed_out and params.product.min_overview_zoom is not None \
+                and params.zf >= params.product.min_overview_zoom:
+            # Zoomed out, but not too far to render real data at reduced resolution.
+            zoomed_out = False
+            read_geobox = decimated_geobox(params.geobox, overview_decimation(params.zf, params.product.min_zoom))
+        else:
+            read_geobox = params.geobox
+        # Tiling.
+        stacker = DataStacker(params.product,
+                              read_geobox,
+                              params.times,
+                              params.resampling,
+                              style=params.style,
+                              zf=params.zf,
+                              reduced_resolution=read_geobox is not params.geobox)
+        pq_search = None
+        n_datasets = stacker.count_datasets_over(dc.index, params.product.max_datasets_wms,
+                                                 params.product.precount_datasets_wms)
+        too_many_datasets = n_datasets is not None
+        if too_many_datasets:
+            datasets = None
+        else:
+            if executor is not None and not zoomed_out:
+                # PQ data comes from a separate product: search for it concurrently with the main search.
+                pq_search = executor.submit(_search_pq_datasets, stacker, params.product, request_id)
+            datasets = stacker.datasets(dc.index, max_datasets=params.product.max_datasets_wms)
+            n_datasets = datasets_in_xarray(datasets)
+            too_many_datasets = (params.product.max_datasets_wms > 0
+                                 and n_datasets > params.product.max_datasets_wms
+            )
+        if n_datasets and (zoomed_out or too_many_datasets):
+            mosaic = read_mosaic(params.product, params.times, params.geobox, params.style.needed_bands)
+        else:
+            mosaic = None
+        pq_datasets = None
+        etag = None
+        if mosaic is None and not too_many_datasets:
+            if n_datasets and pq_search is not None:
+                # The PQ datasets are part of the ETag.
+                pq_datasets = pq_search.result()
+            etag = map_etag(params, datasets, pq_datasets)
+            client_etag = etag if etag_for is None else etag_for(etag)
+            if etag_matches(if_none_match, client_etag):
+                raise NotModified(client_etag)
         if n_datasets == 0:
-            body = _write_empty(params.geobox)
+            bands = _render_empty(params.geobox)
+        elif mosaic is not None:
+            # Too expensive to render from the datasets, but a pre-built low zoom mosaic is available.
+            bands = _render_data(mosaic, None, params.style, _extent_mask(mosaic, params), params.geobox)
+        elif too_many_datasets and metatile:
+            return None, None
         elif too_many_datasets:
-            body = _write_polygon(
+            bands = _render_polygon(
                 params.geobox,
                 params.geobox.extent,
                 params.product.zoom_fill)
@@ -266,96 +584,175 @@ def get_map(args):
                         extent = bbox_to_geom(ds.extent.boundingbox, ds.extent.crs)
                         extent_crs = extent.crs
             extent = extent.to_crs(params.crs)
-            body = _write_polygon(params.geobox, extent, params.product.zoom_fill)
+            bands = _render_polygon(params.geobox, extent, params.product.zoom_fill)
+        elif mdh is not None and mdh.streaming_aggregator is not None:
+            bands = _render_streaming(stacker, datasets, params, mdh, request_id, read_geobox, pq_datasets)
         else:
-            _LOG.debug("load start %s %s", datetime.now().time(), args["requestid"])
+            if executor is not None:
+                # Load the PQ data concurrently with the main data.
+                pq_future = executor.submit(_read_pq_data, stacker, params.product, pq_datasets, request_id)
+            else:
+                pq_future = None
+            _LOG.debug("load start %s %s", datetime.now().time(), request_id)
             data = stacker.data(datasets,
                                 manual_merge=params.product.data_manual_merge,
                                 fuse_func=params.product.fuse_func)
-            _LOG.debug("load stop %s %s", datetime.now().time(), args["requestid"])
+            _LOG.debug("load stop %s %s", datetime.now().time(), request_id)
             if params.style.masks:
-                if params.product.pq_name == params.product.name:
-                    pq_band_data = (data[params.product.pq_band].dims, data[params.product.pq_band].astype("uint16"))
-                    pq_data = xarray.Dataset({params.product.pq_band: pq_band_data},
-                                             coords=data[params.product.pq_band].coords
-                                             )
-                    flag_def = data[params.product.pq_band].flags_definition
-                    pq_data[params.product.pq_band].attrs["flags_definition"] = flag_def
+                if pq_future is None:
+                    pq_data = _pq_band_data(data, params.product)
                 else:
-                    pq_datasets = stacker.datasets(dc.index, mask=True, all_time=params.product.pq_ignore_time)
-                    n_pq_datasets = datasets_in_xarray(pq_datasets)
-                    if n_pq_datasets > 0:
-                        pq_data = stacker.data(pq_datasets,
-                                               mask=True,
-                                               manual_merge=params.product.pq_manual_merge,
-                                               fuse_func=params.product.pq_fuse_func)
-                    else:
-                        pq_data = None
+                    pq_data = pq_future.result()
             else:
                 pq_data = None
 
             extent_mask = None
-            if not params.product.data_manual_merge:
-                td_masks = []
-                for npdt in data.time.values:
-                    td = data.sel(time=npdt)
-                    td_ext_mask = None
-                    for band in params.style.needed_bands:
-                        for f in params.product.extent_mask_func:
-                            if td_ext_mask is None:
-                                td_ext_mask = f(td, band)
-                            else:
-                                td_ext_mask &= f(td, band)
-                    td_masks.append(td_ext_mask)
-                extent_mask = xarray.concat(td_masks, dim=data.time)
-                #    extent_mask.add_time(td.time, ext_mask)
+            if not params.product.data_manual_merge or params.product.native_mosaic:
+                extent_mask = _extent_mask(data, params)
 
             if not data or (params.style.masks and not pq_data):
-                body = _write_empty(params.geobox)
+                bands = _render_empty(params.geobox)
             else:
-                body = _write_png(data, pq_data, params.style, extent_mask, params.geobox)
-                
-    cfg = get_config()
-    return body, 200, cfg.response_headers({"Content-Type": "image/png"})
+                bands = _render_data(data, pq_data, params.style, extent_mask, params.geobox, read_geobox)
+    return bands, etag
+
+
+def _pq_band_data(data, product):
+    # PQ data from the PQ band of the main product.
+    pq_band_data = (data[product.pq_band].dims, data[product.pq_band].astype("uint16"))
+    pq_data = xarray.Dataset({product.pq_band: pq_band_data},
+                             coords=data[product.pq_band].coords
+                             )
+    flag_def = data[product.pq_band].flags_definition
+    pq_data[product.pq_band].attrs["flags_definition"] = flag_def
+    return pq_data
+
+
+def _render_streaming(stacker, datasets, params, mdh, request_id, read_geobox, pq_datasets=None):
+    # Render a multi-date request with a streaming aggregator: data is loaded and folded into
+    # the aggregate one date at a time, so only one date of data is held in memory at once.
+    #
+    # pq_datasets are the datasets of the separate PQ product (if the style uses one).  Its data
+    # is loaded with the main data one date at a time too, unless it only has one date, which
+    # applies to every date.
+    separate_pq = params.style.masks and params.product.pq_name != params.product.name
+    shared_pq_data = None
+    if separate_pq:
+        if datasets_in_xarray(pq_datasets) == 0:
+            return _render_empty(params.geobox)
+        if len(pq_datasets.time) == 1:
+            shared_pq_data = mdh.date_slice(
+                _read_pq_data(stacker, params.product, pq_datasets, request_id), 0)
+    state = mdh.streaming_aggregator.init()
+    folded = False
+    for i in range(len(datasets.time)):
+        date = datasets.time.values[i]
+        if separate_pq and shared_pq_data is None and date not in pq_datasets.time.values:
+            # No PQ data for this date.
+            continue
+        _LOG.debug("load date %d start %s %s", i, datetime.now().time(), request_id)
+        data = stacker.data(datasets.isel(time=[i]),
+                            manual_merge=params.product.data_manual_merge,
+                            fuse_func=params.product.fuse_func)
+        _LOG.debug("load date %d stop %s %s", i, datetime.now().time(), request_id)
+        if not data:
+            continue
+        if shared_pq_data is not None:
+            pq_data = shared_pq_data
+        elif separate_pq:
+            pq_data = mdh.date_slice(
+                _read_pq_data(stacker, params.product, pq_datasets.sel(time=[date]), request_id), 0)
+            if pq_data is None:
+                continue
+        elif params.style.masks:
+            pq_data = mdh.date_slice(_pq_band_data(data, params.product), 0)
+        else:
+            pq_data = None
+        extent_mask = None
+        if not params.product.data_manual_merge or params.product.native_mosaic:
+            extent_mask = mdh.date_slice(_extent_mask(data, params), 0)
+        state = mdh.fold(state, mdh.date_slice(data, 0), pq_data, extent_mask)
+        folded = True
+    if not folded:
+        return _render_empty(params.geobox)
+    return _image_bands(mdh.finalise(state), params.geobox, read_geobox)
+
+
+@contextmanager
+def _pq_executor(separate_pq):
+    # A worker thread for searching and loading a separate PQ product concurrently with the main
+    # data, or None if PQ data (if any) comes from the main product.
+    if not separate_pq:
+        yield None
+        return
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        yield executor
+    finally:
+        # Don't wait for a PQ search whose result turned out not to be needed.
+        executor.shutdown(wait=False)
+
+
+def _search_pq_datasets(stacker, product, request_id):
+    # Search for datasets of a separate flags product.
+    # Runs in a worker thread, so uses its own datacube from the pool.
+    with cube() as dc:
+        if not dc:
+            raise WMSException("Database connectivity failure")
+        _LOG.debug("pq search start %s %s", datetime.now().time(), request_id)
+        pq_datasets = stacker.datasets(dc.index, mask=True, all_time=product.pq_ignore_time)
+        _LOG.debug("pq search stop %s %s", datetime.now().time(), request_id)
+        return pq_datasets
+
+
+def _read_pq_data(stacker, product, pq_datasets, request_id):
+    # Load PQ data from the datasets of a separate flags product (None if there are none).
+    if datasets_in_xarray(pq_datasets) == 0:
+        return None
+    _LOG.debug("pq load start %s %s", datetime.now().time(), request_id)
+    pq_data = stacker.data(pq_datasets,
+                           mask=True,
+                           manual_merge=product.pq_manual_merge,
+                           fuse_func=product.pq_fuse_func)
+    _LOG.debug("pq load stop %s %s", datetime.now().time(), request_id)
+    return pq_data
+
+
+def _extent_mask(data, params):
+    td_masks = []
+    for npdt in data.time.values:
+        td = data.sel(time=npdt)
+        td_ext_mask = None
+        for band in params.style.needed_bands:
+            for f in params.product.extent_mask_func:
+                if td_ext_mask is None:
+                    td_ext_mask = f(td, band)
+                else:
+                    td_ext_mask &= f(td, band)
+        td_masks.append(td_ext_mask)
+    return xarray.concat(td_masks, dim=data.time)
 
 
 @log_call
-def _write_png(data, pq_data, style, extent_mask, geobox):
+def _render_data(data, pq_data, style, extent_mask, geobox, read_geobox=None):
     img_data = style.transform_data(data, pq_data, extent_mask)
-    width = geobox.width
-    height = geobox.height
-    # width, height = img_data.pixel_counts()
+    return _image_bands(img_data, geobox, read_geobox)
 
-    with MemoryFile() as memfile:
-        with memfile.open(driver='PNG',
-                          width=width,
-                          height=height,
-                          count=len(img_data.data_vars),
-                          transform=None,
-                          nodata=0,
-                          dtype='uint8') as thing:
-            for idx, band in enumerate(img_data.data_vars, start=1):
-                thing.write_band(idx, img_data[band].values)
 
-        return memfile.read()
+def _image_bands(img_data, geobox, read_geobox=None):
+    # Image bands at the output geobox (resampled from the read geobox, if data was read at a
+    # reduced resolution).
+    if read_geobox is None:
+        read_geobox = geobox
+    return [resample_image_band(img_data[band].values, read_geobox, geobox) for band in img_data.data_vars]
 
 
-@log_call
-def _write_empty(geobox):
-    with MemoryFile() as memfile:
-        with memfile.open(driver='PNG',
-                          width=geobox.width,
-                          height=geobox.height,
-                          count=1,
-                          transform=None,
-                          nodata=0,
-                          dtype='uint8') as thing:
-            pass
-        return memfile.read()
+def _render_empty(geobox):
+    return [numpy.zeros([geobox.height, geobox.width], dtype="uint8")]
 
 
 @log_call
-def _write_polygon(geobox, polygon, zoom_fill):
+def _render_polygon(geobox, polygon, zoom_fill):
     geobox_ext = geobox.extent
     if geobox_ext.within(polygon):
         data = numpy.full([geobox.height, geobox.width], fill_value=1, dtype="uint8")
@@ -372,17 +769,22 @@ def _write_polygon(geobox, polygon, zoom_fill):
             rs, cs = skimg_polygon([c[1] for c in pixel_coords], [c[0] for c in pixel_coords],
                                    shape=[geobox.width, geobox.height])
             data[rs, cs] = 1
+    return [data * fill for fill in zoom_fill]
+
 
+def write_png(bands):
+    # Encode a list of uint8 image bands as a PNG.
+    height, width = bands[0].shape
     with MemoryFile() as memfile:
         with memfile.open(driver='PNG',
-                          width=geobox.width,
-                          height=geobox.height,
-                          count=len(zoom_fill),
+                          width=width,
+                          height=height,
+                          count=len(bands),
                           transform=None,
                           nodata=0,
                           dtype='uint8') as thing:
-            for idx, fill in enumerate(zoom_fill, start=1):
-                thing.write_band(idx, data * fill)
+            for idx, band in enumerate(bands, start=1):
+                thing.write_band(idx, band)
         return memfile.read()
 
 
@@ -0,0 +1,239 @@
+from __future__ import absolute_import, division, print_function
+
+from bisect import bisect_left, bisect_right, insort
+from datetime import timedelta
+from threading import Lock, RLock
+from time import monotonic
+
+import numpy
+from pytz import utc
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+from datacube.api.query import solar_day
+from datacube.utils import geometry
+
+from datacube_ows.utils import get_index_sqlconn
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+def dataset_solar_date(ds):
+    try:
+        return solar_day(ds).astype("datetime64[D]").item()
+    except ValueError:
+        return ds.center_time.date()
+
+
+def as_utc(dt):
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=utc)
+    return dt.astimezone(utc)
+
+
+class DateBucket(object):
+    """All datasets for one product and solar date, spatially indexed by their lat/lon bounding boxes.
+
+    The spatial index is rebuilt lazily after the bucket changes, and can be queried concurrently.
+    """
+    def __init__(self):
+        self.datasets = {}
+        self._index = None
+        self._lock = Lock()
+
+    def add(self, ds):
+        with self._lock:
+            self.datasets[ds.id] = ds
+            self._index = None
+
+    def remove(self, ds_id):
+        with self._lock:
+            if self.datasets.pop(ds_id, None) is not None:
+                self._index = None
+
+    def _spatial_index(self):
+        # (tree, datasets, geometry id to index dict), or None if the bucket is empty.
+        with self._lock:
+            if self._index is None and self.datasets:
+                datasets = list(self.datasets.values())
+                bboxes = []
+                for ds in datasets:
+                    bbox = ds.extent.to_crs(geometry.CRS("EPSG:4326")).boundingbox
+                    bboxes.append(box(bbox.left, bbox.bottom, bbox.right, bbox.top))
+                self._index = (STRtree(bboxes), datasets, {id(g): i for i, g in enumerate(bboxes)})
+            return self._index
+
+    def query(self, bbox):
+        index = self._spatial_index()
+        if index is None:
+            return []
+        tree, datasets, geom_idx = index
+        hits = tree.query(bbox)
+        if len(hits) and not isinstance(hits[0], (int, numpy.integer)):
+            # Shapely 1.x returns geometries rather than indices.
+            hits = [geom_idx[id(g)] for g in hits]
+        return [datasets[i] for i in sorted(hits)]
+
+
+class DatasetCatalogue(object):
+    """Per-layer in-memory catalogue of dataset footprints.
+
+    Answers spatial/temporal dataset searches for the layer's products without querying
+    the index database.  The catalogue is kept up to date by polling the index for
+    datasets added or archived since the last sync.
+    """
+    def __init__(self, layer, sync_interval=300):
+        self.layer = layer
+        self.sync_interval = sync_interval
+        self.product_names = list(layer.product_names)
+        for pname in layer.pq_names + layer.ladder_product_names:
+            if pname not in self.product_names:
+                self.product_names.append(pname)
+        # Buckets by product name and solar date, with a sorted list of the dates of each product.
+        self._buckets = {}
+        self._dates = {}
+        self._dataset_buckets = {}
+        self._last_sync = None
+        self._last_sync_monotonic = None
+        # _lock guards the bucket dictionaries, and _sync_lock ensures only one thread syncs at a time.
+        self._lock = Lock()
+        self._sync_lock = RLock()
+
+    @property
+    def built(self):
+        return self._last_sync is not None
+
+    def _add(self, ds):
+        self._remove(ds.id)
+        pname, date = key = (ds.type.name, dataset_solar_date(ds))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = DateBucket()
+            insort(self._dates.setdefault(pname, []), date)
+        bucket.add(ds)
+        self._dataset_buckets[ds.id] = key
+
+    def _remove(self, ds_id):
+        key = self._dataset_buckets.pop(ds_id, None)
+        if key is not None:
+            self._buckets[key].remove(ds_id)
+
+    def _db_now(self, conn):
+        return list(conn.execute("SELECT now()"))[0][0]
+
+    def build(self, index):
+        # The database is read without holding the lock, so searches continue against the
+        # previous contents (if any) until the new contents are swapped in.
+        with self._sync_lock:
+            conn = get_index_sqlconn(index)
+            try:
+                sync_time = self._db_now(conn)
+            finally:
+                conn.close()
+            datasets = []
+            for pname in self.product_names:
+                datasets.extend(index.datasets.search(product=pname))
+            with self._lock:
+                self._buckets = {}
+                self._dates = {}
+                self._dataset_buckets = {}
+                for ds in datasets:
+                    self._add(ds)
+                self._last_sync = sync_time
+                self._last_sync_monotonic = monotonic()
+            _LOG.info("Built dataset catalogue for layer %s: %d datasets",
+                      self.layer.name, len(self._dataset_buckets))
+
+    def sync(self, index):
+        # Apply datasets added or archived since the last sync.
+        if not self.built:
+            self.build(index)
+            return
+        with self._sync_lock:
+            conn = get_index_sqlconn(index)
+            try:
+                sync_time = self._db_now(conn)
+                results = list(conn.execute("""
+                    SELECT ds.id, ds.archived IS NOT NULL
+                    FROM agdc.dataset ds, agdc.dataset_type p
+                    WHERE ds.dataset_type_ref = p.id
+                    AND p.name = ANY(%(products)s)
+                    AND (ds.added >= %(since)s OR ds.archived >= %(since)s)
+                    """,
+                    {"products": self.product_names, "since": self._last_sync}))
+            finally:
+                conn.close()
+            archived = [ds_id for ds_id, is_archived in results if is_archived]
+            added = [ds_id for ds_id, is_archived in results if not is_archived]
+            added_datasets = list(index.datasets.bulk_get(added)) if added else []
+            with self._lock:
+                for ds_id in archived:
+                    self._remove(ds_id)
+                for ds in added_datasets:
+                    self._add(ds)
+                self._last_sync = sync_time
+                self._last_sync_monotonic = monotonic()
+
+    def needs_sync(self):
+        return not self.built or monotonic() - self._last_sync_monotonic > self.sync_interval
+
+    def sync_if_needed(self, index):
+        if not self.needs_sync():
+            return
+        with self._sync_lock:
+            # Another thread may have synced while this one waited for the lock.
+            if self.needs_sync():
+                self.sync(index)
+
+    def _search_buckets(self, product_names, start=None, end=None):
+        # The buckets of the products, in date order, for solar dates from start to end (inclusive).
+        buckets = []
+        with self._lock:
+            for pname in product_names:
+                dates = self._dates.get(pname, [])
+                lo = 0 if start is None else bisect_left(dates, start)
+                hi = len(dates) if end is None else bisect_right(dates, end)
+                buckets.extend((date, self._buckets[(pname, date)]) for date in dates[lo:hi])
+        buckets.sort(key=lambda b: b[0])
+        return [bucket for _, bucket in buckets]
+
+    def search(self, index, product_names, geopolygon, time=None, limit=None):
+        """Return datasets for the products that intersect the geopolygon and the time range.
+
+        Matches the semantics of an ODC index search: datasets whose lat/lon bounding box intersects the
+        lat/lon bounding box of the geopolygon, and whose time range overlaps the (start, end) time range.
+        At most limit datasets are returned, if limit is set.
+        """
+        self.sync_if_needed(index)
+        bbox = geopolygon.to_crs(geometry.CRS("EPSG:4326")).boundingbox
+        query_box = box(bbox.left, bbox.bottom, bbox.right, bbox.top)
+        if time is not None:
+            start, end = as_utc(time[0]), as_utc(time[1])
+            # Solar date may be up to a day either side of the UTC date.
+            buckets = self._search_buckets(product_names,
+                                           start.date() - timedelta(days=1), end.date() + timedelta(days=1))
+        else:
+            buckets = self._search_buckets(product_names)
+        datasets = []
+        for bucket in buckets:
+            for ds in bucket.query(query_box):
+                if time is not None:
+                    if as_utc(ds.time.begin) > end or as_utc(ds.time.end) < start:
+                        continue
+                datasets.append(ds)
+                if limit is not None and len(datasets) >= limit:
+                    return datasets
+        return datasets
+
+
+def catalogue_layers(cfg):
+    # The layers that use an in-memory dataset catalogue.
+    return [lyr for lyr in cfg.product_index.values() if getattr(lyr, "dataset_catalogue", None) is not None]
+
+
+def build_catalogues(cfg, index):
+    # Build the in-memory dataset catalogues for all layers that use them.
+    for lyr in catalogue_layers(cfg):
+        lyr.dataset_catalogue.build(index)
@@ -0,0 +1,193 @@
+from __future__ import absolute_import, division, print_function
+
+import ast
+from functools import lru_cache
+
+import numpy
+from xarray import DataArray
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+_BINARY_OPS = {
+    ast.Add: numpy.add,
+    ast.Sub: numpy.subtract,
+    ast.Mult: numpy.multiply,
+    ast.Div: numpy.true_divide,
+    ast.Pow: numpy.power,
+}
+
+_UNARY_OPS = {
+    ast.USub: numpy.negative,
+    ast.UAdd: numpy.positive,
+}
+
+# Functions that may be called in expressions (all supported by numexpr under the same name).
+_FUNCTIONS = {
+    "sqrt": numpy.sqrt,
+    "exp": numpy.exp,
+    "log": numpy.log,
+    "log10": numpy.log10,
+    "abs": numpy.absolute,
+}
+
+
+class ExpressionPlan(object):
+    """An arithmetic expression over named arrays, compiled to a sequence of numpy ufunc calls.
+
+    Operands are the named input arrays (or scalars), constants, or numbered scratch buffers.
+    The result of each operation is written (with out=) into the scratch buffer of one of its
+    operands where possible, so evaluation needs only as many full size temporaries as the
+    depth of the expression, rather than one per operation.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        try:
+            tree = ast.parse(expr, mode="eval")
+        except SyntaxError as e:
+            raise ValueError("Invalid expression %r: %s" % (expr, e.msg))
+        self.names = []
+        self.ops = []
+        self.n_buffers = 0
+        self._free = []
+        self.result = self._compile(tree.body)
+
+    def _buffer(self, *operands):
+        # A scratch buffer for the result of an operation: reuse the first operand buffer
+        # and release the others.
+        bufs = [op[1] for op in operands if op[0] == "buf"]
+        if bufs:
+            self._free.extend(bufs[1:])
+            return bufs[0]
+        if self._free:
+            return self._free.pop()
+        self.n_buffers += 1
+        return self.n_buffers - 1
+
+    def _compile(self, node):
+        # pylint: disable=too-many-return-statements
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return ("const", float(node.value))
+        if isinstance(node, ast.Name):
+            if node.id not in self.names:
+                self.names.append(node.id)
+            return ("name", node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return self._emit(_BINARY_OPS[type(node.op)], self._compile(node.left), self._compile(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            return self._emit(_UNARY_OPS[type(node.op)], self._compile(node.operand))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS \
+                and len(node.args) == 1 and not node.keywords:
+            return self._emit(_FUNCTIONS[node.func.id], self._compile(node.args[0]))
+        raise ValueError("Unsupported element in expression %r: %s" % (self.expr, ast.dump(node)))
+
+    def _emit(self, ufunc, *operands):
+        if all(op[0] == "const" for op in operands):
+            # Fold constant sub-expressions.
+            return ("const", float(ufunc(*[op[1] for op in operands])))
+        out = self._buffer(*operands)
+        self.ops.append((ufunc, operands, out))
+        return ("buf", out)
+
+    def evaluate(self, values, dtype):
+        # Evaluate over a dictionary of named arrays (or scalars), in the given floating point dtype.
+        shape = None
+        for val in values.values():
+            if isinstance(val, numpy.ndarray):
+                shape = val.shape
+                break
+        buffers = [numpy.empty(shape, dtype=dtype) for i in range(self.n_buffers)]
+
+        def resolve(op):
+            if op[0] == "buf":
+                return buffers[op[1]]
+            if op[0] == "name":
+                return values[op[1]]
+            return op[1]
+
+        for ufunc, operands, out in self.ops:
+            ufunc(*[resolve(op) for op in operands], out=buffers[out], dtype=dtype, casting="unsafe")
+        kind, result = self.result
+        if kind == "buf":
+            return buffers[result]
+        if kind == "const":
+            return numpy.full(shape, result, dtype=dtype)
+        return numpy.array(values[result], dtype=dtype)
+
+
+@lru_cache(maxsize=256)
+def compile_expression(expr):
+    return ExpressionPlan(expr)
+
+
+def compute_dtype(arrays):
+    # Floating point type to evaluate in: float32 if the inputs are all float32 or integers
+    # that float32 represents exactly, otherwise float64.
+    return numpy.result_type(*[arr.dtype for arr in arrays], numpy.float32)
+
+
+def evaluate(data, expr, **names):
+    """Evaluate an arithmetic expression over bands of an xarray Dataset.
+
+    Names in the expression refer to bands of data, unless they are passed as keyword arguments,
+    in which case they are either a band name (a str) or a numeric scalar.
+
+    Evaluated with numexpr if it is installed, or a cached numpy plan otherwise.
+    Returns a DataArray with the dimensions and coordinates of the first band in the expression.
+    """
+    plan = compile_expression(expr)
+    template = None
+    values = {}
+    for name in plan.names:
+        val = names.get(name, name)
+        if isinstance(val, str):
+            band = data[val]
+            if template is None:
+                template = band
+            values[name] = band.values
+        else:
+            values[name] = val
+    if template is None:
+        raise ValueError("Expression %r does not refer to any bands" % expr)
+    dtype = compute_dtype([val for val in values.values() if isinstance(val, numpy.ndarray)])
+    if numexpr is not None:
+        result = numexpr.evaluate(
+            expr,
+            local_dict={
+                name: val.astype(dtype, copy=False) if isinstance(val, numpy.ndarray) else val
+                for name, val in values.items()
+            }
+        ).astype(dtype, copy=False)
+    else:
+        result = plan.evaluate(values, dtype)
+    return DataArray(result, dims=template.dims, coords=template.coords)
+
+
+class Expression(object):
+    """A configured expression index function.
+
+    Band names in the expression may be band aliases, which are resolved when the
+    configuration is loaded.
+    """
+    def __init__(self, expr, product_cfg=None):
+        self.expr = expr
+        plan = compile_expression(expr)
+        if product_cfg is not None:
+            self.names = {name: product_cfg.band_idx.band(name) for name in plan.names}
+        else:
+            self.names = {}
+
+    @property
+    def bands(self):
+        return [self.names.get(name, name) for name in compile_expression(self.expr).names]
+
+    def __call__(self, data, *args, **kwargs):
+        return evaluate(data, self.expr, **self.names)
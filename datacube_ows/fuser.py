@@ -0,0 +1,90 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy
+import xarray
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+def nodata_mask(arr, nodata):
+    # Boolean array: True where arr is nodata (or NaN).
+    if nodata is None or (isinstance(nodata, float) and numpy.isnan(nodata)):
+        if arr.dtype.kind == "f":
+            return numpy.isnan(arr)
+        return numpy.zeros(arr.shape, dtype="bool")
+    if arr.dtype.kind == "f":
+        return numpy.isnan(arr) | (arr == nodata)
+    return arr == nodata
+
+
+class Mosaic(object):
+    """Mosaics per-dataset data into one preallocated output array per band.
+
+    Output arrays are allocated once, in the dtype of the first data added for the band, and
+    filled with nodata.  Datasets are then fused in place, in the order they are added: by default
+    the first valid value for a pixel wins (as with combine_first), or the layer's fuse_func is
+    applied.  The first dataset for each time slice is copied in directly, so fuse_func only ever
+    sees data that was actually loaded.
+    """
+    def __init__(self, n_times, fuse_func=None):
+        self.n_times = n_times
+        self.fuse_func = fuse_func
+        self.arrays = {}
+        self.nodata = {}
+        self.attrs = {}
+        # (band, t_idx) pairs that have had a dataset added.
+        self.started = set()
+        self.coords = None
+        self.dims = None
+
+    def _allocate(self, band, da):
+        nodata = da.attrs.get("nodata")
+        if nodata is None and da.dtype.kind == "f":
+            nodata = numpy.nan
+        elif nodata is None:
+            nodata = 0
+        self.nodata[band] = nodata
+        self.attrs[band] = dict(da.attrs, nodata=nodata)
+        self.arrays[band] = numpy.full((self.n_times,) + da.shape, nodata, dtype=da.dtype)
+        if self.coords is None:
+            self.dims = da.dims
+            self.coords = {name: coord for name, coord in da.coords.items() if name != "time"}
+
+    def add(self, t_idx, data, valid=None):
+        # Fuse a single dataset (an xarray Dataset with no time dimension) into time slice t_idx.
+        # Pixels where valid is False are treated as nodata.
+        for band, da in data.data_vars.items():
+            if band not in self.arrays:
+                self._allocate(band, da)
+            dest = self.arrays[band][t_idx]
+            nodata = self.nodata[band]
+            src = da.values
+            src_missing = nodata_mask(src, nodata)
+            if valid is not None:
+                src_missing |= ~valid
+            if self.fuse_func is not None:
+                src = numpy.where(src_missing, nodata, src).astype(dest.dtype, copy=False)
+                if (band, t_idx) in self.started:
+                    self.fuse_func(dest, src)
+                else:
+                    dest[...] = src
+                    self.started.add((band, t_idx))
+            else:
+                fill = nodata_mask(dest, nodata)
+                fill &= ~src_missing
+                numpy.copyto(dest, src, where=fill, casting="unsafe")
+
+    def result(self, time_coord):
+        if not self.arrays:
+            return None
+        coords = dict(self.coords)
+        coords["time"] = time_coord
+        return xarray.Dataset(
+            {
+                band: (("time",) + tuple(self.dims), arr, self.attrs[band])
+                for band, arr in self.arrays.items()
+            },
+            coords=coords
+        )
@@ -1,26 +1,115 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from math import isclose
 
 from datacube_ows.ogc_exceptions import WMSException
+from datacube_ows.ogc_utils import etag_matches
+from datacube_ows.single_flight import SingleFlight
 from datacube_ows.wms_utils import GetLegendGraphicParameters
+import hashlib
 import io
 from PIL import Image
 import numpy as np
 from flask import make_response
 import requests
 
-import matplotlib
-# Do not use X Server backend
 
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+_LOG = logging.getLogger(__name__)
 
 
-_LOG = logging.getLogger(__name__)
+# Rendered legends depend only on configuration, so are memoised per worker, keyed on the
+# style objects (so a reloaded configuration is never served stale legends) and the set of
+# multi-date handlers that apply to the number of dates.
+_LEGEND_CACHE = {}
+LEGEND_FLIGHTS = SingleFlight("legend")
+
+
+class LegendUrlCache(object):
+    """Legend images fetched from style legend URL overrides, cached per URL.
+
+    Missing and expired entries are fetched in a background thread.  A lookup for a url that
+    has never been fetched waits for the fetch, for at most the fetch timeout.  Otherwise lookups
+    never wait on the network: until the fetch completes an expired image continues to be served
+    (stale while revalidate).  A failed fetch keeps any previously fetched image, and is retried
+    after retry_interval seconds (or the ttl, if shorter).
+    """
+    def __init__(self, ttl=600, timeout=1, retry_interval=60, max_workers=2):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.max_workers = max_workers
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _executor(self):
+        # Threads do not survive a fork, so each worker process needs its own pool.
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._pool_pid = os.getpid()
+            self._pending = {}
+        return self._pool
+
+    def get(self, url):
+        # The cached PNG for the url (or None), scheduling a refresh if it is missing or expired.
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or self._expired(entry):
+                self._refresh_in_background(url)
+            cold_fetch = self._pending.get(url) if entry is None else None
+        if cold_fetch is not None:
+            wait([cold_fetch], timeout=self.timeout)
+            with self._lock:
+                entry = self._entries.get(url)
+        return entry[1] if entry else None
+
+    def _expired(self, entry):
+        fetched, _, ok = entry
+        max_age = self.ttl if ok else min(self.ttl, self.retry_interval)
+        return time.monotonic() - fetched >= max_age
+
+    def _refresh_in_background(self, url):
+        executor = self._executor()
+        if url not in self._pending:
+            self._pending[url] = executor.submit(self.refresh, url)
+
+    def refresh(self, url):
+        png = None
+        try:
+            png = fetch_legend_png(url, self.timeout)
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                if png is not None:
+                    self._entries[url] = (now, png, True)
+                else:
+                    old = self._entries.get(url)
+                    self._entries[url] = (now, old[1] if old else None, False)
+                self._pending.pop(url, None)
+        return png
+
+    def prefetch(self, urls, timeout=None):
+        # Fetch the urls in the background, waiting up to timeout seconds for them to complete.
+        with self._lock:
+            for url in urls:
+                self._refresh_in_background(url)
+            futures = list(self._pending.values())
+        wait(futures, timeout=timeout)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+LEGEND_URLS = LegendUrlCache()
 
 
 def legend_graphic(args):
@@ -29,17 +118,70 @@ def legend_graphic(args):
                         ndates=len(params.times))
     if img is None:
         raise WMSException("No legend is available for this request")
-    return img
+    return not_modified_response(img, args.get("if_none_match") if args else None)
 
 
-def create_legend_for_style(product, style_name, ndates=0):
+def create_legend_for_style(product, style_name, ndates=0, if_none_match=None):
     if style_name not in product.style_index:
         return None
     style = product.style_index[style_name]
-    return create_legends_from_styles([style], ndates)
+    return not_modified_response(create_legends_from_styles([style], ndates), if_none_match)
+
+
+def not_modified_response(legend, if_none_match):
+    # A 304 Not Modified response if the client already has the legend.
+    if legend is None or not etag_matches(if_none_match, legend.headers.get("ETag")):
+        return legend
+    response = make_response("", 304)
+    response.headers["ETag"] = legend.headers["ETag"]
+    return response
+
+
+def legend_etag(png):
+    return '"%s"' % hashlib.sha1(png).hexdigest()
+
+
+def legend_cache_key(styles, ndates):
+    if ndates in (0, 1):
+        variant = ndates
+    else:
+        variant = tuple(
+            tuple(mdh.applies_to(ndates) for mdh in s.multi_date_handlers)
+            for s in styles
+        )
+    return (tuple(styles), variant)
+
+
+def legend_png(styles, ndates=0):
+    # The (png, etag) for the legend of the styles, or None if no legend is available.
+    # Memoised unless a style has a legend URL override.
+    if any(s.legend_override_with_url() for s in styles):
+        png = render_legend_png(styles, ndates)
+        return None if png is None else (png, legend_etag(png))
+    key = legend_cache_key(styles, ndates)
+    if key in _LEGEND_CACHE:
+        return _LEGEND_CACHE[key]
+
+    def render():
+        png = render_legend_png(styles, ndates)
+        entry = None if png is None else (png, legend_etag(png))
+        _LEGEND_CACHE[key] = entry
+        return entry
+    return LEGEND_FLIGHTS.do(key, render)
 
 
 def create_legends_from_styles(styles, ndates=0):
+    entry = legend_png(styles, ndates)
+    if entry is None:
+        return None
+    png, etag = entry
+    legend = make_response(png)
+    legend.mimetype = 'image/png'
+    legend.headers["ETag"] = etag
+    return legend
+
+
+def render_legend_png(styles, ndates=0):
     # Run through all values in style cfg and generate
     imgs = []
     for s in styles:
@@ -68,20 +210,60 @@ def create_legends_from_styles(styles, ndates=0):
     imgs_comb = Image.fromarray(imgs_comb)
     b = io.BytesIO()
     imgs_comb.save(b, 'png')
-    legend = make_response(b.getvalue())
-    legend.mimetype = 'image/png'
+    png = b.getvalue()
     b.close()
-    return legend
+    return png
 
 
-def get_image_from_url(url):
-    foo = requests.get
-    r = requests.get(url, timeout=1)
-    if r.status_code == 200 and r.headers['content-type'] == 'image/png':
-        bytesio = io.BytesIO()
-        bytesio.write(r.content)
-        bytesio.seek(0)
-        return Image.open(bytesio)
+def pregenerate_legends(cfg):
+    # Render and memoise the legends for every style of every layer, for requests
+    # with no dates, a single date, and the smallest date count of each multi-date handler.
+    count = 0
+    for layer in cfg.product_index.values():
+        for style in layer.styles:
+            if not style.show_legend or style.legend_override_with_url():
+                continue
+            for ndates in [0, 1] + [mdh.min_count for mdh in style.multi_date_handlers]:
+                try:
+                    if legend_png([style], ndates) is not None:
+                        count += 1
+                # pylint: disable=broad-except
+                except Exception as e:
+                    _LOG.warning("Could not generate legend for style %s of layer %s: %s",
+                                 style.name, layer.name, str(e))
+    _LOG.info("Pre-generated %d legends", count)
+    return count
+
+
+def fetch_legend_png(url, timeout=1):
+    try:
+        r = requests.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        _LOG.warning("Could not fetch legend from %s: %s", url, str(e))
+        return None
+    if r.status_code == 200 and r.headers.get('content-type') == 'image/png':
+        return r.content
+    _LOG.warning("Could not fetch legend from %s: status %s, content type %s",
+                 url, r.status_code, r.headers.get('content-type'))
     return None
 
 
+def get_image_from_url(url):
+    # Served from the legend URL cache - None if the legend could not be fetched (in time).
+    png = LEGEND_URLS.get(url)
+    if png is None:
+        return None
+    return Image.open(io.BytesIO(png))
+
+
+def prefetch_legend_urls(cfg, timeout=None):
+    # Fetch the legend URL overrides of every style of every layer into the legend URL cache.
+    urls = set()
+    for layer in cfg.product_index.values():
+        for style in layer.styles:
+            url = style.legend_override_with_url()
+            if url:
+                urls.add(url)
+    LEGEND_URLS.prefetch(urls, timeout=timeout)
+    _LOG.info("Pre-fetched %d legend urls", len(urls))
+    return len(urls)
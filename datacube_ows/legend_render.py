@@ -0,0 +1,141 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import numpy
+from colour import Color
+from PIL import Image, ImageDraw, ImageFont
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Legends are laid out in inches and points at this resolution, as for matplotlib's default dpi.
+DPI = 100
+FONT_SIZE = 10
+TICK_LENGTH = 3.5
+TICK_PAD = 3.5
+LABEL_PAD = 4.0
+
+# Patch legend geometry, in multiples of the font size (as matplotlib legend defaults).
+HANDLE_LENGTH = 2.0
+HANDLE_HEIGHT = 0.7
+HANDLE_TEXT_PAD = 0.8
+LABEL_SPACING = 0.5
+
+# matplotlib's pyplot state (including rcParams) is global, so only one thread may
+# draw a matplotlib legend at a time.
+MPL_LOCK = threading.RLock()
+
+
+def pyplot():
+    # matplotlib is only imported when a legend needs it, with a non-interactive backend.
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    return plt
+
+
+def points(pts, dpi=DPI):
+    return int(round(pts * dpi / 72.0))
+
+
+def legend_font(size=FONT_SIZE, dpi=DPI):
+    # Scalable default font (requires Pillow 10.1 or later).
+    return ImageFont.load_default(size=points(size, dpi))
+
+
+def blank_image(width, height, dpi=DPI):
+    return Image.new("RGBA", (int(round(width * dpi)), int(round(height * dpi))), (255, 255, 255, 255))
+
+
+def save_png(img, bytesio):
+    img.save(bytesio, format="PNG")
+
+
+def sample_cdict(cdict, n):
+    # Sample a matplotlib style segment data dictionary at n evenly spaced points from 0 to 1,
+    # returning an (n, 3) array of 8 bit RGB, composited over white.
+    xs = (numpy.arange(n) + 0.5) / n
+    channels = {}
+    for band in ("red", "green", "blue", "alpha"):
+        if band not in cdict:
+            channels[band] = numpy.ones(n)
+            continue
+        seg = cdict[band]
+        channels[band] = numpy.interp(xs, [s[0] for s in seg], [s[1] for s in seg])
+    alpha = channels["alpha"]
+    rgb = numpy.stack([channels[band] * alpha + (1.0 - alpha) for band in ("red", "green", "blue")], axis=-1)
+    return numpy.clip(rgb * 255.0 + 0.5, 0, 255).astype("uint8")
+
+
+def colour_bar(bytesio, cdict, ticks, title, width=4, height=1.25,
+               strip_location=(0.05, 0.5, 0.9, 0.15), dpi=DPI):
+    """Draw a horizontal colour bar legend as a PNG.
+
+    cdict is a matplotlib style segment data dictionary, ticks is a dictionary of labels keyed
+    by position along the bar (from 0.0 to 1.0) or None, and the figure size (in inches) and
+    strip location (left, bottom, width, height as fractions of the figure) are interpreted as
+    for matplotlib.
+    """
+    img = blank_image(width, height, dpi)
+    draw = ImageDraw.Draw(img)
+    font = legend_font(dpi=dpi)
+    fig_w, fig_h = img.size
+    left, bottom, strip_w, strip_h = strip_location
+    x0 = int(round(left * fig_w))
+    x1 = max(int(round((left + strip_w) * fig_w)), x0 + 1)
+    y0 = int(round((1.0 - bottom - strip_h) * fig_h))
+    y1 = max(int(round((1.0 - bottom) * fig_h)), y0 + 1)
+
+    strip = sample_cdict(cdict, x1 - x0)
+    img.paste(Image.fromarray(numpy.repeat(strip[numpy.newaxis], y1 - y0, axis=0), "RGB"), (x0, y0))
+    draw.rectangle((x0, y0, x1 - 1, y1 - 1), outline=(0, 0, 0, 255))
+
+    text_top = y1 + points(TICK_LENGTH, dpi) + points(TICK_PAD, dpi)
+    label_bottom = y1
+    for pos, label in (ticks or {}).items():
+        x = x0 + pos * (x1 - x0 - 1)
+        draw.line((x, y1, x, y1 + points(TICK_LENGTH, dpi)), fill=(0, 0, 0, 255))
+        draw.text((x, text_top), str(label), font=font, fill=(0, 0, 0, 255), anchor="ma")
+        label_bottom = max(label_bottom, draw.textbbox((x, text_top), str(label), font=font, anchor="ma")[3])
+    if title:
+        draw.text(((x0 + x1) / 2.0, label_bottom + points(LABEL_PAD, dpi)), title,
+                  font=font, fill=(0, 0, 0, 255), anchor="ma")
+    save_png(img, bytesio)
+
+
+def patch_legend(bytesio, patches, width=3, height=1.25, dpi=DPI):
+    """Draw a legend of colour patches and labels, centred in the image, as a PNG.
+
+    patches is a list of (colour, label) tuples.  Colours may be anything understood by the
+    colour library and labels may span several lines.
+    """
+    img = blank_image(width, height, dpi)
+    draw = ImageDraw.Draw(img)
+    font = legend_font(dpi=dpi)
+    em = points(FONT_SIZE, dpi)
+    handle_w = int(round(HANDLE_LENGTH * em))
+    handle_h = int(round(HANDLE_HEIGHT * em))
+    text_x = handle_w + int(round(HANDLE_TEXT_PAD * em))
+    spacing = int(round(LABEL_SPACING * em))
+
+    rows = []
+    for colour, label in patches:
+        bbox = draw.multiline_textbbox((0, 0), label, font=font)
+        rows.append((colour, label, bbox[2] - bbox[0], max(bbox[3], handle_h)))
+    if not rows:
+        save_png(img, bytesio)
+        return
+    block_w = text_x + max(row[2] for row in rows)
+    block_h = sum(row[3] for row in rows) + spacing * (len(rows) - 1)
+    left = (img.size[0] - block_w) // 2
+    top = (img.size[1] - block_h) // 2
+    for colour, label, _, row_h in rows:
+        rgb = tuple(int(round(c * 255)) for c in Color(colour).rgb)
+        handle_top = top + (row_h - handle_h) // 2
+        draw.rectangle((left, handle_top, left + handle_w - 1, handle_top + handle_h - 1), fill=rgb + (255,))
+        draw.multiline_text((left + text_x, top), label, font=font, fill=(0, 0, 0, 255))
+        top += row_h + spacing
+    save_png(img, bytesio)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from uuid import uuid4
+
+import click
+import numpy
+import rasterio
+import rasterio.shutil
+import xarray
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+
+from datacube.utils import geometry
+
+from datacube_ows import __version__
+from datacube_ows.cube_pool import cube
+from datacube_ows.ows_configuration import get_config
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Low zoom mosaics are coarse resolution, whole-of-layer COGs built offline (one per layer and date)
+# that are used to render requests zoomed out beyond the layer's min_zoom_factor.
+
+
+def mosaic_path(layer, dt):
+    return os.path.join(layer.low_zoom_mosaic["path"], layer.name, dt.strftime("%Y-%m-%d") + ".tif")
+
+
+def mosaic_geobox(layer):
+    # The mosaic grid covers the full extent of the layer at the configured resolution.
+    crs_id = layer.low_zoom_mosaic["crs"]
+    bbox = layer.ranges["bboxes"][crs_id]
+    res_x, res_y = layer.low_zoom_mosaic["resolution"]
+    width = int(math.ceil((bbox["right"] - bbox["left"]) / res_x))
+    height = int(math.ceil((bbox["top"] - bbox["bottom"]) / res_y))
+    transform = Affine.translation(bbox["left"], bbox["top"]) * Affine.scale(res_x, -res_y)
+    return geometry.GeoBox(width, height, transform, geometry.CRS(crs_id))
+
+
+def mosaic_bands(layer):
+    return layer.low_zoom_mosaic.get("bands") or list(layer.band_idx.native_bands.index)
+
+
+def build_mosaic(layer, dt, dc):
+    # Load the whole layer for one date onto the mosaic grid and write it out as a COG.
+    # Returns False if there is no data for the date.
+    from datacube_ows.data import DataStacker, datasets_in_xarray
+    geobox = mosaic_geobox(layer)
+    bands = mosaic_bands(layer)
+    stacker = DataStacker(layer, geobox, [dt], bands=bands)
+    datasets = stacker.datasets(dc.index)
+    if datasets_in_xarray(datasets) == 0:
+        return False
+    data = stacker.data(datasets,
+                        manual_merge=layer.data_manual_merge,
+                        fuse_func=layer.fuse_func)
+    data = data.squeeze("time", drop=True)
+
+    dtype = numpy.result_type(*[data[band].dtype for band in bands])
+    nodata = data[bands[0]].attrs.get("nodata")
+    path = mosaic_path(layer, dt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%s.tmp" % (path, uuid4().hex)
+    try:
+        with rasterio.open(tmp_path, "w",
+                           driver="GTiff",
+                           width=geobox.width,
+                           height=geobox.height,
+                           count=len(bands),
+                           dtype=dtype,
+                           nodata=nodata,
+                           crs=geobox.crs.crs_str,
+                           transform=geobox.affine,
+                           tiled=True,
+                           blockxsize=512,
+                           blockysize=512,
+                           compress="deflate") as dst:
+            for idx, band in enumerate(bands, start=1):
+                arr = data[band].values.astype(dtype)
+                band_nodata = data[band].attrs.get("nodata")
+                if nodata is not None and band_nodata is not None and band_nodata != nodata:
+                    # GeoTIFF supports a single nodata value across all bands
+                    arr[data[band].values == band_nodata] = nodata
+                dst.write(arr, idx)
+                dst.set_band_description(idx, band)
+            factors = [2 ** i for i in range(1, 8) if max(geobox.width, geobox.height) // 2 ** i >= 256]
+            dst.build_overviews(factors, Resampling.nearest)
+        # Copy to a Cloud-Optimised GeoTIFF, with overviews before full resolution data.
+        cog_path = "%s.%s.tmp" % (path, uuid4().hex)
+        rasterio.shutil.copy(tmp_path, cog_path,
+                             driver="GTiff",
+                             tiled=True,
+                             blockxsize=512,
+                             blockysize=512,
+                             compress="deflate",
+                             copy_src_overviews=True)
+        os.replace(cog_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+def read_mosaic(layer, times, geobox, bands):
+    # Read the mosaics for the requested times, warped to the requested geobox.
+    # Returns None if the layer has no mosaic for any of the requested times.
+    if not layer.low_zoom_mosaic:
+        return None
+    paths = [mosaic_path(layer, dt) for dt in times]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    time_slices = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            band_idx = {desc: idx for idx, desc in enumerate(src.descriptions, start=1)}
+            if not all(band in band_idx for band in bands):
+                _LOG.warning("Low zoom mosaic %s does not contain all required bands", path)
+                return None
+            with WarpedVRT(src,
+                           crs=geobox.crs.crs_str,
+                           transform=geobox.affine,
+                           width=geobox.width,
+                           height=geobox.height,
+                           resampling=Resampling.nearest) as vrt:
+                arrays = vrt.read([band_idx[band] for band in bands])
+            nodata = src.nodata
+        time_slices.append(xarray.Dataset(
+            {
+                band: (geobox.dimensions, arrays[i], {"nodata": nodata})
+                for i, band in enumerate(bands)
+            },
+            coords=geobox.xr_coords()
+        ))
+    return xarray.concat(time_slices,
+                         xarray.DataArray([numpy.datetime64(dt, "ns") for dt in times], dims="time", name="time"))
+
+
+def _build_task(layer_name, dt):
+    # Runs in a worker process
+    cfg = get_config()
+    layer = cfg.product_index[layer_name]
+    with cube() as dc:
+        return build_mosaic(layer, dt, dc)
+
+
+@click.command()
+@click.option("--workers", default=4, help="Number of worker processes (default 4)")
+@click.option("--overwrite/--no-overwrite", default=False, help="Rebuild mosaics that already exist (default: skip them).")
+@click.option("--version", is_flag=True, default=False, help="Print version string and exit")
+@click.argument("layers", nargs=-1)
+def main(layers, workers, overwrite, version):
+    """Build low zoom mosaics for datacube-ows layers.
+
+    Builds a mosaic for each date of each of the specified OWS LAYERS (or all layers
+    configured with a low_zoom_mosaic section if no LAYERS are specified).
+
+    Uses the DATACUBE_OWS_CFG environment variable to find the OWS config file.
+    """
+    if version:
+        print("Open Data Cube Open Web Services (datacube-ows) version",
+              __version__
+               )
+        return 0
+    cfg = get_config()
+    if not layers:
+        layers = [name for name, lyr in cfg.product_index.items() if lyr.low_zoom_mosaic]
+    tasks = []
+    for name in layers:
+        lyr = cfg.product_index.get(name)
+        if lyr is None:
+            print("Unknown layer:", name)
+            return 1
+        if not lyr.low_zoom_mosaic:
+            print("Layer %s is not configured for low zoom mosaics" % name)
+            return 1
+        for dt in lyr.ranges["times"]:
+            if overwrite or not os.path.exists(mosaic_path(lyr, dt)):
+                tasks.append((name, dt))
+    print("Building %d mosaics" % len(tasks))
+    failed = 0
+    # Worker processes are spawned rather than forked, so that they do not share the
+    # database connections already opened by this process.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(_build_task, name, dt): (name, dt) for name, dt in tasks}
+        for future in as_completed(futures):
+            name, dt = futures[future]
+            try:
+                if future.result():
+                    print("Built mosaic for", name, dt)
+                else:
+                    print("No data for", name, dt)
+            # pylint: disable=broad-except
+            except Exception as e:
+                failed += 1
+                print("Failed to build mosaic for", name, dt, ":", str(e))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ from flask import Flask, request, g, render_template
 from flask_log_request_id import RequestID, RequestIDLogFilter, current_request_id
 import os
 
-from datacube_ows.legend_generator import create_legend_for_style
+from datacube_ows.legend_generator import LEGEND_URLS, create_legend_for_style, pregenerate_legends, \
+    prefetch_legend_urls
 from datacube_ows.ogc_utils import capture_headers, resp_headers, get_service_base_url
 from datacube_ows.wms import handle_wms, WMS_REQUESTS
 from datacube_ows.wcs1 import handle_wcs1, WCS_REQUESTS
@@ -23,6 +24,7 @@ from datacube_ows.ogc_exceptions import OGCException, WCS1Exception, WCS2Excepti
 from datacube_ows.cube_pool import cube
 from datacube.utils.rio import set_default_rio_config
 from datacube_ows.ows_configuration import get_config
+from datacube_ows.dataset_catalogue import build_catalogues, catalogue_layers
 
 import logging
 
@@ -52,7 +54,14 @@ RequestID(app)
 
 # Parse config file
 if not os.environ.get("DEFER_CFG_PARSE"):
-    get_config()
+    if catalogue_layers(get_config()):
+        with cube() as dc:
+            build_catalogues(get_config(), dc.index)
+    if get_config().pregenerate_legends:
+        pregenerate_legends(get_config())
+    LEGEND_URLS.ttl = get_config().legend_url_ttl
+    if get_config().prefetch_legend_urls:
+        prefetch_legend_urls(get_config())
 
 # If invoked using Gunicorn, link our root logger to the gunicorn logger
 # this will mean the root logs will be captured and managed by the gunicorn logger
@@ -204,6 +213,7 @@ def ogc_svc_impl(svc):
 
         version = nocase_args.get("version")
         version_support = svc_support.negotiated_version(version)
+        nocase_args["negotiated_version"] = version_support.version
     except OGCException as e:
         return e.exception_response()
 
@@ -261,7 +271,7 @@ def legend(layer, style, dates=None):
         ndates = int(args.get("ndates", 0))
     else:
         ndates = len(dates)
-    img = create_legend_for_style(product, style, ndates)
+    img = create_legend_for_style(product, style, ndates, if_none_match=request.headers.get("If-None-Match"))
     if not img:
         return ("Unknown Style", 404, resp_headers({"Content-Type": "text/plain"}))
     return img
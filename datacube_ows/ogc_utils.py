@@ -2,6 +2,8 @@ from __future__ import absolute_import, division, print_function
 
 import re
 import datetime
+import hashlib
+import json
 from importlib import import_module
 from itertools import chain
 
@@ -11,6 +13,8 @@ from timezonefinderL import TimezoneFinder
 from datacube.utils import geometry
 from pytz import timezone, utc
 
+from datacube_ows.expression import Expression
+
 import logging
 
 _LOG = logging.getLogger(__name__)
@@ -152,9 +156,44 @@ def capture_headers(request, args_dict):
     args_dict['requestid'] = request.environ.get("FLASK_REQUEST_ID")
     args_dict['host'] = request.headers.get('Host', None)
     args_dict['url_root'] = request.url_root
+    args_dict['if_none_match'] = request.headers.get('If-None-Match', None)
 
     return args_dict
 
+
+def etag_matches(if_none_match, etag):
+    # Whether an If-None-Match request header matches an ETag (using weak comparison, as
+    # specified for If-None-Match).
+    if not if_none_match or not etag:
+        return False
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _digest_default(obj):
+    # JSON encoding for values in configuration and range dictionaries that json cannot encode.
+    # Functions are identified by name rather than repr, so digests agree across processes.
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    if callable(obj) and hasattr(obj, "__qualname__"):
+        return "%s.%s" % (obj.__module__, obj.__qualname__)
+    return str(obj)
+
+
+def json_digest(obj):
+    # A hex digest of a JSON-like structure, stable across processes.
+    return hashlib.sha1(
+        json.dumps(obj, default=_digest_default, skipkeys=True).encode("utf-8")
+    ).hexdigest()
+
 # Exceptions raised when attempting to create a
 # product layer from a bad config or without correct
 # product range
@@ -176,6 +215,14 @@ class FunctionWrapper(object):
             self._args = []
             self._kwargs = {}
             self.product_cfg = None
+        elif "expression" in func_cfg:
+            try:
+                self._func = Expression(func_cfg["expression"], product_cfg)
+            except ValueError as e:
+                raise ConfigException(str(e))
+            self._args = []
+            self._kwargs = {}
+            self.product_cfg = None
         else:
             self._func = get_function(func_cfg["function"])
             self._args = func_cfg.get("args", [])
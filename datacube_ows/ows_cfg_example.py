@@ -174,6 +174,11 @@ style_rgb = {
     # The raw band value range to be compressed to an 8 bit range for the output image tiles.
     # Band values outside this range are clipped to 0 or 255 as appropriate.
     "scale_range": [0.0, 3000.0],
+    # If true, the linear combination is compiled into a kernel that renders directly from numpy arrays,
+    # which is faster than the default xarray implementation.  Only supported if all components are
+    # linear combinations and every channel (except alpha) has a scale_range.
+    # (Defaults to false.)
+    "numpy_kernel": False,
     # Legend section is optional for linear combination styles. If not supplied, no legend is displayed
     "legend": {
         # Whether or not to display a legend for this style.
@@ -507,7 +512,7 @@ style_ndvi = {
     "abstract": "Normalised Difference Vegetation Index - a derived index that correlates well with the existence of vegetation",
     # The index function is continuous value from which the heat map is derived.
     #
-    # Two formats are supported:
+    # Three formats are supported:
     # 1. A string containing a fully qualified path to a python function
     #    e.g. "index_function": "datacube_ows.ogc_utils.not_a_real_function_name",
     #
@@ -520,8 +525,11 @@ style_ndvi = {
     #       to the function in the args or kwargs.  The product_cfg allows the index function to convert band aliases to
     #       to band names.
     #
+    # 3. A dict containing an "expression": an arithmetic expression over band names or aliases,
+    #    e.g. "index_function": {"expression": "(nir - red) / (nir + red)"},
+    #
     # The function is assumed to take one arguments, an xarray Dataset.  (Plus any additional
-    # arguments required by the args and kwargs values in format 3, possibly including product_cfg.)
+    # arguments required by the args and kwargs values in format 2, possibly including product_cfg.)
     #
     "index_function": {
         "function": "datacube_ows.band_utils.norm_diff",
@@ -746,6 +754,7 @@ style_ndvi_delta = {
 
         # MatPlotLib rcparams options.
         # Defaults to {} (i.e. matplotlib defaults)
+        # Legends without rcParams are drawn by a faster native renderer rather than matplotlib.
         # See https://matplotlib.org/3.2.2/tutorials/introductory/customizing.html
         "rcParams": {
                  "lines.linewidth": 2,
@@ -780,6 +789,11 @@ style_ndvi_delta = {
             "aggregator_function": {
                 "function": "datacube_ows.band_utils.multi_date_delta"
             },
+            # Alternatively, a streaming aggregator may be declared instead of an aggregator function.
+            # Dates are then loaded and folded into the aggregate one at a time, so memory use does not
+            # grow with the number of dates.  Built-in streaming aggregators are "mean", "min", "max",
+            # "count" and "delta".
+            # "streaming_aggregator": "delta",
             # The multi-date color ramp.  May be defined as an explicit colour ramp, as shown above for the single
             # date case; or may be defined with a range and unscaled color ramp as shown here.
             #
@@ -815,6 +829,10 @@ style_deform = {
     # Only used if an explicit colour ramp is not defined.  Optional - defaults to a simple (but
     # kind of ugly) blue-to-red rainbow ramp.
     "mpl_ramp": "RdBu",
+    # If set, a lookup table of this many colours spanning the colour ramp is precomputed, and index values
+    # are rounded to the nearest lookup table entry rather than interpolated.  Faster, but ramps with sharp
+    # steps may need a large lookup table.  Optional - defaults to no lookup table.
+    "lut_size": 4096,
     # If true, the calculated index value for the pixel will be included in GetFeatureInfo responses.
     # Defaults to True.
     "include_in_feature_info": True,
@@ -1165,6 +1183,17 @@ standard_resource_limits = {
         # Defaults to 300.0
         "min_zoom_factor": 500.0,
 
+        # Overview zoom factor (optional)
+        #
+        # If set, requests zoomed out beyond min_zoom_factor but with a zoom factor of at least
+        # min_overview_zoom_factor render real data, averaged into a reduced resolution grid chosen from
+        # the zoom factor (read from overviews, where the source data has them) and resampled to the
+        # output size.
+        # Requests zoomed out beyond min_overview_zoom_factor render indicative polygons.
+        #
+        # Must be less than min_zoom_factor. Defaults to None (no reduced resolution rendering).
+        "min_overview_zoom_factor": 50.0,
+
         # Min zoom factor (above) works well for small-tiled requests, (e.g. 256x256 as sent by Terria).
         # However, for large-tiled requests (e.g. as sent by QGIS), large and intensive queries can still
         # go through to the datacube.
@@ -1181,6 +1210,11 @@ standard_resource_limits = {
         # extents for the product.
         # Defaults to zero, which is interpreted as no dataset limit.
         "max_datasets": 6,
+        # If true, datasets are first counted against the space-time materialised view, so that requests
+        # over max_datasets are rejected before the dataset search.  The count is approximate (the view may
+        # be stale, and pads single-timestamp eo3 datasets to a day) and costs an extra query per request.
+        # Defaults to False.
+        "precount_datasets": False,
     },
     "wcs": {
         # wcs::max_datasets is the WCS equivalent of wms::max_datasets.  The main requirement for setting this
@@ -1321,7 +1355,33 @@ ows_cfg = {
             # The authorities dictionary maps names to authority urls.
             "auth": "https://authoritative-authority.com",
             "idsrus": "https://www.identifiers-r-us.com",
-        }
+        },
+        # Rendered tile cache for WMTS GetTile and tile-aligned WMS GetMap requests.
+        # Optional - if not provided, tiles are not cached.
+        "tile_cache": {
+            # Max size of the in-memory LRU cache in each worker. Optional, defaults to 64MB
+            "memory_max_bytes": 64 * 1024 * 1024,
+            # Directory for the on-disk tier. Optional - if not provided, only the in-memory tier is used.
+            "disk_path": "/var/cache/ows_tiles",
+            # Max size of the on-disk tier. Optional, defaults to 1GB
+            "disk_max_bytes": 1024 * 1024 * 1024,
+            # How often each worker rescans the on-disk tier in the background, to account for tiles written by
+            # other workers. Optional, defaults to 600 seconds
+            "disk_rescan_seconds": 600,
+            # Render tiles in blocks of N x N tiles (metatiles), caching all tiles in the block.
+            # Optional, defaults to 1 (no metatiling)
+            "metatile": 4,
+        },
+        # Rendered legends are cached in each worker, after they are first requested.
+        # If true, the legends of all styles are rendered when each worker starts instead.
+        # Optional, defaults to False.
+        "pregenerate_legends": True,
+        # Legend images for styles with a legend url override are cached in each worker and
+        # refreshed in the background after this many seconds.  Optional, defaults to 600.
+        "legend_url_ttl": 3600,
+        # If true, legend url overrides are fetched when each worker starts, rather than when
+        # first requested.  Optional, defaults to False.
+        "prefetch_legend_urls": True,
     }, ####  End of "wms" section.
 
     # Config items in the "wcs" section apply to the WCS service to all WCS coverages
@@ -1485,6 +1545,61 @@ ows_cfg = {
                         # Default to False.
                         "manual_merge": False,
                     },
+                    # The resolution ladder is optional.
+                    # A list of coarser ODC products (e.g. summary or overview products) that are read in place of
+                    # the layer's own product for requests with a zoom factor below "max_zoom_factor".  The
+                    # coarsest suitable product (i.e. with the lowest max_zoom_factor greater than the zoom
+                    # factor of the request) is used.
+                    #
+                    # Ladder products must contain all the layer's bands.  For multi-product layers, use "products"
+                    # (a list of ODC product names matching the layer's product_names) instead of "product".
+                    #
+                    # Defaults to an empty list.
+                    "resolution_ladder": [
+                        {"max_zoom_factor": 100.0, "product": "ls8_nbart_albers_1km"},
+                        {"max_zoom_factor": 300.0, "product": "ls8_nbart_albers_250m"},
+                    ],
+                    # The dataset_search section is optional.
+                    "dataset_search": {
+                        # If true, the footprints of all datasets for the layer (including flag/pq products)
+                        # are held in an in-memory spatial index, and WMS/WMTS/WCS dataset searches are
+                        # answered from memory instead of querying the ODC index database.
+                        #
+                        # Defaults to False.
+                        "in_memory_catalogue": False,
+                        # How often (in seconds) to poll the ODC index database for datasets added or archived
+                        # since the in-memory catalogue was last updated.
+                        #
+                        # Defaults to 300 (5 minutes).
+                        "catalogue_sync_interval": 300,
+                        # If true, dataset searches (other than for GetFeatureInfo) only fetch the parts of the
+                        # dataset metadata documents needed to load data, which is faster for products
+                        # with large metadata documents.  Ignored if in_memory_catalogue is true.
+                        #
+                        # Defaults to False.
+                        "slim_search": False,
+                        # If true, all products and dates of a dataset search are searched with a single
+                        # database query, instead of one query per product per date.  Ignored if
+                        # in_memory_catalogue is true.
+                        #
+                        # Defaults to False.
+                        "batch_search": False,
+                    },
+                    # The low_zoom_mosaic section is optional.
+                    # If supplied, requests zoomed out beyond min_zoom_factor (or exceeding max_datasets) are
+                    # rendered from coarse resolution mosaics built offline by the datacube-ows-mosaic command,
+                    # where a mosaic exists for all requested dates.
+                    "low_zoom_mosaic": {
+                        # Directory where the mosaic COGs are stored. Required.
+                        "path": "/data/ows_mosaics",
+                        # CRS of the mosaic grid. Must be a published CRS. Required.
+                        "crs": "EPSG:3577",
+                        # Resolution of the mosaic grid in CRS units. Required.
+                        "resolution": [1000.0, 1000.0],
+                        # Bands to include in the mosaic.  Must include all bands needed by the layer's styles.
+                        # Defaults to all bands.
+                        "bands": ["red", "green", "blue", "nir", "swir1", "swir2"],
+                    },
                     # The image_processing section must be supplied.
                     "image_processing": {
                         # Extent mask function
@@ -1517,6 +1632,20 @@ ows_cfg = {
                         # Apply corrections for solar angle, for "Level 1" products.
                         # (Defaults to false - should not be used for NBAR/NBAR-T or other Analysis Ready products
                         "apply_solar_corrections": False,
+                        # The maximum number of datasets to read concurrently when datasets are read individually
+                        # (i.e. if manual_merge or apply_solar_corrections is True).
+                        # (Defaults to 1 - datasets are read one at a time.)
+                        "read_threads": 1,
+                        # If true, datasets that are read individually (i.e. if manual_merge or
+                        # apply_solar_corrections is True) are fused into preallocated arrays in the native
+                        # data type, using fuse_func if set, rather than being merged as floating point data.
+                        # (Defaults to false.)
+                        "native_mosaic": False,
+                        # If true, data is kept in its native data type through styling, with invalid and masked
+                        # pixels tracked in separate boolean masks rather than by converting the data to
+                        # floating point with NaNs.  Arithmetic is performed in 32 bit floating point.
+                        # (Defaults to false.)
+                        "preserve_dtype": False,
                     },
                     # If the WCS section is not supplied, then this named layer will NOT appear as a WCS
                     # coverage (but will still be a layer in WMS and WMTS).
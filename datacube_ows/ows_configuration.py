@@ -18,7 +18,9 @@ from slugify import slugify
 
 from datacube_ows.cube_pool import cube, get_cube, release_cube
 from datacube_ows.styles import StyleDef
-from datacube_ows.ogc_utils import ConfigException, FunctionWrapper
+from datacube_ows.ogc_utils import ConfigException, FunctionWrapper, json_digest
+from datacube_ows.tile_cache import TileCache
+from datacube_ows.dataset_catalogue import DatasetCatalogue
 
 import logging
 
@@ -216,6 +218,33 @@ class SuppURL(object):
         self.format = cfg["format"]
 
 
+class ResolutionRung(object):
+    # A coarser ODC product (or products) that can be read in place of the layer's own product(s)
+    # for requests with a zoom factor below max_zoom_factor.
+    def __init__(self, cfg, layer, dc):
+        self.max_zoom = cfg["max_zoom_factor"]
+        if layer.multi_product:
+            self.product_names = cfg["products"]
+            if len(self.product_names) != len(layer.product_names):
+                raise ConfigException("Resolution ladder products for layer %s must match the layer's products" % layer.name)
+        else:
+            self.product_names = [cfg["product"]]
+        self.product_name = self.product_names[0]
+        self.products = []
+        for prod_name in self.product_names:
+            if "__" in prod_name:
+                raise ConfigException("Product names cannot contain a double underscore '__'.")
+            product = dc.index.products.get_by_name(prod_name)
+            if not product:
+                raise ConfigException("Could not find product %s in datacube" % prod_name)
+            for band in layer.band_idx.native_bands.index:
+                if band not in product.measurements:
+                    raise ConfigException("Resolution ladder product %s for layer %s has no band %s" % (
+                        prod_name, layer.name, band))
+            self.products.append(product)
+        self.product = self.products[0]
+
+
 class OWSConfigEntry(object):
     def __init__(self, cfg):
         self._ingest_dict(cfg)
@@ -333,6 +362,15 @@ class OWSNamedLayer(OWSLayer):
             self.parse_flags(cfg.get("flags", {}), dc)
         except KeyError:
             raise ConfigException("Missing required config items in flags section for layer %s" % self.name)
+        try:
+            self.parse_resolution_ladder(cfg.get("resolution_ladder", []), dc)
+        except KeyError:
+            raise ConfigException("Missing required config items in resolution_ladder section for layer %s" % self.name)
+        self.parse_dataset_search(cfg.get("dataset_search", {}))
+        try:
+            self.parse_low_zoom_mosaic(cfg.get("low_zoom_mosaic"))
+        except KeyError:
+            raise ConfigException("Missing required config items in low_zoom_mosaic section for layer %s" % self.name)
         try:
             self.parse_image_processing(cfg["image_processing"])
         except KeyError:
@@ -376,8 +414,52 @@ class OWSNamedLayer(OWSLayer):
         wcs_cfg = cfg.get("wcs", {})
         self.zoom_fill = wms_cfg.get("zoomed_out_fill_colour", [150, 180, 200, 160])
         self.min_zoom = wms_cfg.get("min_zoom_factor", 300.0)
+        self.min_overview_zoom = wms_cfg.get("min_overview_zoom_factor")
+        if self.min_overview_zoom is not None and self.min_overview_zoom >= self.min_zoom:
+            raise ConfigException("min_overview_zoom_factor must be less than min_zoom_factor in layer %s" % self.name)
         self.max_datasets_wms = wms_cfg.get("max_datasets", 0)
         self.max_datasets_wcs = wcs_cfg.get("max_datasets", 0)
+        self.precount_datasets_wms = wms_cfg.get("precount_datasets", False)
+        self.precount_datasets_wcs = wcs_cfg.get("precount_datasets", False)
+
+    def parse_resolution_ladder(self, cfg, dc):
+        self.resolution_ladder = sorted(
+            [ResolutionRung(rung_cfg, self, dc) for rung_cfg in cfg],
+            key=lambda rung: rung.max_zoom
+        )
+
+    def ladder_rung(self, zf):
+        # The coarsest resolution ladder rung suitable for the zoom factor, or None to use the layer's own product(s).
+        for rung in self.resolution_ladder:
+            if zf < rung.max_zoom:
+                return rung
+        return None
+
+    @property
+    def ladder_product_names(self):
+        return [pname for rung in self.resolution_ladder for pname in rung.product_names]
+
+    def parse_dataset_search(self, cfg):
+        if cfg.get("in_memory_catalogue", False):
+            self.dataset_catalogue = DatasetCatalogue(self, cfg.get("catalogue_sync_interval", 300))
+        else:
+            self.dataset_catalogue = None
+        self.slim_search = cfg.get("slim_search", False)
+        self.batch_search = cfg.get("batch_search", False)
+
+    def parse_low_zoom_mosaic(self, cfg):
+        if not cfg:
+            self.low_zoom_mosaic = None
+            return
+        self.low_zoom_mosaic = {
+            "path": cfg["path"],
+            "crs": cfg["crs"],
+            "resolution": cfg["resolution"],
+            "bands": [self.band_idx.band(b) for b in cfg.get("bands", [])],
+        }
+        if self.low_zoom_mosaic["crs"] not in self.global_cfg.published_CRSs:
+            raise ConfigException("low_zoom_mosaic crs %s for layer %s is not a published CRS" % (
+                self.low_zoom_mosaic["crs"], self.name))
 
     def parse_image_processing(self, cfg):
         emf_cfg = cfg["extent_mask_func"]
@@ -389,6 +471,11 @@ class OWSNamedLayer(OWSLayer):
         self.always_fetch_bands = list([ self.band_idx.band(b) for b in raw_afb ])
         self.solar_correction = cfg.get("apply_solar_corrections", False)
         self.data_manual_merge = cfg.get("manual_merge", False)
+        self.native_mosaic = cfg.get("native_mosaic", False)
+        self.preserve_dtype = cfg.get("preserve_dtype", False)
+        self.read_threads = cfg.get("read_threads", 1)
+        if not isinstance(self.read_threads, int) or self.read_threads < 1:
+            raise ConfigException("read_threads must be a positive integer in layer %s" % self.name)
         if cfg.get("fuse_func"):
             self.fuse_func = FunctionWrapper(self, cfg["fuse_func"])
         else:
@@ -611,6 +698,7 @@ class OWSNamedLayer(OWSLayer):
         else:
             dc = get_cube()
         self.hide = False
+        old_ranges = getattr(self, "_ranges", None)
         self._ranges = None
         try:
             from datacube_ows.product_ranges import get_ranges
@@ -618,6 +706,8 @@ class OWSNamedLayer(OWSLayer):
             if self._ranges is None:
                 raise Exception("Null product range")
             self.bboxes = self.extract_bboxes()
+            if old_ranges is not None and old_ranges != self._ranges and self.global_cfg.tile_cache:
+                self.global_cfg.tile_cache.invalidate_layer(self.name)
         # pylint: disable=broad-except
         except Exception as a:
             _LOG.warning("get_ranges failed for layer %s: %s", self.name, str(a))
@@ -797,6 +887,7 @@ class OWSConfig(OWSConfigEntry):
         if not self.initialised or refresh:
             self.initialised = True
             cfg = read_config()
+            self.config_digest = json_digest(cfg)
             try:
                 self.parse_global(cfg["global"])
             except KeyError as e:
@@ -875,6 +966,12 @@ class OWSConfig(OWSConfigEntry):
         self.wms_max_height = cfg.get("max_height", 256)
         self.attribution = AttributionCfg.parse(cfg.get("attribution"))
         self.authorities = cfg.get("authorities", {})
+        self.tile_cache = TileCache.from_cfg(cfg.get("tile_cache"))
+        self.pregenerate_legends = cfg.get("pregenerate_legends", False)
+        self.legend_url_ttl = cfg.get("legend_url_ttl", 600)
+        if not isinstance(self.legend_url_ttl, (int, float)) or self.legend_url_ttl < 0:
+            raise ConfigException("legend_url_ttl must be a non-negative number of seconds")
+        self.prefetch_legend_urls = cfg.get("prefetch_legend_urls", False)
 
     def parse_wcs(self, cfg):
         if self.wcs:
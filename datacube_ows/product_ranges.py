@@ -325,6 +325,18 @@ def add_ranges(dc, product_names, summary=False, merge_only=False):
                 ows_product.name,
                 repr(ows_product.product_names)
             ))
+            # Resolution ladder products are read in place of the layer's products at low zoom,
+            # so need their own ranges kept up to date.
+            for dc_pname in ows_product.ladder_product_names:
+                if dc_pname in odc_products:
+                    odc_products[dc_pname]["ows"].append(ows_product)
+                else:
+                    odc_products[dc_pname] = { "ows": [ows_product]}
+            if ows_product.ladder_product_names:
+                print("OWS Layer %s has resolution ladder ODC Product(s): %s" % (
+                    ows_product.name,
+                    repr(ows_product.ladder_product_names)
+                ))
             if ows_product.multi_product:
                 ows_multiproducts.append(ows_product)
         if not ows_product:
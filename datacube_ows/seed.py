@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from datacube_ows import __version__
+from datacube_ows.ows_configuration import get_config
+from datacube_ows.wmts import wmts_args_to_wms, tile_key, tile_span, tileMatrixMinX, tileMatrixMaxY, \
+    CACHE_TILE_MATRIX_SET, _render_map, _render_metatile
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Web Mercator is only defined between these latitudes.
+MAX_LAT = 85.0511287798
+
+
+def lonlat_to_webmerc(lon, lat):
+    lat = max(min(lat, MAX_LAT), -MAX_LAT)
+    x = 6378137.0 * math.radians(lon)
+    y = 6378137.0 * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return x, y
+
+
+def tile_range(bbox, zoom):
+    # The (min_row, max_row, min_col, max_col) of the tiles at a zoom level intersecting a lon/lat bbox.
+    minx, miny = lonlat_to_webmerc(bbox[0], bbox[1])
+    maxx, maxy = lonlat_to_webmerc(bbox[2], bbox[3])
+    span = tile_span(zoom)
+    max_idx = 2 ** zoom - 1
+    min_col = max(int(math.floor((minx - tileMatrixMinX) / span)), 0)
+    max_col = min(int(math.floor((maxx - tileMatrixMinX) / span)), max_idx)
+    min_row = max(int(math.floor((tileMatrixMaxY - maxy) / span)), 0)
+    max_row = min(int(math.floor((tileMatrixMaxY - miny) / span)), max_idx)
+    return min_row, max_row, min_col, max_col
+
+
+def tile_count(bbox, zooms):
+    count = 0
+    for zoom in zooms:
+        min_row, max_row, min_col, max_col = tile_range(bbox, zoom)
+        count += (max_row - min_row + 1) * (max_col - min_col + 1)
+    return count
+
+
+def tile_tasks(layer, styles, times, bbox, zooms, metatile=1):
+    # Tiles are listed block by block (for blocks of metatile x metatile tiles), so that the tiles
+    # of a block are usually handled by the same worker, which renders the block once.
+    for zoom in zooms:
+        min_row, max_row, min_col, max_col = tile_range(bbox, zoom)
+        n = min(metatile, 2 ** zoom)
+        for time in times:
+            for style in styles:
+                for block_row in range(min_row - min_row % n, max_row + 1, n):
+                    for block_col in range(min_col - min_col % n, max_col + 1, n):
+                        for row in range(max(block_row, min_row), min(block_row + n, max_row + 1)):
+                            for col in range(max(block_col, min_col), min(block_col + n, max_col + 1)):
+                                yield layer, style, time, zoom, row, col
+
+
+def seed_tile(task):
+    # Render one tile exactly as a WMTS GetTile request would (as part of a metatile if the
+    # cache is configured for them), and write it to the tile cache.  Runs in a worker process.
+    #
+    # Tiles are cached under the same key as GetTile requests for the resolved style and date,
+    # so seeding the latest date also seeds requests that do not specify a date.
+    #
+    # Returns the number of tiles rendered: 0 if skipped or not cacheable, more than 1 for metatiles.
+    layer, style, time, zoom, row, col = task
+    args = {
+        "layer": layer,
+        "style": style,
+        "format": "image/png",
+        "time": time,
+        "tilematrixset": CACHE_TILE_MATRIX_SET,
+        "tilematrix": str(zoom),
+        "tilerow": str(row),
+        "tilecol": str(col),
+        "requestid": "seed",
+    }
+    cache = get_config().tile_cache
+    wms_args = wmts_args_to_wms(args)
+    key = tile_key(args, wms_args)
+    if cache.disk.contains(key):
+        # Already seeded (e.g. by an interrupted earlier run, or as part of a metatile)
+        return 0
+    if cache.metatile > 1:
+        tiles = _render_metatile(cache, key, wms_args)
+        if tiles is not None:
+            return len(tiles)
+    _, status, _ = _render_map(cache, key, wms_args)
+    return 1 if status == 200 else 0
+
+
+@click.command()
+@click.option("--style", "styles", multiple=True, help="Style to seed (may be repeated).  Defaults to the layer's default style.")
+@click.option("--time", "times", multiple=True, help="Date to seed, as YYYY-MM-DD (may be repeated).  Defaults to the layer's latest date.")
+@click.option("--min-zoom", default=0, help="Lowest WMTS zoom level (tile matrix) to seed (default 0)")
+@click.option("--max-zoom", default=10, help="Highest WMTS zoom level (tile matrix) to seed (default 10)")
+@click.option("--bbox", default=None, help="Longitude/latitude bounding box to seed: minlon,minlat,maxlon,maxlat.  Defaults to the layer's extent.")
+@click.option("--workers", default=4, help="Number of worker processes (default 4)")
+@click.option("--version", is_flag=True, default=False, help="Print version string and exit")
+@click.argument("layers", nargs=-1)
+def main(layers, styles, times, min_zoom, max_zoom, bbox, workers, version):
+    """Pre-render WMTS tiles for datacube-ows layers into the on-disk tile cache.
+
+    Seeds tiles of the specified LAYERS for each of the specified styles and dates
+    and for each zoom level from min-zoom to max-zoom.
+
+    Tiles that are already in the cache are skipped, so an interrupted run can be resumed
+    by re-running the same command.
+
+    Uses the DATACUBE_OWS_CFG environment variable to find the OWS config file.
+    """
+    if version:
+        print("Open Data Cube Open Web Services (datacube-ows) version",
+              __version__
+               )
+        return 0
+    cfg = get_config()
+    if not cfg.tile_cache or not getattr(cfg.tile_cache, "disk", None):
+        print("Seeding requires a tile cache with an on-disk tier (tile_cache.disk_path)")
+        return 1
+    if not layers:
+        print("No layers specified")
+        return 1
+    zooms = range(min_zoom, max_zoom + 1)
+    for name in layers:
+        lyr = cfg.product_index.get(name)
+        if lyr is None:
+            print("Unknown layer:", name)
+            return 1
+        lyr_styles = styles or [lyr.default_style.name]
+        lyr_times = times or [lyr.ranges["end_time"].strftime("%Y-%m-%d")]
+        if bbox:
+            lyr_bbox = [float(c) for c in bbox.split(",")]
+        else:
+            lyr_bbox = [lyr.ranges["lon"]["min"], lyr.ranges["lat"]["min"],
+                        lyr.ranges["lon"]["max"], lyr.ranges["lat"]["max"]]
+        n_tiles = tile_count(lyr_bbox, zooms) * len(lyr_styles) * len(lyr_times)
+        print("Seeding %d tiles for layer %s" % (n_tiles, name))
+        rendered = 0
+        # Worker processes are spawned rather than forked, so that they do not share the
+        # database connections already opened by this process.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for result in executor.map(seed_tile,
+                                       tile_tasks(name, lyr_styles, lyr_times, lyr_bbox, zooms,
+                                                  cfg.tile_cache.metatile),
+                                       chunksize=16):
+                rendered += result
+        print("Rendered %d tiles for layer %s" % (rendered, name))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
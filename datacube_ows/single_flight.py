@@ -0,0 +1,74 @@
+from __future__ import absolute_import, division, print_function
+
+from threading import Event, Lock
+
+from prometheus_client import Counter
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+COALESCED_REQUESTS = Counter("ows_coalesced_requests",
+                             "Requests served from an identical concurrent in-flight request",
+                             ["operation"])
+
+
+# Request arguments that identify the client or the request rather than what is rendered.
+VOLATILE_ARGS = {"requestid", "referer", "origin", "host", "url_root", "if_none_match"}
+
+
+def request_key(args):
+    # Normalised, hashable key for a request - identical renders have identical keys.
+    return tuple(sorted(
+        (k.lower(), v if v is None else str(v))
+        for k, v in args.items()
+        if k.lower() not in VOLATILE_ARGS
+    ))
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent calls.
+
+    While a call for a key is in flight, further calls with the same key wait for it to
+    complete and share its result (or exception) rather than repeating the work.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if not leader:
+            COALESCED_REQUESTS.labels(operation=self.operation).inc()
+            _LOG.debug("Coalescing %s request with in-flight request", self.operation)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def __len__(self):
+        return len(self._flights)
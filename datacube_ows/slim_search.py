@@ -0,0 +1,241 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+
+from sqlalchemy import and_, func, null, or_, select
+
+from datacube.index.fields import to_expressions
+from datacube.model import Dataset, Range
+from datacube.utils.documents import get_doc_offset_safe
+
+from datacube_ows.utils import get_index_sqlconn
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Stands in for Dataset.metadata - only the longitude range is needed (for solar day grouping).
+SlimMetadata = namedtuple("SlimMetadata", ["lon"])
+
+_NOT_CALCULATED = object()
+
+
+class SlimDataset(object):
+    """A compact, read-only stand-in for an ODC Dataset.
+
+    Holds only the fields needed to group and load a dataset (id, product,
+    locations, measurement paths, grid spatial definition, format, driver data
+    and time), so can be passed to group_datasets and load_data.
+    """
+    __slots__ = ("id", "type", "uris", "measurements", "format", "time", "metadata",
+                 "_gs", "_driver_data", "_extent")
+
+    def __init__(self, id_, product, uris, grid_spatial, measurements, fmt, driver_data, time, lon):
+        self.id = id_
+        self.type = product
+        self.uris = uris
+        self._gs = grid_spatial
+        self.measurements = measurements or {}
+        self.format = fmt
+        self._driver_data = driver_data
+        self.time = time
+        self.metadata = SlimMetadata(lon=lon)
+        self._extent = _NOT_CALCULATED
+
+    # Spatial properties are calculated from the grid spatial definition exactly as for a full Dataset.
+    crs = property(Dataset.crs.fget)
+    transform = property(Dataset.transform.fget)
+    bounds = property(Dataset.bounds.fget)
+
+    @property
+    def extent(self):
+        if self._extent is _NOT_CALCULATED:
+            self._extent = Dataset.extent.func(self)
+        return self._extent
+
+    @property
+    def center_time(self):
+        if self.time is None:
+            return None
+        return self.time.begin + (self.time.end - self.time.begin) // 2
+
+    @property
+    def metadata_doc(self):
+        # Only the driver data is held (for BandInfo).
+        if self._driver_data is None:
+            return {}
+        return {"driver_data": self._driver_data}
+
+    def __eq__(self, other):
+        if isinstance(other, (SlimDataset, Dataset)):
+            return self.id == other.id
+        return False
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "SlimDataset <id=%s product=%s>" % (self.id, self.type.name)
+
+
+# Fields selected for slim searches.
+SLIM_FIELDS = ("id", "uris", "grid_spatial", "measurements", "time", "lon")
+
+
+def slim_offsets(product):
+    # Metadata document offsets of the slim fields that are not search fields.
+    doc_offsets = product.metadata_type.definition["dataset"]
+    return {
+        "grid_spatial": doc_offsets["grid_spatial"],
+        "measurements": doc_offsets["measurements"],
+    }
+
+
+def product_format(product):
+    # The data format of a product's datasets, from the product's metadata (the fields datasets are
+    # matched to the product on), or None if not defined there.
+    offset = product.metadata_type.definition["dataset"].get("format", ["format", "name"])
+    return get_doc_offset_safe(offset, product.metadata_doc)
+
+
+def index_tables(metadata_type):
+    # The ODC dataset and dataset location tables, as referenced by the metadata type's search fields.
+    # (The index API cannot search several time ranges at once, so batched searches build their own query.)
+    dataset_fields = metadata_type.dataset_fields
+    return dataset_fields["id"].alchemy_column.table, dataset_fields["uri"].alchemy_column.table
+
+
+def search_query(products, search_terms, time_ranges, slim=True, limit=None):
+    # A single ODC index search across several products (which must share a metadata type)
+    # and any of several time ranges.
+    #
+    # If slim, only the columns and document fragments needed to build SlimDatasets are selected,
+    # otherwise the full metadata documents are selected.
+    metadata_type = products[0].metadata_type
+    dataset_fields = metadata_type.dataset_fields
+    doc_offsets = metadata_type.definition["dataset"]
+    dataset, location = index_tables(metadata_type)
+    conditions = [expr.alchemy_expression for expr in to_expressions(dataset_fields.get, **search_terms)]
+    conditions.append(or_(*[
+        expr.alchemy_expression
+        for time_range in time_ranges
+        for expr in to_expressions(dataset_fields.get, time=time_range)
+    ]))
+    uris = func.array(
+        select([
+            location.c.uri_scheme + ":" + location.c.uri_body
+        ]).where(
+            and_(
+                location.c.dataset_ref == dataset.c.id,
+                location.c.archived == None
+            )
+        ).order_by(
+            location.c.added.desc(),
+            location.c.id.desc()
+        ).label("uris")
+    ).label("uris")
+    if slim:
+        if "format" in doc_offsets:
+            fmt = dataset.c.metadata[tuple(doc_offsets["format"])].astext.label("format")
+        else:
+            fmt = null().label("format")
+        columns = [
+            dataset.c.id,
+            dataset.c.dataset_type_ref,
+            uris,
+            dataset.c.metadata[tuple(doc_offsets["grid_spatial"])].label("grid_spatial"),
+            dataset.c.metadata[tuple(doc_offsets["measurements"])].label("measurements"),
+            fmt,
+            dataset.c.metadata["driver_data"].label("driver_data"),
+            dataset_fields["time"].alchemy_expression.label("time"),
+            dataset_fields["lon"].alchemy_expression.label("lon"),
+        ]
+    else:
+        columns = [
+            dataset.c.id,
+            dataset.c.dataset_type_ref,
+            uris,
+            dataset.c.metadata,
+        ]
+    query = select(columns).where(
+        and_(
+            dataset.c.dataset_type_ref.in_([product.id for product in products]),
+            dataset.c.archived == None,
+            *conditions
+        )
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    # Fetch rows from a server-side cursor as they are consumed.
+    return query.execution_options(stream_results=True)
+
+
+def slim_dataset(product, row, fmt=None):
+    # A SlimDataset from a slim search result (a DatasetLight or a search_query row).
+    time = row.time
+    lon = row.lon
+    return SlimDataset(
+        row.id,
+        product,
+        list(row.uris or []),
+        row.grid_spatial,
+        row.measurements,
+        getattr(row, "format", None) or fmt,
+        getattr(row, "driver_data", None),
+        Range(time.lower, time.upper) if time is not None else None,
+        Range(float(lon.lower), float(lon.upper)) if lon is not None else None,
+    )
+
+
+def full_dataset(product, row):
+    return Dataset(product, row.metadata, uris=list(row.uris))
+
+
+def search_datasets(index, products, search_terms, time_ranges=None, slim=True, limit=None):
+    # Search the index for datasets of any of the products and overlapping any of the time ranges.
+    # Returns SlimDatasets if slim, otherwise full Datasets - at most limit of them, if a limit is given.
+    #
+    # search_terms are as for index.datasets.search, without the product (and without the time if
+    # time_ranges are given).  Without time_ranges, products are searched one at a time through the
+    # index API.  With time_ranges, products are searched with one query per metadata type (normally
+    # one query in all).
+    if time_ranges:
+        return _batched_search(index, products, search_terms, time_ranges, slim, limit)
+    datasets = []
+    for product in products:
+        if limit is not None and len(datasets) >= limit:
+            break
+        remaining = None if limit is None else limit - len(datasets)
+        query = dict(search_terms, product=product.name)
+        if slim:
+            fmt = product_format(product)
+            results = index.datasets.search_returning_datasets_light(SLIM_FIELDS,
+                                                                     custom_offsets=slim_offsets(product),
+                                                                     limit=remaining,
+                                                                     **query)
+            datasets.extend(slim_dataset(product, row, fmt) for row in results)
+        else:
+            datasets.extend(index.datasets.search(limit=remaining, **query))
+    return datasets
+
+
+def _batched_search(index, products, search_terms, time_ranges, slim, limit):
+    by_metadata_type = {}
+    for product in products:
+        by_metadata_type.setdefault(product.metadata_type.name, []).append(product)
+    datasets = []
+    conn = get_index_sqlconn(index)
+    try:
+        for mdt_products in by_metadata_type.values():
+            if limit is not None and len(datasets) >= limit:
+                break
+            products_by_id = {product.id: product for product in mdt_products}
+            remaining = None if limit is None else limit - len(datasets)
+            results = conn.execute(search_query(mdt_products, search_terms, time_ranges, slim, remaining))
+            for row in results:
+                product = products_by_id[row.dataset_type_ref]
+                datasets.append(slim_dataset(product, row) if slim else full_dataset(product, row))
+    finally:
+        conn.close()
+    return datasets
@@ -1,5 +1,6 @@
 from datacube.utils.masking import make_mask
 
+from datacube_ows.band_utils import STREAMING_AGGREGATORS
 from datacube_ows.ogc_utils import ConfigException, FunctionWrapper
 
 
@@ -13,6 +14,8 @@ class StyleDefBase(object):
         self.title = style_cfg["title"]
         self.abstract = style_cfg["abstract"]
         self.masks = [StyleMask(**mask_cfg) for mask_cfg in style_cfg.get("pq_masks", [])]
+        # Keep data in its native dtype and mask with boolean arrays rather than NaNs.
+        self.preserve_dtype = getattr(product, "preserve_dtype", False)
         self.needed_bands = set()
         for band in self.product.always_fetch_bands:
             self.needed_bands.add(band)
@@ -44,6 +47,33 @@ class StyleDefBase(object):
                     data[band] = data[band].where(mask_data)
         return data
 
+    def valid_mask(self, pq_data, extent_mask):
+        # Boolean mask of pixels that pass the extent mask and all the style's flag masks
+        # (or None if there are no masks) - for preserve_dtype mode.
+        valid = extent_mask
+        if pq_data is not None:
+            for mask in self.masks:
+                odc_mask = make_mask(pq_data, **mask.flags)
+                mask_data = getattr(odc_mask, self.product.pq_band)
+                if mask.invert:
+                    mask_data = ~mask_data
+                valid = mask_data if valid is None else valid & mask_data
+        return valid
+
+    @staticmethod
+    def float_data(data):
+        # Integer data as float32 for arithmetic (rather than the float64 numpy defaults to).
+        if data.dtype.kind == "f":
+            return data
+        return data.astype("float32")
+
+    @staticmethod
+    def mask_8bit(imgband_data, valid):
+        # Zero (i.e. make transparent) invalid pixels of 8 bit image data, in place.
+        if valid is not None:
+            imgband_data.values[~valid.values] = 0
+        return imgband_data
+
     def transform_data(self, data, pq_data, extent_mask, *masks):
         date_count = len(data.coords["time"])
         if date_count == 1:
@@ -89,8 +119,16 @@ class StyleDefBase(object):
             self.min_count, self.max_count = cfg["allowed_count_range"]
             if self.max_count < self.min_count:
                 raise ConfigException("multi_date handler allowed_count_range: minimum must be less than equal to maximum")
+            self.aggregator = None
+            self.streaming_aggregator = None
             if "aggregator_function" in cfg:
                 self.aggregator = FunctionWrapper(style.product, cfg["aggregator_function"])
+            elif "streaming_aggregator" in cfg:
+                agg_cfg = cfg["streaming_aggregator"]
+                if isinstance(agg_cfg, str) and agg_cfg in STREAMING_AGGREGATORS:
+                    self.streaming_aggregator = STREAMING_AGGREGATORS[agg_cfg]()
+                else:
+                    self.streaming_aggregator = FunctionWrapper(style.product, agg_cfg)()
             else:
                 raise ConfigException("Aggregator function is required for multi-date handlers.")
             self.parse_legend_cfg(cfg.get("legend", {}))
@@ -105,6 +143,24 @@ class StyleDefBase(object):
         def transform_data(self, data, pq_data, extent_mask, *masks):
             raise NotImplementedError()
 
+        @staticmethod
+        def date_slice(data, idx):
+            # The idx'th date of data, without the time dimension.  Data with only
+            # one date (e.g. time-independent PQ data) applies to every date.
+            if data is None:
+                return None
+            if len(data.coords["time"]) == 1:
+                return data.isel(time=0)
+            return data.isel(time=idx)
+
+        def fold(self, state, data, pq_data, extent_mask):
+            # Fold the data for a single date into the streaming aggregation state.
+            raise NotImplementedError()
+
+        def finalise(self, state):
+            # Render the streaming aggregation state as image data.
+            raise NotImplementedError()
+
         def parse_legend_cfg(self, cfg):
             self.show_legend = cfg.get("show_legend", self.auto_legend)
             self.legend_url_override = cfg.get('url', None)
@@ -5,9 +5,9 @@ import logging
 import numpy
 from colour import Color
 from datacube.utils.masking import make_mask
-from matplotlib import patches as mpatches, pyplot as plt
-from xarray import Dataset, DataArray, merge
+from xarray import Dataset, DataArray
 
+from datacube_ows.legend_render import MPL_LOCK, patch_legend, pyplot
 from datacube_ows.styles.base import StyleDefBase
 
 _LOG = logging.getLogger(__name__)
@@ -21,6 +21,8 @@ class ColorMapStyleDef(StyleDefBase):
         self.value_map = style_cfg["value_map"]
         for band in self.value_map.keys():
             self.needed_bands.add(self.product.band_idx.band(band))
+        # Compiled (rgba, matched) lookup tables - see lut_key.
+        self._luts = {}
 
     @staticmethod
     def reint(data):
@@ -58,11 +60,79 @@ class ColorMapStyleDef(StyleDefBase):
         return mask
 
 
+    # Integer data types small enough to compile a lookup table over every possible value.
+    MAX_LUT_ITEMSIZE = 2
+
+    def lookup(self, cfg_band, values):
+        # Apply the value map for a band to a 1D array of band values (with the band's attributes,
+        # as flag definitions are read from them).
+        #
+        # Returns an (4, n) array of 8 bit (red, green, blue, alpha) values and a boolean array
+        # of which values matched an entry in the value map. As for combine_first, the first
+        # matching entry wins.
+        rgba = numpy.zeros((4, len(values)), dtype="uint8")
+        matched = numpy.zeros(len(values), dtype="bool")
+        for value in self.value_map[cfg_band]:
+            mask = numpy.asarray(ColorMapStyleDef.create_mask(values, value["flags"]), dtype="bool")
+            if value.get("mask", False):
+                # pylint: disable=invalid-unary-operand-type
+                values = ColorMapStyleDef.reint(values.where(~mask))
+            else:
+                rgb = Color(value["color"])
+                color = numpy.array([rgb.red, rgb.green, rgb.blue, value.get("alpha", 1.0)]) * 255
+                new = mask & ~matched
+                rgba[:, new] = color.astype("uint8")[:, numpy.newaxis]
+                matched |= new
+        return rgba, matched
+
+    def lut_key(self, cfg_band, bdata):
+        # Lookup tables depend on the style, the band's value map, the data type and the flag
+        # definitions read from the data.
+        return (
+            self.product.name,
+            self.name,
+            cfg_band,
+            repr(self.value_map[cfg_band]),
+            bdata.dtype.str,
+            repr(bdata.attrs.get("flags_definition")),
+        )
+
+    def compiled_lut(self, cfg_band, bdata):
+        # The lookup table over every possible value of the band's (small integer or boolean) data type.
+        key = self.lut_key(cfg_band, bdata)
+        if key not in self._luts:
+            if bdata.dtype.kind == "b":
+                domain = numpy.array([False, True])
+            else:
+                info = numpy.iinfo(bdata.dtype)
+                domain = numpy.arange(info.min, info.max + 1, dtype=bdata.dtype)
+            self._luts[key] = self.lookup(cfg_band, DataArray(domain, dims=["value"], attrs=bdata.attrs))
+        return self._luts[key]
+
+    def transform_band(self, cfg_band, bdata):
+        # Style a band in one vectorised pass: the value map is evaluated once per distinct value, then
+        # gathered for every pixel.
+        vals = bdata.values.ravel()
+        if bdata.dtype.kind == "b" or (bdata.dtype.kind in "iu" and bdata.dtype.itemsize <= self.MAX_LUT_ITEMSIZE):
+            rgba, matched = self.compiled_lut(cfg_band, bdata)
+            idx = vals.astype(numpy.intp)
+            if bdata.dtype.kind != "b":
+                idx -= numpy.iinfo(bdata.dtype).min
+        else:
+            # Too many possible values for a complete lookup table - look up the values present.
+            uniq, idx = numpy.unique(vals, return_inverse=True)
+            rgba, matched = self.lookup(cfg_band, DataArray(uniq, dims=["value"], attrs=bdata.attrs))
+        return rgba[:, idx].reshape((4,) + bdata.shape), matched[idx].reshape(bdata.shape)
+
     def transform_single_date_data(self, data, pq_data, extent_mask, *masks):
         # pylint: disable=too-many-locals, too-many-branches
         # extent mask data per band to preseve nodata
         _LOG.debug("transform begin %s", datetime.now())
-        if extent_mask is not None:
+        valid = None
+        if self.preserve_dtype:
+            # Look up the bands in their native data type and make invalid pixels transparent afterwards.
+            valid = self.valid_mask(pq_data, extent_mask)
+        elif extent_mask is not None:
             for band in data.data_vars:
                 try:
                     data[band] = data[band].where(extent_mask, other=data[band].attrs['nodata'])
@@ -70,38 +140,35 @@ class ColorMapStyleDef(StyleDefBase):
                     data[band] = data[band].where(extent_mask)
 
         _LOG.debug("extent mask complete %s", str(datetime.now()))
-        data = self.apply_masks(data, pq_data)
+        if not self.preserve_dtype:
+            data = self.apply_masks(data, pq_data)
         _LOG.debug("mask complete %s", str(datetime.now()))
-        imgdata = Dataset()
-        for cfg_band, values in self.value_map.items():
-            # Run through each item
+        rgba = None
+        for cfg_band in self.value_map:
             band = self.product.band_idx.band(cfg_band)
-            band_data = Dataset()
             bdata = data[band]
             if bdata.dtype.kind == 'f':
                 # Convert back to int for bitmasking
                 bdata = ColorMapStyleDef.reint(bdata)
-            for value in values:
-                flags = value["flags"]
-                rgb = Color(value["color"])
-                alpha = value.get("alpha", 1.0)
-                mask_source_band = value.get("mask", False)
-
-                mask = ColorMapStyleDef.create_mask(bdata, flags)
-
-                if mask_source_band:
-                    # disable checking on the use of ~mask
-                    # pylint: disable=invalid-unary-operand-type
-                    bdata = bdata.where(~mask)
-                    bdata = ColorMapStyleDef.reint(bdata)
-                else:
-                    masked = ColorMapStyleDef.create_colordata(bdata, rgb, alpha, mask)
-                    band_data = masked if len(band_data.data_vars) == 0 else band_data.combine_first(masked)
-
-            imgdata = band_data if len(imgdata.data_vars) == 0 else merge([imgdata, band_data])
-
-        imgdata *= 255
-        return imgdata.astype('uint8')
+            band_rgba, band_matched = self.transform_band(cfg_band, bdata)
+            if rgba is None:
+                rgba, matched, dims, coords = band_rgba, band_matched, bdata.dims, bdata.coords
+            else:
+                # Earlier bands take precedence
+                new = band_matched & ~matched
+                rgba[:, new] = band_rgba[:, new]
+                matched |= new
+        if valid is not None:
+            rgba[:, ~numpy.asarray(valid, dtype="bool")] = 0
+        imgdata = Dataset(
+            {
+                color: (dims, rgba[i])
+                for i, color in enumerate(["red", "green", "blue", "alpha"])
+            },
+            coords=coords
+        )
+        _LOG.debug("transform complete %s", str(datetime.now()))
+        return imgdata
 
     def single_date_legend(self, bytesio):
         patches = []
@@ -111,18 +178,23 @@ class ColorMapStyleDef(StyleDefBase):
                 if "title" in value and "abstract" in value and "color" in value and value["title"]:
                     rgb = Color(value["color"])
                     label = fill(value["title"] + " - " + value["abstract"], 30)
-                    try:
-                        patch = mpatches.Patch(color=rgb.hex_l, label=label)
-                    # pylint: disable=broad-except
-                    except Exception as e:
-                        print("Error creating patch?", e)
-                    patches.append(patch)
+                    patches.append((rgb.hex_l, label))
         cfg = self.legend_cfg
-        plt.rcdefaults()
-        if cfg.get("rcParams", None) is not None:
+        if not cfg.get("rcParams"):
+            # Nothing matplotlib specific is configured, so use the native renderer.
+            patch_legend(bytesio, patches, cfg.get("width", 3), cfg.get("height", 1.25))
+            return
+        with MPL_LOCK:
+            plt = pyplot()
+            from matplotlib import patches as mpatches
+            plt.rcdefaults()
             plt.rcParams.update(cfg.get("rcParams"))
-        figure = plt.figure(figsize=(cfg.get("width", 3),
-                                     cfg.get("height", 1.25)))
-        plt.axis('off')
-        legend = plt.legend(handles=patches, loc='center', frameon=False)
-        plt.savefig(bytesio, format='png')
\ No newline at end of file
+            figure = plt.figure(figsize=(cfg.get("width", 3),
+                                         cfg.get("height", 1.25)))
+            try:
+                plt.axis('off')
+                plt.legend(handles=[mpatches.Patch(color=colour, label=label) for colour, label in patches],
+                           loc='center', frameon=False)
+                figure.savefig(bytesio, format='png')
+            finally:
+                plt.close(figure)
@@ -51,6 +51,11 @@ class ComponentStyleDef(StyleDefBase):
                 for band in self.rgb_components[imgband].keys():
                     self.needed_bands.add(band)
 
+        if style_cfg.get("numpy_kernel", False):
+            self.kernel = LinearComponentKernel(self)
+        else:
+            self.kernel = None
+
     def dealias_components(self, comp_in):
         if comp_in is None:
             return None
@@ -66,21 +71,28 @@ class ComponentStyleDef(StyleDefBase):
 
 
     def transform_single_date_data(self, data, pq_data, extent_mask, *masks):
-        if extent_mask is not None:
-            data = data.where(extent_mask)
-        data = self.apply_masks(data, pq_data)
+        if self.kernel is not None:
+            return self.kernel(data, self.valid_mask(pq_data, extent_mask))
+        if self.preserve_dtype:
+            valid = self.valid_mask(pq_data, extent_mask)
+        else:
+            valid = None
+            if extent_mask is not None:
+                data = data.where(extent_mask)
+            data = self.apply_masks(data, pq_data)
         imgdata = Dataset()
         for imgband, components in self.rgb_components.items():
             if callable(components):
                 imgband_data = components(data)
-                dims = imgband_data.dims
-                imgband_data = imgband_data.astype('uint8')
-                imgdata[imgband] = (dims, imgband_data)
+                imgband_data = self.mask_8bit(imgband_data.astype('uint8'), valid)
+                imgdata[imgband] = imgband_data
             else:
                 imgband_data = None
                 for band, intensity in components.items():
                     if callable(intensity):
                         imgband_component = intensity(data[band], band, imgband)
+                    elif self.preserve_dtype:
+                        imgband_component = self.float_data(data[band]) * intensity
                     else:
                         imgband_component = data[band] * intensity
 
@@ -93,6 +105,85 @@ class ComponentStyleDef(StyleDefBase):
                     imgband_data = DataArray(imgband_data, data.coords, data.dims.keys())
                 if imgband != "alpha":
                     imgband_data = self.compress_band(imgband, imgband_data)
-                imgdata[imgband] = (imgband_data.dims,
-                                    imgband_data.astype("uint8"))
-        return imgdata
\ No newline at end of file
+                imgdata[imgband] = self.mask_8bit(imgband_data.astype("uint8"), valid)
+        return imgdata
+
+class LinearComponentKernel(object):
+    """Renders a linear combination component style directly from numpy arrays.
+
+    The band weights are compiled once (when the style is parsed) into a (channel, band) matrix.
+    Each channel is accumulated, clipped and scaled in place in a single float buffer and written
+    straight into a preallocated (channel, y, x) uint8 image buffer, avoiding the intermediate
+    DataArrays of the xarray code path.
+    """
+    def __init__(self, style):
+        self.channels = [imgband for imgband in ["red", "green", "blue", "alpha"] if imgband in style.rgb_components]
+        self.bands = []
+        for imgband in self.channels:
+            components = style.rgb_components[imgband]
+            if callable(components) or any(callable(w) for w in components.values()):
+                raise ConfigException(
+                    "Style %s: numpy_kernel is only supported for linear combination components" % style.name)
+            for band in components:
+                if band not in self.bands:
+                    self.bands.append(band)
+        if not self.bands:
+            raise ConfigException("Style %s: numpy_kernel requires at least one band" % style.name)
+        self.weights = np.zeros((len(self.channels), len(self.bands)))
+        for i, imgband in enumerate(self.channels):
+            for band, weight in style.rgb_components[imgband].items():
+                self.weights[i, self.bands.index(band)] = weight
+        # Per channel: the non-zero (band index, weight) terms, and the scale range (None for alpha).
+        self.terms = [
+            [(j, w) for j, w in enumerate(row) if w != 0.0]
+            for row in self.weights
+        ]
+        self.scale = []
+        for imgband in self.channels:
+            if imgband == "alpha":
+                self.scale.append(None)
+                continue
+            sc_min = style.component_scale_ranges[imgband]["min"]
+            sc_max = style.component_scale_ranges[imgband]["max"]
+            if sc_min is None or sc_max is None:
+                raise ConfigException("Style %s: numpy_kernel requires a scale_range for channel %s" % (style.name, imgband))
+            self.scale.append((sc_min, sc_max))
+        self.float32 = style.preserve_dtype
+
+    def __call__(self, data, valid=None):
+        template = data[self.bands[0]]
+        arrays = [data[band].values for band in self.bands]
+        if self.float32:
+            acc_dtype = np.float32
+        else:
+            # As for xarray arithmetic: float32 data stays float32, integer data is promoted to float64.
+            acc_dtype = np.result_type(*arrays, 1.0)
+        invalid = None if valid is None else ~np.asarray(getattr(valid, "values", valid), dtype="bool")
+        img = np.empty((len(self.channels),) + template.shape, dtype="uint8")
+        acc = np.empty(template.shape, dtype=acc_dtype)
+        tmp = np.empty(template.shape, dtype=acc_dtype)
+        with np.errstate(invalid="ignore"):
+            for i, terms in enumerate(self.terms):
+                if terms:
+                    j, w = terms[0]
+                    np.multiply(arrays[j], w, out=acc, casting="unsafe")
+                    for j, w in terms[1:]:
+                        np.multiply(arrays[j], w, out=tmp, casting="unsafe")
+                        acc += tmp
+                else:
+                    acc.fill(0)
+                if self.scale[i] is not None:
+                    sc_min, sc_max = self.scale[i]
+                    np.clip(acc, sc_min, sc_max, out=acc)
+                    acc -= sc_min
+                    acc /= (sc_max - sc_min)
+                    acc *= 255
+                missing = np.isnan(acc)
+                if invalid is not None:
+                    missing |= invalid
+                acc[missing] = 0
+                np.copyto(img[i], acc, casting="unsafe")
+        return Dataset(
+            {imgband: (template.dims, img[i]) for i, imgband in enumerate(self.channels)},
+            coords=template.coords
+        )
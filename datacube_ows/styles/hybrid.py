@@ -12,12 +12,17 @@ class HybridStyleDef(ColorRampDef, ComponentStyleDef):
 
     def transform_single_date_data(self, data, pq_data, extent_mask, *masks):
         #pylint: disable=too-many-locals
-        if extent_mask is not None:
-            data = data.where(extent_mask)
-        data = self.apply_masks(data, pq_data)
+        if self.preserve_dtype:
+            valid = self.valid_mask(pq_data, extent_mask)
+            data = data.map(self.float_data, keep_attrs=True)
+        else:
+            valid = None
+            if extent_mask is not None:
+                data = data.where(extent_mask)
+            data = self.apply_masks(data, pq_data)
 
         if self.index_function is not None:
-            data['index_function'] = (data.dims, self.index_function(data))
+            data['index_function'] = self.index_function(data)
 
         imgdata = Dataset()
 
@@ -41,6 +46,6 @@ class HybridStyleDef(ColorRampDef, ComponentStyleDef):
                                  + self.component_ratio * component_band_data)
             else:
                 img_band_data = rampdata * 255.0
-            imgdata[band] = (d.dims, img_band_data.astype("uint8"))
+            imgdata[band] = self.mask_8bit(img_band_data.astype("uint8"), valid)
 
         return imgdata
\ No newline at end of file
@@ -3,15 +3,11 @@ from decimal import Decimal, ROUND_HALF_UP
 from math import isclose
 import logging
 
-import matplotlib
 import numpy
 from colour import Color
-from matplotlib import pyplot as plt
-from matplotlib.colors import to_hex, LinearSegmentedColormap
 from xarray import Dataset
 
-matplotlib.use('Agg')
-
+from datacube_ows.legend_render import MPL_LOCK, colour_bar, pyplot
 from datacube_ows.ogc_utils import ConfigException, FunctionWrapper
 from datacube_ows.styles.base import StyleDefBase
 _LOG = logging.getLogger(__name__)
@@ -85,8 +81,9 @@ def crack_ramp(ramp):
 
 
 def read_mpl_ramp(mpl_ramp : str):
+    from matplotlib.colors import to_hex
     unscaled_cmap = []
-    cmap = plt.get_cmap(mpl_ramp)
+    cmap = pyplot().get_cmap(mpl_ramp)
     val_range = numpy.arange(0.1, 1.1, 0.1)
     rgba_hex = to_hex(cmap(0.0))
     unscaled_cmap.append(
@@ -155,29 +152,14 @@ def colour_ramp_legend(bytesio, legend_cfg, colour_ramp, map_name,
 
     cdict, ticks = create_cdict_ticks(legend_cfg, colour_ramp)
 
-    plt.rcdefaults()
-    if colour_ramp.legend_mpl_rcparams:
-        plt.rcParams.update(colour_ramp.legend_mpl_rcparams)
-    fig = plt.figure(figsize=(colour_ramp.legend_width,
-                              colour_ramp.legend_height))
-    ax = fig.add_axes(colour_ramp.legend_strip_location)
-    custom_map = LinearSegmentedColormap(map_name, cdict)
-    color_bar = matplotlib.colorbar.ColorbarBase(
-        ax,
-        cmap=custom_map,
-        orientation="horizontal")
-
-    if ticks is not None:
-        color_bar.set_ticks(list(ticks.keys()))
-        color_bar.set_ticklabels(list(ticks.values()))
-
     title = colour_ramp.legend_title if colour_ramp.legend_title else default_title
     if colour_ramp.legend_units:
         title = title + "(" + colour_ramp.legend_units + ")"
 
-    color_bar.set_label(title)
-
-    plt.savefig(bytesio, format='png')
+    draw_colour_bar(bytesio, map_name, cdict, ticks, title,
+                    colour_ramp.legend_width, colour_ramp.legend_height,
+                    colour_ramp.legend_strip_location,
+                    colour_ramp.legend_mpl_rcparams)
 
 
 def legacy_colour_ramp_legend(bytesio, legend_cfg, colour_ramp, map_name,
@@ -260,33 +242,48 @@ def legacy_colour_ramp_legend(bytesio, legend_cfg, colour_ramp, map_name,
 
     cdict, ticks = create_cdict_ticks(legend_cfg, colour_ramp)
 
-    # TODO: Potentially short-circuit this if using string based mpl_ramp
-    # custom_map = plt.get_cmap(style_cfg["mpl_ramp"]) should return a LinearSegmentedColormap
-
-    plt.rcdefaults()
-    if legend_cfg.get("rcParams", None) is not None:
-        plt.rcParams.update(legend_cfg.get("rcParams"))
-    fig = plt.figure(figsize=(legend_cfg.get("width", 4),
-                              legend_cfg.get("height", 1.25)))
-    ax_pos = legend_cfg.get("axes_position", [0.05, 0.5, 0.9, 0.15])
-    ax = fig.add_axes(ax_pos)
-    custom_map = LinearSegmentedColormap(map_name, cdict)
-    color_bar = matplotlib.colorbar.ColorbarBase(
-        ax,
-        cmap=custom_map,
-        orientation="horizontal")
-
     if ticks is not None:
-        color_bar.set_ticks(list(ticks.keys()))
-        color_bar.set_ticklabels([str(l) for l in ticks.values()])
+        ticks = {pos: str(l) for pos, l in ticks.items()}
 
     title = legend_cfg.get("title", default_title)
     unit = legend_cfg.get("units", "unitless")
     title = title + "(" + unit + ")"
 
-    color_bar.set_label(title)
-
-    plt.savefig(bytesio, format='png')
+    draw_colour_bar(bytesio, map_name, cdict, ticks, title,
+                    legend_cfg.get("width", 4), legend_cfg.get("height", 1.25),
+                    legend_cfg.get("axes_position", [0.05, 0.5, 0.9, 0.15]),
+                    legend_cfg.get("rcParams"))
+
+
+def draw_colour_bar(bytesio, map_name, cdict, ticks, title, width, height, strip_location, rcparams=None):
+    if not rcparams:
+        # Nothing matplotlib specific is configured, so use the native renderer.
+        colour_bar(bytesio, cdict, ticks, title, width, height, strip_location)
+        return
+    with MPL_LOCK:
+        plt = pyplot()
+        from matplotlib.colorbar import ColorbarBase
+        from matplotlib.colors import LinearSegmentedColormap
+        plt.rcdefaults()
+        plt.rcParams.update(rcparams)
+        fig = plt.figure(figsize=(width, height))
+        try:
+            ax = fig.add_axes(strip_location)
+            custom_map = LinearSegmentedColormap(map_name, cdict)
+            color_bar = ColorbarBase(
+                ax,
+                cmap=custom_map,
+                orientation="horizontal")
+
+            if ticks is not None:
+                color_bar.set_ticks(list(ticks.keys()))
+                color_bar.set_ticklabels(list(ticks.values()))
+
+            color_bar.set_label(title)
+
+            fig.savefig(bytesio, format='png')
+        finally:
+            plt.close(fig)
 
 
 class ColorRamp:
@@ -302,6 +299,9 @@ class ColorRamp:
             raw_scaled_ramp = scale_unscaled_ramp(
                 rmin, rmax, unscaled_ramp)
         self.ramp = raw_scaled_ramp
+        self.lut_size = ramp_cfg.get("lut_size")
+        if self.lut_size is not None and (not isinstance(self.lut_size, int) or self.lut_size < 2):
+            raise ConfigException("lut_size must be an integer of at least 2 in style %s" % style.name)
         legend_cfg = ramp_cfg.get("legend", {})
         if legend_cfg.get("show_legend", True) and not legend_cfg.get("url"):
             self.parse_legend(legend_cfg)
@@ -365,6 +365,31 @@ class ColorRamp:
             "blue": b,
             "alpha": a
         }
+        if self.lut_size:
+            self.build_lut()
+
+    def build_lut(self):
+        # Precompute 8 bit (red, green, blue, alpha) values at lut_size evenly spaced index values
+        # spanning the ramp.  An extra final entry of zeros (transparent) is used for NaN.
+        self.lut_min = self.values[0]
+        self.lut_max = self.values[-1]
+        if self.lut_max > self.lut_min:
+            self.lut_scale = (self.lut_size - 1) / (self.lut_max - self.lut_min)
+        else:
+            self.lut_scale = 0.0
+        lut_values = numpy.linspace(self.lut_min, self.lut_max, self.lut_size)
+        self.lut = numpy.zeros((len(self.components), self.lut_size + 1), dtype="uint8")
+        for i, band in enumerate(self.components):
+            self.lut[i, :self.lut_size] = self.get_8bit_value(lut_values, band)
+
+    def lut_index(self, data):
+        # Quantise data to the nearest LUT entry (NaN to the transparent final entry).
+        scaled = numpy.subtract(data, self.lut_min, dtype=numpy.result_type(data.dtype, numpy.float32))
+        scaled *= self.lut_scale
+        numpy.clip(scaled, 0, self.lut_size - 1, out=scaled)
+        scaled[numpy.isnan(scaled)] = self.lut_size
+        scaled += 0.5
+        return scaled.astype(numpy.intp)
 
     def parse_legend(self, cfg):
         def rounder_str(prec):
@@ -495,6 +520,13 @@ class ColorRamp:
         return (val * 255).astype("uint8")
 
     def apply(self, data):
+        if self.lut_size:
+            # One gather for all four channels.
+            rgba = numpy.take(self.lut, self.lut_index(data.values), axis=1)
+            return Dataset({
+                band: (data.dims, rgba[i])
+                for i, band in enumerate(self.components)
+            })
         imgdata = {}
         for band in self.components:
             imgdata[band] = (data.dims, self.get_8bit_value(data, band))
@@ -537,11 +569,19 @@ class ColorRampDef(StyleDefBase):
             self.parse_multi_date(style_cfg)
 
     def apply_masks_and_index(self, data, pq_data, extent_mask, *masks):
+        if self.preserve_dtype:
+            # Mask the (float32) index rather than every input band.
+            valid = self.valid_mask(pq_data, extent_mask)
+            index_data = self.index_function(data.map(self.float_data, keep_attrs=True))
+            if valid is not None:
+                index_data = index_data.where(valid)
+            data['index_function'] = index_data
+            return data["index_function"]
         if extent_mask is not None:
             data = data.where(extent_mask)
         data = self.apply_masks(data, pq_data)
         index_data = self.index_function(data)
-        data['index_function'] = (index_data.dims, index_data)
+        data['index_function'] = index_data
         return data["index_function"]
 
     def transform_single_date_data(self, data, pq_data, extent_mask, *masks):
@@ -565,10 +605,25 @@ class ColorRampDef(StyleDefBase):
             self.color_ramp = ColorRamp(style, cfg)
 
         def transform_data(self, data, pq_data, extent_mask, *masks):
+            if self.streaming_aggregator is not None:
+                state = self.streaming_aggregator.init()
+                for i in range(len(data.coords["time"])):
+                    state = self.fold(state,
+                                      self.date_slice(data, i),
+                                      self.date_slice(pq_data, i),
+                                      self.date_slice(extent_mask, i))
+                return self.finalise(state)
             xformed_data = self.style.apply_masks_and_index(data, pq_data, extent_mask, *masks)
             agg = self.aggregator(xformed_data)
             return self.color_ramp.apply(agg)
 
+        def fold(self, state, data, pq_data, extent_mask):
+            index_data = self.style.apply_masks_and_index(data, pq_data, extent_mask)
+            return self.streaming_aggregator.update(state, index_data)
+
+        def finalise(self, state):
+            return self.color_ramp.apply(self.streaming_aggregator.finalise(state))
+
         def legend(self, bytesio):
             title = self.legend_cfg.get("title", self.range_str() + " Dates")
             name = self.style.product.name + f"_{self.min_count}"
@@ -0,0 +1,332 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import shutil
+from collections import OrderedDict, namedtuple
+from threading import Lock, Thread
+from time import sleep
+from uuid import uuid4
+
+from prometheus_client import Counter
+
+from datacube_ows.ogc_utils import ConfigException, get_function
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+# Rendered tiles are identified by the WMTS tile coordinates plus the layer/style/time
+# that selects what is rendered into the tile, and the version of the configuration.
+TileKey = namedtuple("TileKey", ["layer", "style", "time", "tile_matrix_set", "zoom", "row", "col", "config"])
+
+
+TILE_CACHE_HITS = Counter("ows_tile_cache_hits",
+                          "Rendered tile cache hits",
+                          ["tier"])
+TILE_CACHE_MISSES = Counter("ows_tile_cache_misses",
+                            "Rendered tile cache misses")
+
+
+def key_digest(key):
+    return hashlib.sha1(repr(tuple(key)).encode("utf-8")).hexdigest()
+
+
+class MemoryTileStore(object):
+    """Bounded in-memory LRU of rendered tiles (and their ETags), evicting by total size in bytes."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._etags = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def get_etag(self, key):
+        return self._etags.get(key)
+
+    def put(self, key, body, etag=None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = body
+            if etag is not None:
+                self._etags[key] = etag
+            else:
+                self._etags.pop(key, None)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._etags.pop(evicted_key, None)
+                self.size -= len(evicted)
+
+    def invalidate_layer(self, layer):
+        with self._lock:
+            for key in [k for k in self._entries if k.layer == layer]:
+                self.size -= len(self._entries.pop(key))
+                self._etags.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Tiles added and removed (individually or by directory) while the tile directory is being scanned.
+ScanChanges = namedtuple("ScanChanges", ["added", "dropped", "dropped_dirs"])
+
+
+class DiskTileStore(object):
+    """On-disk store of rendered tiles, evicting least recently used tiles by total size in bytes.
+
+    Tiles are stored one file per tile under a per-layer directory, so a whole layer can be
+    invalidated by removing its directory.  A tile's ETag (if any) is stored in a small sidecar
+    file next to the tile.
+
+    The size and LRU order of the tiles are tracked in memory as tiles are read and written, so
+    eviction never walks the cache directory.  Tiles written by other worker processes are picked
+    up by a background scan of the directory (at startup, then every rescan_seconds), which orders
+    tiles by modification time (updated on each read) and evicts any excess.
+    """
+    def __init__(self, path, max_bytes, rescan_seconds=600):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = Lock()
+        # Tile path -> size, least recently used first.
+        self._tiles = OrderedDict()
+        self.size = 0
+        # Changes made while a scan is in progress.
+        self._scan_changes = None
+        self.rescan_seconds = rescan_seconds
+        self._scanner = Thread(target=self._scan_loop, name="tile-cache-scan", daemon=True)
+        self._scanner.start()
+
+    def _layer_dir(self, layer):
+        return os.path.join(self.path, layer)
+
+    def _tile_path(self, key):
+        digest = key_digest(key)
+        return os.path.join(self._layer_dir(key.layer), digest[:2], digest + ".png")
+
+    @staticmethod
+    def _etag_path(tile_path):
+        return tile_path[:-len(".png")] + ".etag"
+
+    def _tile_files(self):
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith(".png"):
+                    yield os.path.join(root, f)
+
+    def _scan_loop(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:  # pylint: disable=broad-except
+                _LOG.warning("Tile cache scan of %s failed: %s", self.path, str(e))
+            if not self.rescan_seconds:
+                return
+            sleep(self.rescan_seconds)
+
+    def scan(self):
+        # Rebuild the tile index from the cache directory, then evict any excess.
+        # The directory is walked without holding the lock, so changes made by this process during
+        # the walk are recorded and applied to the result.
+        with self._lock:
+            self._scan_changes = ScanChanges(set(), set(), [])
+        tiles = []
+        for f in self._tile_files():
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            tiles.append((st.st_mtime, f, st.st_size))
+        tiles.sort()
+        with self._lock:
+            changes = self._scan_changes
+            self._scan_changes = None
+            dropped_dirs = tuple(changes.dropped_dirs)
+            scanned = OrderedDict(
+                (f, size) for _, f, size in tiles
+                if f not in changes.dropped and not f.startswith(dropped_dirs)
+            )
+            # Tiles this process has used keep their place at the recently used end.
+            for f, size in self._tiles.items():
+                if f in changes.added or f in scanned:
+                    scanned.pop(f, None)
+                    scanned[f] = size
+            self._tiles = scanned
+            self.size = sum(self._tiles.values())
+            doomed = self._evict()
+        self._remove(doomed)
+
+    def contains(self, key):
+        return os.path.exists(self._tile_path(key))
+
+    def get(self, key):
+        path = self._tile_path(key)
+        try:
+            with open(path, "rb") as fp:
+                body = fp.read()
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            if path in self._tiles:
+                self._tiles.move_to_end(path)
+        return body
+
+    def get_etag(self, key):
+        try:
+            with open(self._etag_path(self._tile_path(key)), "r") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write(path, content, mode):
+        # Write to a temporary file and rename, so concurrent readers never see a partial file.
+        tmp_path = "%s.%s.tmp" % (path, uuid4().hex)
+        with open(tmp_path, mode) as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
+
+    def put(self, key, body, etag=None):
+        path = self._tile_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        etag_path = self._etag_path(path)
+        if etag is not None:
+            self._write(etag_path, etag, "w")
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        self._write(path, body, "wb")
+        with self._lock:
+            # Replacing a tile only changes the size by the difference.
+            self.size -= self._tiles.pop(path, old_size)
+            self._tiles[path] = len(body)
+            self.size += len(body)
+            if self._scan_changes is not None:
+                self._scan_changes.added.add(path)
+            doomed = self._evict()
+        self._remove(doomed)
+
+    def _evict(self):
+        # Drop the least recently used tiles from the index until the store is comfortably under its
+        # size limit, returning their paths for removal outside the lock.  Called with the lock held.
+        doomed = []
+        if self.size > self.max_bytes:
+            target = self.max_bytes * 0.9
+            while self._tiles and self.size > target:
+                f, size = self._tiles.popitem(last=False)
+                self.size -= size
+                doomed.append(f)
+        if self._scan_changes is not None:
+            self._scan_changes.dropped.update(doomed)
+        return doomed
+
+    def _remove(self, paths):
+        for f in paths:
+            for doomed in (f, self._etag_path(f)):
+                try:
+                    os.remove(doomed)
+                except OSError:
+                    pass
+
+    def invalidate_layer(self, layer):
+        layer_dir = self._layer_dir(layer)
+        if not os.path.isdir(layer_dir):
+            return
+        # Rename first so that the layer is invalidated atomically before the (slow) removal.
+        doomed = "%s.%s.invalidated" % (layer_dir, uuid4().hex)
+        try:
+            os.rename(layer_dir, doomed)
+        except OSError:
+            return
+        with self._lock:
+            prefix = layer_dir + os.sep
+            for f in [f for f in self._tiles if f.startswith(prefix)]:
+                self.size -= self._tiles.pop(f)
+            if self._scan_changes is not None:
+                self._scan_changes.dropped_dirs.append(prefix)
+        shutil.rmtree(doomed, ignore_errors=True)
+
+
+class TileCache(object):
+    """Two-tier rendered tile cache: a bounded in-memory LRU in front of an optional on-disk store."""
+    def __init__(self, cfg):
+        self.memory = MemoryTileStore(cfg.get("memory_max_bytes", 64 * 1024 * 1024))
+        if cfg.get("disk_path"):
+            self.disk = DiskTileStore(cfg["disk_path"], cfg.get("disk_max_bytes", 1024 * 1024 * 1024),
+                                      cfg.get("disk_rescan_seconds", 600))
+        else:
+            self.disk = None
+        # Tiles are rendered in blocks of metatile x metatile tiles.
+        self.metatile = cfg.get("metatile", 1)
+        if not isinstance(self.metatile, int) or self.metatile < 1:
+            raise ConfigException("Tile cache metatile size must be a positive integer")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        body = self.memory.get(key)
+        if body is not None:
+            self._hit("memory")
+            return body
+        if self.disk:
+            body = self.disk.get(key)
+            if body is not None:
+                self._hit("disk")
+                self.memory.put(key, body, self.disk.get_etag(key))
+                return body
+        self.misses += 1
+        TILE_CACHE_MISSES.inc()
+        return None
+
+    def get_etag(self, key):
+        etag = self.memory.get_etag(key)
+        if etag is None and self.disk:
+            etag = self.disk.get_etag(key)
+        return etag
+
+    def _hit(self, tier):
+        self.hits += 1
+        TILE_CACHE_HITS.labels(tier=tier).inc()
+
+    def put(self, key, body, etag=None):
+        self.memory.put(key, body, etag)
+        if self.disk:
+            self.disk.put(key, body, etag)
+
+    def invalidate_layer(self, layer):
+        _LOG.info("Invalidating cached tiles for layer %s", layer)
+        self.memory.invalidate_layer(layer)
+        if self.disk:
+            self.disk.invalidate_layer(layer)
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        if not cfg:
+            return None
+        if "class" in cfg:
+            # Pluggable cache implementation - must support the get/put/invalidate_layer interface.
+            # Implementations that also support get_etag must accept an etag argument to put.
+            cache_class = get_function(cfg["class"])
+        else:
+            cache_class = cls
+        try:
+            return cache_class(cfg)
+        except OSError as e:
+            raise ConfigException("Could not initialise tile cache: %s" % str(e))
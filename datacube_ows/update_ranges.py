@@ -4,7 +4,7 @@ import re
 import os
 import pkg_resources
 from datacube_ows import __version__
-from datacube_ows.product_ranges import get_sqlconn, add_ranges
+from datacube_ows.product_ranges import get_sqlconn, add_ranges, get_ranges
 from datacube import Datacube
 import psycopg2
 from psycopg2.sql import SQL
@@ -113,10 +113,13 @@ def main(layers, blocking,
         return 0
 
     print("Deriving extents from materialised views")
+    cfg = get_config()
     if not layers:
-        layers = list(get_config().product_index.keys())
+        layers = list(cfg.product_index.keys())
     try:
+        old_ranges = snapshot_ranges(dc, cfg, layers)
         add_ranges(dc, layers, summary, merge_only)
+        invalidate_tile_cache(dc, cfg, old_ranges)
     except (psycopg2.errors.UndefinedColumn,
             sqlalchemy.exc.ProgrammingError):
         print("ERROR: OWS schema or extent materialised views appear to be missing",
@@ -127,6 +130,36 @@ def main(layers, blocking,
     return 0
 
 
+def affected_layers(cfg, layers):
+    # OWS layers whose ranges may be changed by updating the named OWS layers or ODC products.
+    affected = {}
+    for name in layers:
+        if name in cfg.product_index:
+            affected[name] = cfg.product_index[name]
+        else:
+            for lyr in cfg.product_index.values():
+                if name in lyr.product_names or name in lyr.ladder_product_names:
+                    affected[lyr.name] = lyr
+    return affected.values()
+
+
+def snapshot_ranges(dc, cfg, layers):
+    if not cfg.tile_cache:
+        return {}
+    return {
+        lyr.name: get_ranges(dc, lyr)
+        for lyr in affected_layers(cfg, layers)
+    }
+
+
+def invalidate_tile_cache(dc, cfg, old_ranges):
+    # Cached tiles for a layer are stale once its ranges change.
+    for name, ranges in old_ranges.items():
+        if get_ranges(dc, cfg.product_index[name]) != ranges:
+            print("Invalidating cached tiles for layer", name)
+            cfg.tile_cache.invalidate_layer(name)
+
+
 def create_views(dc):
     try:
         from datacube.config import LocalConfig
@@ -38,5 +38,9 @@ def group_by_statistical():
 
 
 def get_sqlconn(dc):
+    return get_index_sqlconn(dc.index)
+
+
+def get_index_sqlconn(index):
     # pylint: disable=protected-access
-    return dc.index._db._engine.connect()
\ No newline at end of file
+    return index._db._engine.connect()
\ No newline at end of file
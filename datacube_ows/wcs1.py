@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function
 
 from flask import render_template
 
+from datacube_ows.capabilities_cache import capabilities_response
 from datacube_ows.ogc_utils import get_service_base_url
 
 from datacube_ows.ogc_exceptions import WCS1Exception
@@ -31,7 +32,6 @@ def handle_wcs1(nocase_args):
 
 @log_call
 def get_capabilities(args):
-    # TODO: Handle updatesequence request parameter for cache consistency.
     section = args.get("section")
     if section:
         section = section.lower()
@@ -57,18 +57,17 @@ def get_capabilities(args):
     cfg = get_config()
     url = args.get('Host', args['url_root'])
     base_url = get_service_base_url(cfg.allowed_urls, url)
-    return (
-        render_template("wcs_capabilities.xml",
-                        show_service=show_service,
-                        show_capability=show_capability,
-                        show_content_metadata=show_content_metadata,
-                        cfg=cfg,
-                        base_url=base_url),
-        200,
-        cfg.response_headers({
-            "Content-Type": "application/xml",
-            "Cache-Control": "no-cache, max-age=0"
-        }))
+
+    def render(update_sequence):
+        return render_template("wcs_capabilities.xml",
+                               show_service=show_service,
+                               show_capability=show_capability,
+                               show_content_metadata=show_content_metadata,
+                               cfg=cfg,
+                               base_url=base_url,
+                               update_sequence=update_sequence)
+    section_key = (show_service, show_capability, show_content_metadata)
+    return capabilities_response(args, ("wcs", "1.0.0", section_key, base_url), render, WCS1Exception)
 
 
 @log_call
@@ -12,7 +12,7 @@ from rasterio import MemoryFile
 from ows.util import Version
 
 from datacube_ows.cube_pool import cube
-from datacube_ows.data import DataStacker, datasets_in_xarray
+from datacube_ows.data import DataStacker, datasets_in_xarray, too_many_datasets_message
 from datacube_ows.ogc_exceptions import WCS1Exception
 from datacube_ows.ogc_utils import ProductLayerException
 from datacube_ows.ows_configuration import get_config
@@ -279,7 +279,11 @@ def get_coverage_data(req):
                               req.geobox,
                               req.times,
                               bands=req.bands)
-        datasets = stacker.datasets(dc.index)
+        n_datasets = stacker.count_datasets_over(dc.index, req.product.max_datasets_wcs,
+                                                 req.product.precount_datasets_wcs)
+        if n_datasets is not None:
+            raise WCS1Exception(too_many_datasets_message(req.product.max_datasets_wcs, n_datasets))
+        datasets = stacker.datasets(dc.index, max_datasets=req.product.max_datasets_wcs)
         if not datasets:
             # TODO: Return an empty coverage file with full metadata?
             cfg = get_config()
@@ -326,9 +330,7 @@ def get_coverage_data(req):
 
         n_datasets = datasets_in_xarray(datasets)
         if req.product.max_datasets_wcs > 0 and n_datasets > req.product.max_datasets_wcs:
-            raise WCS1Exception("This request processes too much data to be served in a reasonable amount of time."
-                                "Please reduce the bounds of your request and try again."
-                                "(max: %d, this request requires: %d)" % (req.product.max_datasets_wcs, n_datasets))
+            raise WCS1Exception(too_many_datasets_message(req.product.max_datasets_wcs, n_datasets, at_least=True))
 
         stacker = DataStacker(req.product,
                               req.geobox,
@@ -17,6 +17,7 @@ from ows.wcs.v20.decoders import kvp_decode_describe_coverage, kvp_decode_get_co
 from ows.wcs.v20 import encoders as encoders_v20
 from ows.wcs.v21 import encoders as encoders_v21
 
+from datacube_ows.capabilities_cache import capabilities_response
 from datacube_ows.ogc_utils import resp_headers, get_service_base_url
 
 from datacube_ows.ogc_exceptions import WCS2Exception
@@ -79,74 +80,72 @@ def get_capabilities(args):
     if 'coveragesummary' in sections:
         include_coverage_summary = True
 
-    capabilities = ServiceCapabilities.with_defaults_v20(
-        service_url=base_url+'/wcs',
-        allowed_operations=[
-            'GetCapabilities', 'DescribeCoverage', 'GetCoverage'
-        ],
-        allow_post=False,
-        title=cfg.title,
-        abstract=cfg.abstract,
-        keywords=cfg.keywords,
-        fees=cfg.fees,
-        access_constraints=[cfg.access_constraints],
-        provider_name='',
-        provider_site='',
-        individual_name=cfg.contact_info['person'],
-        organisation_name=cfg.contact_info['organisation'],
-        position_name=cfg.contact_info['position'],
-        phone_voice=cfg.contact_info['telephone'],
-        phone_facsimile=cfg.contact_info['fax'],
-        delivery_point=cfg.contact_info['address']['address'],
-        city=cfg.contact_info['address']['city'],
-        administrative_area=cfg.contact_info['address']['state'],
-        postal_code=cfg.contact_info['address']['postcode'],
-        country=cfg.contact_info['address']['country'],
-        electronic_mail_address=cfg.contact_info['email'],
-        online_resource=base_url,
-        # hours_of_service=,
-        # contact_instructions=,
-        # role=,
-        coverage_summaries=[
-            CoverageSummary(
-                identifier=product.name,
-                coverage_subtype='RectifiedGridCoverage',
-                title=product.title,
-                wgs84_bbox=WGS84BoundingBox([
-                    product.ranges['lon']['min'], product.ranges['lat']['min'],
-                    product.ranges['lon']['max'], product.ranges['lat']['max'],
-                ])
-            )
-            for product in cfg.product_index.values()
-        ],
-        formats_supported=[
-            fmt.mime
-            for fmt in cfg.wcs_formats
-            if 2 in fmt.renderers
-        ],
-        crss_supported=[
-            crs  # TODO: conversion to URL format
-            for crs in cfg.published_CRSs
-        ],
-        interpolations_supported=None,  # TODO: find out interpolations
-    )
-    result = encoders_v20.xml_encode_capabilities(
-        capabilities,
-        include_service_identification=include_service_identification,
-        include_service_provider=include_service_provider,
-        include_operations_metadata=include_operations_metadata,
-        include_service_metadata=include_service_metadata,
-        include_coverage_summary=include_coverage_summary
-    )
-
-    return (
-        result.value,
-        200,
-        resp_headers({
-            "Content-Type": result.content_type,
-            "Cache-Control": "no-cache, max-age=0"
-        })
-    )
+    def render(update_sequence):
+        capabilities = ServiceCapabilities.with_defaults_v20(
+            service_url=base_url+'/wcs',
+            update_sequence=update_sequence,
+            allowed_operations=[
+                'GetCapabilities', 'DescribeCoverage', 'GetCoverage'
+            ],
+            allow_post=False,
+            title=cfg.title,
+            abstract=cfg.abstract,
+            keywords=cfg.keywords,
+            fees=cfg.fees,
+            access_constraints=[cfg.access_constraints],
+            provider_name='',
+            provider_site='',
+            individual_name=cfg.contact_info['person'],
+            organisation_name=cfg.contact_info['organisation'],
+            position_name=cfg.contact_info['position'],
+            phone_voice=cfg.contact_info['telephone'],
+            phone_facsimile=cfg.contact_info['fax'],
+            delivery_point=cfg.contact_info['address']['address'],
+            city=cfg.contact_info['address']['city'],
+            administrative_area=cfg.contact_info['address']['state'],
+            postal_code=cfg.contact_info['address']['postcode'],
+            country=cfg.contact_info['address']['country'],
+            electronic_mail_address=cfg.contact_info['email'],
+            online_resource=base_url,
+            # hours_of_service=,
+            # contact_instructions=,
+            # role=,
+            coverage_summaries=[
+                CoverageSummary(
+                    identifier=product.name,
+                    coverage_subtype='RectifiedGridCoverage',
+                    title=product.title,
+                    wgs84_bbox=WGS84BoundingBox([
+                        product.ranges['lon']['min'], product.ranges['lat']['min'],
+                        product.ranges['lon']['max'], product.ranges['lat']['max'],
+                    ])
+                )
+                for product in cfg.product_index.values()
+            ],
+            formats_supported=[
+                fmt.mime
+                for fmt in cfg.wcs_formats
+                if 2 in fmt.renderers
+            ],
+            crss_supported=[
+                crs  # TODO: conversion to URL format
+                for crs in cfg.published_CRSs
+            ],
+            interpolations_supported=None,  # TODO: find out interpolations
+        )
+        result = encoders_v20.xml_encode_capabilities(
+            capabilities,
+            include_service_identification=include_service_identification,
+            include_service_provider=include_service_provider,
+            include_operations_metadata=include_operations_metadata,
+            include_service_metadata=include_service_metadata,
+            include_coverage_summary=include_coverage_summary
+        )
+        return result.value, result.content_type
+    section_key = (include_service_identification, include_service_provider, include_operations_metadata,
+                   include_service_metadata, include_coverage_summary)
+    return capabilities_response(args, ("wcs", args.get("negotiated_version"), section_key, base_url), render,
+                                 WCS2Exception, content_type=None)
 
 
 def create_coverage_description(cfg, product):
@@ -18,7 +18,7 @@ from ows.wcs.v20 import (
 )
 
 from datacube_ows.cube_pool import get_cube, release_cube, cube
-from datacube_ows.data import DataStacker, datasets_in_xarray
+from datacube_ows.data import DataStacker, datasets_in_xarray, too_many_datasets_message
 from datacube_ows.ogc_exceptions import WCS2Exception
 from datacube_ows.ogc_utils import ProductLayerException
 from datacube_ows.ows_configuration import get_config
@@ -242,13 +242,14 @@ def get_coverage_data(request):
                               geobox,
                               times,
                               bands=bands)
-        datasets = stacker.datasets(dc.index)
+        n_datasets = stacker.count_datasets_over(dc.index, layer.max_datasets_wcs, layer.precount_datasets_wcs)
+        if n_datasets is not None:
+            raise WCS2Exception(too_many_datasets_message(layer.max_datasets_wcs, n_datasets))
+        datasets = stacker.datasets(dc.index, max_datasets=layer.max_datasets_wcs)
         n_datasets = datasets_in_xarray(datasets)
 
         if layer.max_datasets_wcs > 0 and n_datasets > layer.max_datasets_wcs:
-            raise WCS2Exception("This request processes too much data to be served in a reasonable amount of time."
-                                "Please reduce the bounds of your request and try again."
-                                "(max: %d, this request requires: %d)" % (layer.max_datasets_wcs, n_datasets))
+            raise WCS2Exception(too_many_datasets_message(layer.max_datasets_wcs, n_datasets, at_least=True))
         elif n_datasets == 0:
             raise WCS2Exception("The requested spatio-temporal subsets return no data.",
                                 WCS2Exception.INVALID_SUBSETTING,
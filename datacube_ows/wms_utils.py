@@ -17,6 +17,7 @@ try:
 except ImportError:
     from rasterio.warp import RESAMPLING as Resampling
 
+from rasterio.warp import reproject
 from affine import Affine
 from datacube.utils import geometry
 import math
@@ -121,6 +122,37 @@ def zoom_factor(args, crs):
     return 1.0 / math.sqrt(affine.determinant)
 
 
+def overview_decimation(zf, min_zoom):
+    # Power-of-two factor by which to coarsen the read resolution of a zoomed out request, so that
+    # the read resolution is close to that of a request at the minimum zoom factor.
+    if zf >= min_zoom:
+        return 1
+    return 2 ** int(math.floor(math.log2(min_zoom / zf)))
+
+
+def decimated_geobox(geobox, factor):
+    # A coarser geobox covering (at least) the same extent, with pixels factor times larger.
+    if factor == 1:
+        return geobox
+    return geometry.GeoBox(int(math.ceil(geobox.width / factor)),
+                           int(math.ceil(geobox.height / factor)),
+                           geobox.affine * Affine.scale(factor, factor),
+                           geobox.crs)
+
+
+def resample_image_band(arr, src_geobox, dst_geobox):
+    # Resample a rendered 8 bit image band from a decimated geobox to the output geobox
+    # (bilinear, so the result is smooth rather than blocky).
+    if src_geobox is dst_geobox:
+        return arr
+    out = numpy.zeros((dst_geobox.height, dst_geobox.width), dtype=arr.dtype)
+    reproject(arr, out,
+              src_transform=src_geobox.transform, src_crs=str(src_geobox.crs),
+              dst_transform=dst_geobox.transform, dst_crs=str(dst_geobox.crs),
+              resampling=Resampling.bilinear)
+    return out
+
+
 def img_coords_to_geopoint(geobox, i, j):
     cfg = get_config()
     h_coord = cfg.published_CRSs[str(geobox.crs)]["horizontal_coord"]
@@ -324,6 +356,8 @@ class GetLegendGraphicParameters():
 
 
 class GetMapParameters(GetParameters):
+    check_size_limits = True
+
     def method_specific_init(self, args):
         # Validate Format parameter
         self.format = get_arg(args, "format", "image format",
@@ -342,13 +376,14 @@ class GetMapParameters(GetParameters):
             raise WMSException("Style %s is not defined" % style_r,
                                WMSException.STYLE_NOT_DEFINED,
                                locator="Style parameter")
-        cfg = get_config()
-        if self.geobox.width > cfg.wms_max_width:
-            raise WMSException(f"Width {self.geobox.width} exceeds supported maximum {self.cfg.wms_max_width}.",
-                               locator="Width parameter")
-        if self.geobox.height > cfg.wms_max_height:
-            raise WMSException(f"Width {self.geobox.height} exceeds supported maximum {self.cfg.wms_max_height}.",
-                               locator="Height parameter")
+        if self.check_size_limits:
+            cfg = get_config()
+            if self.geobox.width > cfg.wms_max_width:
+                raise WMSException(f"Width {self.geobox.width} exceeds supported maximum {self.cfg.wms_max_width}.",
+                                   locator="Width parameter")
+            if self.geobox.height > cfg.wms_max_height:
+                raise WMSException(f"Width {self.geobox.height} exceeds supported maximum {self.cfg.wms_max_height}.",
+                                   locator="Height parameter")
 
         # Zoom factor
         self.zf = zoom_factor(args, self.crs)
@@ -357,6 +392,12 @@ class GetMapParameters(GetParameters):
         self.resampling = Resampling.nearest
 
 
+class MetatileParameters(GetMapParameters):
+    # Internally generated GetMap requests for a block of WMTS tiles, which may exceed the
+    # maximum width and height for client requests.
+    check_size_limits = False
+
+
 class GetFeatureInfoParameters(GetParameters):
     def get_product(self, args):
         return get_product_from_arg(args, "query_layers")
@@ -1,13 +1,20 @@
 from __future__ import absolute_import, division, print_function
 
+import hashlib
+from math import isclose
+
 from flask import render_template
 
-from datacube_ows.data import get_map, feature_info
-from datacube_ows.ogc_utils import get_service_base_url
+from datacube_ows.capabilities_cache import capabilities_response
+from datacube_ows.data import NotModified, get_map, feature_info, render_map, write_png
+from datacube_ows.ogc_utils import etag_matches, get_service_base_url
 
 from datacube_ows.ogc_exceptions import WMSException, WMTSException
+from datacube_ows.wms_utils import GetMapParameters, MetatileParameters
 
 from datacube_ows.ows_configuration import get_config
+from datacube_ows.single_flight import SingleFlight, request_key
+from datacube_ows.tile_cache import TileKey, key_digest
 
 from datacube_ows.utils import log_call
 
@@ -54,9 +61,19 @@ WebMercScaleSet = [
      34123.67334159654,
 ]
 
+# The two supported tile matrix sets are identical grids.
+SUPPORTED_TILE_MATRIX_SETS = ("urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible", "WholeWorld_WebMercator")
+CACHE_TILE_MATRIX_SET = "WholeWorld_WebMercator"
+
+tileMatrixMinX = -20037508.3427892
+tileMatrixMaxY = 20037508.3427892
+
+
+def tile_span(tile_matrix):
+    return WebMercScaleSet[tile_matrix] * 0.00028 * 256
+
 @log_call
 def get_capabilities(args):
-    # TODO: Handle updatesequence request parameter for cache consistency.
     # Note: Only WMS v1.0.0 exists at this stage, so no version negotiation is necessary
     # Extract layer metadata from Datacube.
     cfg = get_config()
@@ -99,8 +116,9 @@ def get_capabilities(args):
                 raise WMTSException("Invalid section: %s" % section,
                                 WMTSException.INVALID_PARAMETER_VALUE,
                                 locator="Section parameter")
-    return (
-        render_template(
+
+    def render(update_sequence):
+        return render_template(
             "wmts_capabilities.xml",
             cfg=cfg,
             base_url=base_url,
@@ -109,12 +127,11 @@ def get_capabilities(args):
             show_ops_metadata = show_ops_metadata,
             show_contents = show_contents,
             show_themes = show_themes,
-            webmerc_ss = WebMercScaleSet),
-        200,
-        cfg.response_headers(
-            {"Content-Type": "application/xml", "Cache-Control": "max-age=10"}
-        )
-    )
+            webmerc_ss = WebMercScaleSet,
+            update_sequence=update_sequence)
+    section_key = (show_service_id, show_service_provider, show_ops_metadata, show_contents, show_themes)
+    return capabilities_response(args, ("wmts", "1.0.0", section_key, base_url), render, WMTSException,
+                                 cache_control="max-age=10")
 
 @log_call
 def wmts_args_to_wms(args):
@@ -142,7 +159,7 @@ def wmts_args_to_wms(args):
         "requestid": args["requestid"]
     }
 
-    if tileMatrixSet not in ("urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible", "WholeWorld_WebMercator"):
+    if tileMatrixSet not in SUPPORTED_TILE_MATRIX_SETS:
         raise WMTSException("Invalid Tile Matrix Set: " + tileMatrixSet)
 
     try:
@@ -160,10 +177,7 @@ def wmts_args_to_wms(args):
     except ValueError:
         raise WMTSException("Invalid Tile Col: " + col)
 
-    tileMatrixMinX=-20037508.3427892
-    tileMatrixMaxY=20037508.3427892
-
-    tileSpan = WebMercScaleSet[tileMatrix] * 0.00028 * 256
+    tileSpan = tile_span(tileMatrix)
 
     leftX = col * tileSpan + tileMatrixMinX
     upperY = tileMatrixMaxY - row * tileSpan
@@ -182,12 +196,188 @@ def wmts_args_to_wms(args):
 
     return wms_args
 
+def resolved_tile_key(wms_args, zoom, row, col):
+    # Cache key for a tile, or None if there is no tile cache.
+    #
+    # The layer, style and dates are those the request resolves to, so requests that omit the
+    # style or date share the key of requests naming the defaults, and move on to a new key when
+    # the default date changes.  Resolving the request also validates it before the cache is used.
+    # Keys include the configuration version, so tiles cached on disk do not outlive the
+    # configuration they were rendered with.
+    cfg = get_config()
+    if cfg.tile_cache is None:
+        return None
+    params = GetMapParameters(wms_args)
+    return TileKey(
+        layer=params.product.name,
+        style=params.style.name,
+        time=",".join(str(t) for t in params.times),
+        tile_matrix_set=CACHE_TILE_MATRIX_SET,
+        zoom=zoom,
+        row=row,
+        col=col,
+        config=getattr(cfg, "config_digest", None)
+    )
+
+
+def tile_key(args, wms_args):
+    # Cache key for a WMTS GetTile request.
+    return resolved_tile_key(wms_args, int(args["tilematrix"]), int(args["tilerow"]), int(args["tilecol"]))
+
+
+def wms_args_to_tile_key(args):
+    # Returns the tile cache key for a WMS GetMap request that exactly matches a WMTS tile,
+    # or None if the request is not tile-aligned.
+    crs = args.get("crs", args.get("srs", ""))
+    if crs.upper() != "EPSG:3857":
+        return None
+    if args.get("format", "").lower() != "image/png":
+        return None
+    try:
+        if int(args.get("width", 0)) != 256 or int(args.get("height", 0)) != 256:
+            return None
+        minx, miny, maxx, maxy = map(float, args.get("bbox", "").split(","))
+    except ValueError:
+        return None
+    styles = args.get("styles", "")
+    layers = args.get("layers", "")
+    if "," in styles or "," in layers:
+        return None
+    span = maxx - minx
+    for zoom in range(len(WebMercScaleSet)):
+        tspan = tile_span(zoom)
+        if isclose(span, tspan, rel_tol=1e-6):
+            break
+    else:
+        return None
+    col = round((minx - tileMatrixMinX) / tspan)
+    row = round((tileMatrixMaxY - maxy) / tspan)
+    # Bbox corners must match the tile corners (allowing for %f formatting of the bbox).
+    tol = max(tspan * 1e-6, 1e-3)
+    if (not isclose(minx, col * tspan + tileMatrixMinX, abs_tol=tol)
+            or not isclose(maxy, tileMatrixMaxY - row * tspan, abs_tol=tol)
+            or not isclose(miny, tileMatrixMaxY - (row + 1) * tspan, abs_tol=tol)):
+        return None
+    return resolved_tile_key(args, zoom, row, col)
+
+
+# Identical concurrent GetMap/GetTile renders within a worker are coalesced into one.
+GETMAP_FLIGHTS = SingleFlight("getmap")
+
+
+def get_map_cached(key, wms_args):
+    # Serve a tile from the rendered tile cache, or render it with get_map and cache the result.
+    cfg = get_config()
+    cache = cfg.tile_cache
+    if cache is not None and key is not None:
+        body = cache.get(key)
+        if body is not None:
+            etag = cache.get_etag(key) if hasattr(cache, "get_etag") else None
+            return tile_response(body, etag, wms_args)
+        if getattr(cache, "metatile", 1) > 1:
+            n, mrow, mcol, _ = metatile_args(key, wms_args, cache.metatile)
+            # Requests for any tile in the block share the in-flight metatile render, unless they are
+            # conditional: a render that stops at a 304 for one tile has nothing for the others.
+            flight_key = ("metatile",) + tuple(key._replace(row=mrow, col=mcol)) + (n, wms_args.get("if_none_match"))
+            try:
+                tiles = GETMAP_FLIGHTS.do(flight_key, _render_metatile, cache, key, wms_args)
+            except NotModified as e:
+                return "", 304, cfg.response_headers({"ETag": e.etag})
+            if tiles is not None and key in tiles:
+                return tile_response(*tiles[key], wms_args)
+    # Renders are conditional on If-None-Match, so only requests with the same validator can share one.
+    flight_key = (request_key(wms_args), wms_args.get("if_none_match"))
+    body, status, headers = GETMAP_FLIGHTS.do(flight_key, _render_map, cache, key, wms_args)
+    return body, status, dict(headers)
+
+
+def tile_etag(meta_etag, key):
+    # ETag of a tile rendered as part of a metatile with the given ETag.
+    return '"%s"' % hashlib.sha1((meta_etag + key_digest(key)).encode("utf-8")).hexdigest()
+
+
+def content_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def tile_response(body, etag, wms_args):
+    # Response for an already rendered tile, or 304 Not Modified if the client has it already.
+    # Tiles cached without an ETag are tagged by content.
+    cfg = get_config()
+    if etag is None:
+        etag = content_etag(body)
+    if etag_matches(wms_args.get("if_none_match"), etag):
+        return "", 304, cfg.response_headers({"ETag": etag})
+    return body, 200, cfg.response_headers({"Content-Type": "image/png", "ETag": etag})
+
+
+def cache_put(cache, key, body, etag):
+    if hasattr(cache, "get_etag"):
+        cache.put(key, body, etag)
+    else:
+        cache.put(key, body)
+
+
+def metatile_args(key, wms_args, size):
+    # GetMap arguments for the block of (up to) size x size tiles containing the tile.
+    n = min(size, 2 ** key.zoom)
+    mrow = key.row - key.row % n
+    mcol = key.col - key.col % n
+    span = tile_span(key.zoom)
+    meta_args = dict(wms_args)
+    meta_args["width"] = str(256 * n)
+    meta_args["height"] = str(256 * n)
+    meta_args["bbox"] = "%f,%f,%f,%f" % (
+        mcol * span + tileMatrixMinX,
+        tileMatrixMaxY - (mrow + n) * span,
+        (mcol + n) * span + tileMatrixMinX,
+        tileMatrixMaxY - mrow * span
+    )
+    return n, mrow, mcol, meta_args
+
+
+def split_metatile(key, bands, n, mrow, mcol):
+    # Slice the rendered bands of a metatile into individual encoded tiles.
+    tiles = {}
+    for r in range(n):
+        for c in range(n):
+            tile_bands = [band[r * 256:(r + 1) * 256, c * 256:(c + 1) * 256] for band in bands]
+            tiles[key._replace(row=mrow + r, col=mcol + c)] = write_png(tile_bands)
+    return tiles
+
+
+def _render_metatile(cache, key, wms_args):
+    # Render the block of tiles containing the requested tile in one pass and cache all of them.
+    # Returns a dictionary of (body, etag) tuples by tile key, or None if the block cannot be
+    # rendered as a whole.  Tile ETags are derived from the ETag of the whole block.
+    n, mrow, mcol, meta_args = metatile_args(key, wms_args, cache.metatile)
+    # Raises NotModified before any data is read if the client already has the requested tile.
+    bands, meta_etag = render_map(MetatileParameters(meta_args), wms_args.get("requestid"), metatile=True,
+                                  if_none_match=wms_args.get("if_none_match"),
+                                  etag_for=lambda etag: tile_etag(etag, key))
+    if bands is None:
+        return None
+    tiles = {}
+    for tkey, body in split_metatile(key, bands, n, mrow, mcol).items():
+        etag = None if meta_etag is None else tile_etag(meta_etag, tkey)
+        cache_put(cache, tkey, body, etag)
+        tiles[tkey] = (body, etag)
+    return tiles
+
+
+def _render_map(cache, key, wms_args):
+    body, status, headers = get_map(wms_args)
+    if status == 200 and cache is not None and key is not None:
+        cache_put(cache, key, body, headers.get("ETag"))
+    return body, status, headers
+
+
 @log_call
 def get_tile(args):
     wms_args = wmts_args_to_wms(args)
 
     try:
-        return get_map(wms_args)
+        return get_map_cached(tile_key(args, wms_args), wms_args)
     except WMSException as wmse:
         first_error = wmse.errors[0]
         e = WMTSException(first_error["msg"],
@@ -10,7 +10,7 @@ with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
 requirements = [
-    'datacube',
+    'datacube>=1.8',
     'Flask',
     'flask_log_request_id',
     'requests',
@@ -20,7 +20,7 @@ requirements = [
     'lxml',
     'matplotlib',
     'numpy',
-    'Pillow',
+    'Pillow>=10.1',
     'prometheus_client',
     'psycopg2',
     'python_dateutil',
@@ -51,7 +51,9 @@ setup(
         'console_scripts': [
             'datacube-ows=datacube_ows.wsgi:main',
             'datacube-ows-update-old=datacube_ows.update_ranges_old:main',
-            'datacube-ows-update=datacube_ows.update_ranges:main'
+            'datacube-ows-update=datacube_ows.update_ranges:main',
+            'datacube-ows-mosaic=datacube_ows.low_zoom_mosaic:main',
+            'datacube-ows-seed=datacube_ows.seed:main'
         ]
     },
     packages=find_packages(),
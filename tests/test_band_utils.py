@@ -1,5 +1,7 @@
 """Test band math utilities
 """
+import warnings
+
 import pytest
 import numpy as np
 import xarray as xr
@@ -15,6 +17,7 @@ from datacube_ows.band_utils import (
     single_band_log,
     sentinel2_ndci,
     multi_date_delta,
+    STREAMING_AGGREGATORS,
 )
 from datacube_ows.ows_configuration import BandIndex, OWSProductLayer
 
@@ -94,3 +97,46 @@ def test_multidate():
 
 def test_ndci():
     assert not sentinel2_ndci(TEST_XARR, "b1", "b2", "b1", "b2") is None
+
+
+def test_norm_diff_values():
+    data = xr.Dataset({
+        "b1": (["x", "y"], np.array([[3000, 10], [0, 65535]], dtype=np.uint16)),
+        "b2": (["x", "y"], np.array([[1000, 30], [0, 1]], dtype=np.uint16)),
+    })
+    result = norm_diff(data, "b1", "b2")
+    b1 = data["b1"].values.astype("float64")
+    b2 = data["b2"].values.astype("float64")
+    with np.errstate(invalid="ignore"):
+        np.testing.assert_allclose(result.values, (b1 - b2) / (b1 + b2), rtol=1e-6)
+    # Input data is not modified
+    assert data["b1"].dtype == np.uint16
+
+
+def test_streaming_aggregators():
+    times = np.array(["2020-01-01", "2020-01-02", "2020-01-03"], dtype="datetime64[ns]")
+    vals = np.array([
+        [[1.0, np.nan], [3.0, np.nan]],
+        [[2.0, 5.0], [np.nan, np.nan]],
+        [[6.0, 1.0], [4.0, np.nan]],
+    ])
+    stack = xr.DataArray(vals, dims=["time", "y", "x"], coords={"time": times, "y": [1.0, 0.0], "x": [0.0, 1.0]})
+
+    def fold(name, data):
+        agg = STREAMING_AGGREGATORS[name]()
+        state = agg.init()
+        for i in range(len(data.time)):
+            state = agg.update(state, data.isel(time=i))
+        return agg.finalise(state)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        np.testing.assert_array_equal(fold("mean", stack).values, np.nanmean(vals, axis=0))
+        np.testing.assert_array_equal(fold("min", stack).values, np.nanmin(vals, axis=0))
+        np.testing.assert_array_equal(fold("max", stack).values, np.nanmax(vals, axis=0))
+    np.testing.assert_array_equal(fold("count", stack).values, [[3, 2], [2, 0]])
+    assert fold("mean", stack).dims == ("y", "x")
+
+    pair = stack.isel(time=[0, 2])
+    np.testing.assert_array_equal(fold("delta", pair).values, multi_date_delta(pair).values)
+
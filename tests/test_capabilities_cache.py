@@ -0,0 +1,101 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import datacube_ows.capabilities_cache
+from datacube_ows.capabilities_cache import capabilities_response, capabilities_version
+from datacube_ows.ogc_exceptions import WMSException
+
+
+def fake_layer(name, ranges):
+    layer = MagicMock()
+    layer.name = name
+    layer.ranges = ranges
+    layer.hide = False
+    return layer
+
+
+@pytest.fixture
+def cfg():
+    cfg = MagicMock()
+    cfg.config_digest = "abc123"
+    cfg.product_index = {
+        "layer_a": fake_layer("layer_a", {"times": ["2020-01-01"], "time_set": {"2020-01-01"}}),
+        "layer_b": fake_layer("layer_b", {"times": ["2020-01-01", "2020-01-02"]}),
+    }
+    cfg.response_headers.side_effect = lambda d: dict(d)
+    datacube_ows.capabilities_cache._CAPABILITIES_CACHE.clear()
+    datacube_ows.capabilities_cache._RANGES_DIGESTS.clear()
+    with patch("datacube_ows.capabilities_cache.get_config") as get_config:
+        get_config.return_value = cfg
+        yield cfg
+
+
+def test_capabilities_version(cfg):
+    version = capabilities_version(cfg)
+    assert version == capabilities_version(cfg)
+    cfg.product_index["layer_b"].ranges = {"times": ["2020-01-01", "2020-01-03"]}
+    assert capabilities_version(cfg) != version
+    new_version = capabilities_version(cfg)
+    cfg.product_index["layer_b"].hide = True
+    assert capabilities_version(cfg) != new_version
+    cfg.product_index["layer_b"].hide = False
+    cfg.config_digest = "def456"
+    assert capabilities_version(cfg) != new_version
+
+
+def test_capabilities_response(cfg):
+    render = MagicMock()
+    render.side_effect = lambda update_sequence: "<caps seq='%s'/>" % update_sequence
+    key = ("wms", "1.3.0", None, "http://localhost")
+
+    doc, status, headers = capabilities_response({}, key, render, WMSException)
+    version = capabilities_version(cfg)
+    assert status == 200
+    assert doc == "<caps seq='%s'/>" % version
+    assert headers["Content-Type"] == "application/xml"
+    etag = headers["ETag"]
+
+    # Served from the cache while the version is unchanged.
+    doc2, _, headers2 = capabilities_response({}, key, render, WMSException)
+    assert doc2 == doc
+    assert headers2["ETag"] == etag
+    render.assert_called_once()
+
+    # Conditional requests
+    body, status, headers = capabilities_response({"if_none_match": etag}, key, render, WMSException)
+    assert status == 304
+    assert body == ""
+    assert headers["ETag"] == etag
+    _, status, _ = capabilities_response({"if_none_match": '"stale"'}, key, render, WMSException)
+    assert status == 200
+
+    # updateSequence
+    with pytest.raises(WMSException) as e:
+        capabilities_response({"updatesequence": version}, key, render, WMSException)
+    assert e.value.errors[0]["code"] == WMSException.CURRENT_UPDATE_SEQUENCE
+    _, status, _ = capabilities_response({"updatesequence": "0"}, key, render, WMSException)
+    assert status == 200
+    render.assert_called_once()
+
+    # Other documents are rendered and tagged separately.
+    _, _, other_headers = capabilities_response({}, ("wms", "1.3.0", None, "http://other"), render, WMSException)
+    assert render.call_count == 2
+    assert other_headers["ETag"] != etag
+
+    # Range updates create a new version.
+    cfg.product_index["layer_a"].ranges = {"times": ["2020-01-05"]}
+    doc3, _, headers3 = capabilities_response({"if_none_match": etag}, key, render, WMSException)
+    assert render.call_count == 3
+    assert doc3 != doc
+    assert headers3["ETag"] != etag
+
+
+def test_capabilities_response_encoder_content_type(cfg):
+    render = MagicMock()
+    render.side_effect = lambda update_sequence: ("<caps/>", "text/xml")
+    key = ("wcs", "2.1.0", None, "http://localhost")
+    for _ in range(2):
+        doc, status, headers = capabilities_response({}, key, render, WMSException, content_type=None)
+        assert (doc, status, headers["Content-Type"]) == ("<caps/>", 200, "text/xml")
+    render.assert_called_once()
@@ -202,3 +202,400 @@ def test_make_band_dict_float(product_layer):
     assert band_dict["fake"] == ['Mask image as provided by JAXA - Ocean and water, lay over, shadowing, land.']
 
 
+def fake_stacker(read_threads):
+    product = MagicMock()
+    product.read_threads = read_threads
+    product.pq_band = None
+    product.solar_correction = False
+    product.extent_mask_func = [lambda data, band: data[band] != -1]
+    product.fuse_func = None
+    product.native_mosaic = False
+    stacker = datacube_ows.data.DataStacker.__new__(datacube_ows.data.DataStacker)
+    stacker._product = product
+    stacker._geobox = None
+    stacker._needed_bands = ["red"]
+    return stacker
+
+
+def fake_single_dataset_read(ds, measurements, geobox, **kwargs):
+    import xarray
+    arr = np.full((1, 4, 4), -1, dtype="int16")
+    arr[0, ds % 4, :] = ds
+    arr[0, :, ds % 4] = ds + 100
+    return xarray.Dataset({"red": (("time", "y", "x"), arr)})
+
+
+def test_map_datasets_preserves_order():
+    stacker = fake_stacker(4)
+    assert list(stacker.map_datasets(lambda x: x * 2, range(10))) == list(range(0, 20, 2))
+    stacker = fake_stacker(1)
+    assert list(stacker.map_datasets(lambda x: x * 2, iter(range(3)))) == [0, 2, 4]
+
+
+def test_map_datasets_interleaves_reads_and_merges():
+    import threading
+    events = []
+    lock = threading.Lock()
+
+    def read(ds):
+        with lock:
+            events.append(("read", ds))
+        return ds
+
+    stacker = fake_stacker(1)
+    for ds in stacker.map_datasets(read, range(3)):
+        events.append(("merge", ds))
+    assert events == [("read", 0), ("merge", 0), ("read", 1), ("merge", 1), ("read", 2), ("merge", 2)]
+
+    # With read threads, at most read_threads datasets are read ahead of the merge.
+    events = []
+    stacker = fake_stacker(2)
+    for ds in stacker.map_datasets(read, range(6)):
+        with lock:
+            n_reads = sum(1 for event in events if event[0] == "read")
+            events.append(("merge", ds))
+        assert n_reads <= ds + 2
+    assert [event for event in events if event[0] == "merge"] == [("merge", ds) for ds in range(6)]
+
+
+def test_load_resampling():
+    from datacube.model import Measurement
+    measurements = {
+        "red": Measurement(name="red", dtype="int16", nodata=-999, units="1"),
+        "fmask": Measurement(name="fmask", dtype="uint8", nodata=0, units="1",
+                             flags_definition={"cloud": {"bits": 0, "values": {"0": False, "1": True}}}),
+    }
+    stacker = fake_stacker(1)
+    stacker._reduced_resolution = False
+    assert stacker.load_resampling(measurements) is None
+    stacker._reduced_resolution = True
+    assert stacker.load_resampling(measurements) == {"red": "average", "fmask": "nearest"}
+
+
+def test_image_bands_reduced_resolution():
+    import xarray
+    from affine import Affine
+    from datacube.utils import geometry
+    geobox = geometry.GeoBox(8, 8, Affine(10.0, 0.0, 1000.0, 0.0, -10.0, 5000.0), geometry.CRS("EPSG:3857"))
+    read_geobox = datacube_ows.wms_utils.decimated_geobox(geobox, 4)
+    img = xarray.Dataset({"red": (("y", "x"), np.array([[0, 200], [0, 200]], dtype="uint8"))})
+    bands = datacube_ows.data._image_bands(img, geobox, read_geobox)
+    assert bands[0].shape == (8, 8)
+    assert 0 < bands[0][3, 4] < 200
+    bands = datacube_ows.data._image_bands(img, read_geobox)
+    assert bands[0] is img["red"].values
+
+
+def test_manual_data_stack_threaded_matches_serial():
+    import xarray
+    datasets = xarray.DataArray(
+        np.empty(2, dtype=object),
+        dims=["time"],
+        coords={"time": [np.datetime64("2020-01-01"), np.datetime64("2020-01-02")]}
+    )
+    datasets.values[0] = (1, 2, 3, 6)
+    datasets.values[1] = (5, 4, 7)
+    results = []
+    for threads in (1, 4):
+        stacker = fake_stacker(threads)
+        stacker.read_data_for_single_dataset = fake_single_dataset_read
+        results.append(stacker.manual_data_stack(datasets, None, False, False))
+    xarray.testing.assert_identical(results[0], results[1])
+
+
+def test_native_mosaic_matches_manual_merge():
+    import xarray
+    datasets = xarray.DataArray(
+        np.empty(2, dtype=object),
+        dims=["time"],
+        coords={"time": [np.datetime64("2020-01-01"), np.datetime64("2020-01-02")]}
+    )
+    datasets.values[0] = (1, 2, 3, 6)
+    datasets.values[1] = (5, 4, 7)
+    stacker = fake_stacker(1)
+    stacker.read_data_for_single_dataset = fake_single_dataset_read
+    merged = stacker.manual_data_stack(datasets, None, False, False)
+    stacker._product.native_mosaic = True
+    stacker._source = stacker._product
+    native = stacker.data(datasets, manual_merge=True)
+    assert native["red"].dtype == np.dtype("int16")
+    # Missing data is nodata rather than NaN
+    nodata = native["red"].attrs["nodata"]
+    np.testing.assert_array_equal(native["red"].where(native["red"] != nodata).values, merged["red"].values)
+
+
+def test_pq_executor():
+    # Only layers with a separate PQ product get a worker thread.
+    with datacube_ows.data._pq_executor(False) as executor:
+        assert executor is None
+    with datacube_ows.data._pq_executor(True) as executor:
+        assert executor.submit(lambda: "pq").result() == "pq"
+
+
+def test_render_map_pq_search():
+    import threading
+    params = MagicMock()
+    params.times = [datetime(2020, 1, 1)]
+    params.style.masks = [MagicMock()]
+    params.product.name = "a_layer"
+    params.product.pq_name = "a_pq_product"
+    params.product.min_zoom = 1.0
+    params.zf = 10.0
+    params.product.max_datasets_wms = 5
+    params.product.precount_datasets_wms = True
+    params.geobox.height = 2
+    params.geobox.width = 2
+    main_started = threading.Event()
+    pq_started = threading.Event()
+
+    def main_search(index, max_datasets=None):
+        main_started.set()
+        # The PQ search runs while the main search is still in progress.
+        assert pq_started.wait(5)
+        return None
+
+    def pq_search(stacker, product, request_id):
+        pq_started.set()
+        assert main_started.wait(5)
+        return None
+
+    with patch("datacube_ows.data.cube"), \
+            patch("datacube_ows.data.DataStacker") as stacker_cls, \
+            patch("datacube_ows.data._search_pq_datasets", side_effect=pq_search) as search_pq, \
+            patch("datacube_ows.data.map_etag", return_value='"etag"'):
+        stacker = stacker_cls.return_value
+        stacker.count_datasets_over.return_value = None
+        stacker.datasets.side_effect = main_search
+        bands, etag = datacube_ows.data.render_map(params, "req")
+        assert search_pq.call_count == 1
+        assert etag == '"etag"'
+
+        # Requests rejected by the dataset count pre-check never start the PQ search.
+        search_pq.reset_mock()
+        stacker.datasets.reset_mock()
+        stacker.count_datasets_over.return_value = 10
+        assert datacube_ows.data.render_map(params, "req", metatile=True) == (None, None)
+        search_pq.assert_not_called()
+        stacker.datasets.assert_not_called()
+
+
+def test_count_datasets():
+    from datacube.utils import geometry
+    from affine import Affine
+    from sqlalchemy.exc import OperationalError
+
+    product = MagicMock()
+    product.multi_product = False
+    product.product_name = "a_product"
+    product.dataset_catalogue = None
+    stacker = datacube_ows.data.DataStacker.__new__(datacube_ows.data.DataStacker)
+    stacker._product = product
+    stacker._source = product
+    stacker._geobox = geometry.GeoBox(10, 10, Affine(0.1, 0.0, 130.0, 0.0, -0.1, -20.0), geometry.CRS("EPSG:4326"))
+    stacker._times = [
+        (datetime(2020, 1, 1), datetime(2020, 1, 1, 23, 59, 59)),
+        (datetime(2020, 1, 3), datetime(2020, 1, 3, 23, 59, 59)),
+    ]
+    conn = MagicMock()
+    conn.execute.return_value = [(42,)]
+    with patch("datacube_ows.data.get_index_sqlconn") as get_conn:
+        get_conn.return_value = conn
+        assert stacker.count_datasets(MagicMock()) == 42
+        sql, params = conn.execute.call_args[0]
+        assert "COUNT(*)" in sql
+        assert "stv.spatial_extent &&" in sql
+        assert "%(start0)s" in sql and "%(end1)s" in sql
+        assert params["products"] == ["a_product"]
+        assert params["minx"] == pytest.approx(130.0)
+        assert params["miny"] == pytest.approx(-21.0)
+        assert conn.close.called
+
+        conn.execute.side_effect = OperationalError("SELECT", {}, Exception("no view"))
+        assert stacker.count_datasets(MagicMock()) is None
+
+        product.dataset_catalogue = MagicMock()
+        assert stacker.count_datasets(MagicMock()) is None
+
+
+def test_count_datasets_over():
+    stacker = datacube_ows.data.DataStacker.__new__(datacube_ows.data.DataStacker)
+    with patch.object(stacker, "count_datasets", return_value=10) as count:
+        assert stacker.count_datasets_over("index", 9) is None
+        assert stacker.count_datasets_over("index", 0, True) is None
+        count.assert_not_called()
+        assert stacker.count_datasets_over("index", 10, True) is None
+        assert stacker.count_datasets_over("index", 9, True) == 10
+        count.return_value = None
+        assert stacker.count_datasets_over("index", 9, True) is None
+
+
+def test_datasets_stops_at_max_datasets():
+    from types import SimpleNamespace
+    from datacube.utils import geometry
+    from affine import Affine
+
+    product = MagicMock()
+    product.multi_product = False
+    product.product_name = "a_product"
+    product.pq_ignore_time = False
+    product.dataset_catalogue = None
+    product.slim_search = False
+    product.batch_search = False
+    stacker = datacube_ows.data.DataStacker.__new__(datacube_ows.data.DataStacker)
+    stacker._product = product
+    stacker._source = product
+    stacker._geobox = geometry.GeoBox(10, 10, Affine(0.1, 0.0, 130.0, 0.0, -0.1, -20.0), geometry.CRS("EPSG:4326"))
+    stacker._times = [
+        (datetime(2020, 1, d), datetime(2020, 1, d, 23, 59, 59)) for d in (1, 3, 5)
+    ]
+    stacker.group_by = "time"
+
+    def fake_search(limit=None, **query):
+        day = query["time"].begin.day
+        found = [SimpleNamespace(id="%d_%d" % (day, i), center_time=datetime(2020, 1, day, 1, i)) for i in range(2)]
+        return iter(found[:limit])
+
+    index = MagicMock()
+    index.datasets.search.side_effect = fake_search
+    datasets = stacker.datasets(index)
+    assert datacube_ows.data.datasets_in_xarray(datasets) == 6
+    assert index.datasets.search.call_count == 3
+
+    index.datasets.search.reset_mock()
+    datasets = stacker.datasets(index, max_datasets=2)
+    # Stops once the limit is exceeded
+    assert datacube_ows.data.datasets_in_xarray(datasets) == 3
+    assert [c[1]["limit"] for c in index.datasets.search.call_args_list] == [3, 1]
+
+
+def test_render_streaming_loads_one_date_at_a_time(product_layer):
+    import xarray
+    from datacube_ows.styles import StyleDef
+    style = StyleDef(product_layer, {
+        "name": "test_style",
+        "title": "Test Style",
+        "abstract": "This is a Test Style for Datacube WMS",
+        "needed_bands": ["red"],
+        "index_function": {"expression": "red / 1000.0"},
+        "range": [0.0, 1.0],
+        "multi_date": [
+            {"allowed_count_range": [2, 5], "streaming_aggregator": "mean", "range": [0.0, 1.0]},
+        ],
+    })
+    times = [np.datetime64("2020-01-0%d" % d, "ns") for d in (1, 2, 3)]
+    full = xarray.Dataset(
+        {"red": (("time", "y", "x"), np.array([[[100, 900], [np.nan, 0]],
+                                              [[300, np.nan], [np.nan, 50]],
+                                              [[500, 200], [np.nan, 1000]]]))},
+        coords={"time": times, "y": [1.0, 0.0], "x": [0.0, 1.0]}
+    )
+    datasets = xarray.DataArray(np.empty(3, dtype=object), dims=["time"], coords={"time": times})
+
+    stacker = MagicMock()
+    stacker.data.side_effect = lambda dss, **kwargs: full.sel(time=dss.time.values)
+    params = MagicMock()
+    params.style = style
+    params.style.masks = []
+    params.product.data_manual_merge = True
+    params.product.native_mosaic = False
+    params.geobox.height = 2
+    params.geobox.width = 2
+    mdh = style.get_multi_date_handler(3)
+
+    bands = datacube_ows.data._render_streaming(stacker, datasets, params, mdh, "req", params.geobox)
+    assert stacker.data.call_count == 3
+    for call in stacker.data.call_args_list:
+        assert len(call[0][0].time) == 1
+    expected = mdh.color_ramp.apply(full["red"].mean(dim="time") / 1000.0)
+    for band, expected_band in zip(bands, ("red", "green", "blue", "alpha")):
+        np.testing.assert_array_equal(band, expected[expected_band].values)
+    assert bands[3][1, 0] == 0
+
+
+def test_render_streaming_loads_pq_one_date_at_a_time():
+    import xarray
+    times = [np.datetime64("2020-01-0%d" % d, "ns") for d in (1, 2, 3)]
+    datasets = xarray.DataArray(np.empty(3, dtype=object), dims=["time"], coords={"time": times})
+    pq_datasets = xarray.DataArray(np.empty(2, dtype=object), dims=["time"], coords={"time": times[0::2]})
+    loads = []
+
+    def load(dss, mask=False, **kwargs):
+        loads.append(("pq" if mask else "data", list(dss.time.values)))
+        return xarray.Dataset({"band": (("time",), np.zeros(len(dss.time)))}, coords={"time": dss.time.values})
+
+    stacker = MagicMock()
+    stacker.data.side_effect = load
+    params = MagicMock()
+    params.style.masks = [MagicMock()]
+    params.product.name = "a_layer"
+    params.product.pq_name = "a_pq_product"
+    params.product.data_manual_merge = True
+    params.product.native_mosaic = False
+    mdh = MagicMock()
+    with patch("datacube_ows.data.datasets_in_xarray", return_value=1), \
+            patch("datacube_ows.data._image_bands") as image_bands:
+        bands = datacube_ows.data._render_streaming(stacker, datasets, params, mdh, "req", params.geobox,
+                                                    pq_datasets)
+    assert bands == image_bands.return_value
+    # PQ data is loaded with each date of main data; dates without PQ data are not loaded at all.
+    assert loads == [
+        ("data", [times[0]]), ("pq", [times[0]]),
+        ("data", [times[2]]), ("pq", [times[2]]),
+    ]
+    assert mdh.fold.call_count == 2
+
+
+def test_map_etag():
+    import xarray
+    from affine import Affine
+    from datacube.utils.geometry import CRS, GeoBox
+
+    def ds(id_):
+        dataset = MagicMock()
+        dataset.id = id_
+        return dataset
+
+    def grouped(*ids_per_date):
+        arr = np.empty(len(ids_per_date), dtype=object)
+        for i, ids in enumerate(ids_per_date):
+            arr[i] = tuple(ds(id_) for id_ in ids)
+        return xarray.DataArray(arr, dims=["time"])
+
+    params = MagicMock()
+    params.product.name = "a_layer"
+    params.product.global_cfg.config_digest = "abc123"
+    params.style.name = "a_style"
+    params.times = [datetime(2020, 1, 1).date()]
+    params.geobox = GeoBox(256, 256, Affine(10.0, 0.0, 1000.0, 0.0, -10.0, 2000.0), CRS("EPSG:3857"))
+
+    etag = datacube_ows.data.map_etag(params, grouped(["b", "a"], ["c"]))
+    assert etag.startswith('"') and etag.endswith('"')
+    # Independent of dataset order
+    assert datacube_ows.data.map_etag(params, grouped(["c"], ["a", "b"])) == etag
+    assert datacube_ows.data.map_etag(params, grouped(["a", "b"], ["d"])) != etag
+    assert datacube_ows.data.map_etag(params, grouped(["a", "b"], ["c"]), grouped(["pq"])) != etag
+    assert datacube_ows.data.map_etag(params, None) != etag
+    params.style.name = "another_style"
+    assert datacube_ows.data.map_etag(params, grouped(["a", "b"], ["c"])) != etag
+    params.style.name = "a_style"
+    params.geobox = GeoBox(256, 256, Affine(10.0, 0.0, 3560.0, 0.0, -10.0, 2000.0), CRS("EPSG:3857"))
+    assert datacube_ows.data.map_etag(params, grouped(["a", "b"], ["c"])) != etag
+
+
+def test_get_map_conditional():
+    cfg = MagicMock()
+    cfg.response_headers.side_effect = lambda d: dict(d)
+    bands = [np.zeros((2, 2), dtype="uint8")] * 4
+    with patch("datacube_ows.data.GetMapParameters"), \
+            patch("datacube_ows.data.get_config", return_value=cfg), \
+            patch("datacube_ows.data.render_map") as render_map:
+        render_map.return_value = (bands, '"etag"')
+        body, status, headers = datacube_ows.data.get_map({"requestid": "req"})
+        assert status == 200
+        assert headers == {"Content-Type": "image/png", "ETag": '"etag"'}
+
+        render_map.side_effect = datacube_ows.data.NotModified('"etag"')
+        body, status, headers = datacube_ows.data.get_map({"requestid": "req", "if_none_match": '"etag"'})
+        assert (body, status) == ("", 304)
+        assert headers == {"ETag": '"etag"'}
+        assert render_map.call_args[1]["if_none_match"] == '"etag"'
@@ -0,0 +1,142 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from pytz import utc
+
+from datacube.model import Range
+from datacube.utils import geometry
+
+from datacube_ows.dataset_catalogue import DatasetCatalogue
+
+
+def make_ds(ds_id, product, left, bottom, right, top, time):
+    return SimpleNamespace(
+        id=ds_id,
+        type=SimpleNamespace(name=product),
+        extent=geometry.box(left, bottom, right, top, crs=geometry.CRS("EPSG:4326")),
+        center_time=time,
+        time=Range(time, time),
+        metadata=SimpleNamespace(lon=Range(left, right)),
+    )
+
+
+def make_catalogue(datasets):
+    layer = SimpleNamespace(name="a_layer", product_names=["prod_a", "prod_b"], pq_names=["prod_pq"],
+                            ladder_product_names=[])
+    index = MagicMock()
+    index.datasets.search.side_effect = lambda product: [ds for ds in datasets if ds.type.name == product]
+    conn = MagicMock()
+    conn.execute.return_value = [(datetime(2020, 6, 1, tzinfo=utc),)]
+    cat = DatasetCatalogue(layer)
+    with patch("datacube_ows.dataset_catalogue.get_index_sqlconn") as get_conn:
+        get_conn.return_value = conn
+        cat.build(index)
+    return cat, index
+
+
+def test_catalogue_search():
+    datasets = [
+        make_ds("a1", "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 1, 1, 0, tzinfo=utc)),
+        make_ds("a2", "prod_a", 140.0, -30.0, 141.0, -29.0, datetime(2020, 1, 1, 1, 0, tzinfo=utc)),
+        make_ds("a3", "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 5, 1, 0, tzinfo=utc)),
+        make_ds("b1", "prod_b", 130.5, -29.5, 131.5, -28.5, datetime(2020, 1, 1, 2, 0, tzinfo=utc)),
+        make_ds("pq1", "prod_pq", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 1, 1, 0, tzinfo=utc)),
+    ]
+    cat, index = make_catalogue(datasets)
+    assert cat.built
+    assert not cat.needs_sync()
+
+    query_poly = geometry.box(130.2, -29.8, 130.8, -29.2, crs=geometry.CRS("EPSG:4326"))
+    day = (datetime(2020, 1, 1, tzinfo=utc), datetime(2020, 1, 1, 23, 59, 59, tzinfo=utc))
+
+    found = cat.search(index, ["prod_a"], query_poly, day)
+    assert [ds.id for ds in found] == ["a1"]
+
+    found = cat.search(index, ["prod_a", "prod_b"], query_poly, day)
+    assert sorted(ds.id for ds in found) == ["a1", "b1"]
+
+    found = cat.search(index, ["prod_a"], query_poly)
+    assert sorted(ds.id for ds in found) == ["a1", "a3"]
+
+    found = cat.search(index, ["prod_pq"], query_poly, day)
+    assert [ds.id for ds in found] == ["pq1"]
+
+    far_away = geometry.box(100.0, 10.0, 101.0, 11.0, crs=geometry.CRS("EPSG:4326"))
+    assert cat.search(index, ["prod_a", "prod_b"], far_away, day) == []
+
+
+def test_catalogue_sync():
+    datasets = [
+        make_ds("a1", "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 1, 1, 0, tzinfo=utc)),
+        make_ds("a2", "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 1, 3, 0, tzinfo=utc)),
+    ]
+    cat, index = make_catalogue(datasets)
+    new_ds = make_ds("a3", "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, 1, 5, 0, tzinfo=utc))
+    index.datasets.bulk_get.return_value = [new_ds]
+    conn = MagicMock()
+    conn.execute.side_effect = [
+        [(datetime(2020, 6, 2, tzinfo=utc),)],
+        [("a2", True), ("a3", False)],
+    ]
+    with patch("datacube_ows.dataset_catalogue.get_index_sqlconn") as get_conn:
+        get_conn.return_value = conn
+        cat.sync(index)
+    index.datasets.bulk_get.assert_called_once_with(["a3"])
+
+    query_poly = geometry.box(130.2, -29.8, 130.8, -29.2, crs=geometry.CRS("EPSG:4326"))
+    day = (datetime(2020, 1, 1, tzinfo=utc), datetime(2020, 1, 1, 23, 59, 59, tzinfo=utc))
+    found = cat.search(index, ["prod_a"], query_poly, day)
+    assert [ds.id for ds in found] == ["a1", "a3"]
+
+
+def test_catalogue_search_limit_and_dates():
+    datasets = [
+        make_ds("a%d" % d, "prod_a", 130.0, -30.0, 131.0, -29.0, datetime(2020, 1, d, 1, 0, tzinfo=utc))
+        for d in range(1, 11)
+    ]
+    cat, index = make_catalogue(datasets)
+    query_poly = geometry.box(130.2, -29.8, 130.8, -29.2, crs=geometry.CRS("EPSG:4326"))
+    window = (datetime(2020, 1, 3, tzinfo=utc), datetime(2020, 1, 5, 23, 59, 59, tzinfo=utc))
+    assert [ds.id for ds in cat.search(index, ["prod_a"], query_poly, window)] == ["a3", "a4", "a5"]
+    assert [ds.id for ds in cat.search(index, ["prod_a"], query_poly, window, limit=2)] == ["a3", "a4"]
+    assert len(cat.search(index, ["prod_a"], query_poly, limit=4)) == 4
+    # Only the buckets for dates in the window (plus a day either side) are searched.
+    assert len(cat._search_buckets(["prod_a"], window[0].date(), window[1].date())) == 3
+
+
+def test_catalogue_syncs_once():
+    import threading
+    cat, index = make_catalogue([])
+    cat.sync_interval = 0
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_sync(idx):
+        calls.append(idx)
+        started.set()
+        release.wait(5)
+        cat._last_sync_monotonic = float("inf")
+
+    with patch.object(cat, "sync", side_effect=slow_sync):
+        first = threading.Thread(target=cat.sync_if_needed, args=(index,))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=cat.sync_if_needed, args=(index,))
+        second.start()
+        release.set()
+        first.join(5)
+        second.join(5)
+    assert len(calls) == 1
+
+
+def test_catalogue_layers():
+    from datacube_ows.dataset_catalogue import build_catalogues, catalogue_layers
+    with_cat = SimpleNamespace(dataset_catalogue=MagicMock())
+    without_cat = SimpleNamespace(dataset_catalogue=None)
+    cfg = SimpleNamespace(product_index={"a": with_cat, "b": without_cat})
+    assert catalogue_layers(cfg) == [with_cat]
+    build_catalogues(cfg, "index")
+    with_cat.dataset_catalogue.build.assert_called_once_with("index")
+    assert catalogue_layers(SimpleNamespace(product_index={"b": without_cat})) == []
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from datacube_ows.expression import compile_expression, evaluate, Expression
+from datacube_ows.ogc_utils import ConfigException, FunctionWrapper
+from datacube_ows.ows_configuration import BandIndex, OWSProductLayer
+
+
+@pytest.fixture
+def data():
+    coords = {"y": [1.0, 0.0], "x": [0.0, 1.0, 2.0]}
+    return xr.Dataset({
+        "nir": (("y", "x"), np.array([[3000, 2000, 0], [100, 4000, 5]], dtype="int16")),
+        "red": (("y", "x"), np.array([[1000, 2000, 0], [300, 1000, 5]], dtype="int16")),
+        "blue": (("y", "x"), np.array([[0.5, 0.25, np.nan], [1.0, 2.0, 4.0]], dtype="float64")),
+    }, coords=coords)
+
+
+def test_plan_reuses_buffers():
+    plan = compile_expression("(nir - red) / (nir + red) * 2 + 1")
+    assert plan.names == ["nir", "red"]
+    assert len(plan.ops) == 5
+    # Only two full size temporaries are needed.
+    assert plan.n_buffers == 2
+    # Constant sub-expressions are folded
+    assert len(compile_expression("nir * (2 ** 3 - 1)").ops) == 1
+    assert compile_expression("nir + red") is compile_expression("nir + red")
+
+
+def test_evaluate(data):
+    result = evaluate(data, "(nir - red) / (nir + red)")
+    assert isinstance(result, xr.DataArray)
+    assert result.dims == ("y", "x")
+    # int16 data is evaluated in float32, so cannot overflow.
+    assert result.dtype == np.dtype("float32")
+    nir = data["nir"].values.astype("float64")
+    red = data["red"].values.astype("float64")
+    with np.errstate(invalid="ignore"):
+        np.testing.assert_allclose(result.values, (nir - red) / (nir + red), rtol=1e-6)
+
+    result = evaluate(data, "sqrt(b) * -k + abs(b1 - 2)", b="blue", b1="blue", k=3)
+    assert result.dtype == np.dtype("float64")
+    blue = data["blue"].values
+    np.testing.assert_array_equal(result.values, np.sqrt(blue) * -3 + np.abs(blue - 2))
+
+    np.testing.assert_array_equal(evaluate(data, "red").values, data["red"].values)
+
+
+@pytest.mark.parametrize("expr", ["nir +", "nir > red", "nir.values", "max(nir, red)", "'a' + nir", "3 + 4"])
+def test_invalid_expressions(data, expr):
+    with pytest.raises(ValueError):
+        evaluate(data, expr)
+
+
+def test_expression_function_wrapper(data):
+    product_layer = OWSProductLayer.__new__(OWSProductLayer)
+    product_layer.name = "test_product"
+    product_layer.band_idx = BandIndex.__new__(BandIndex)
+    product_layer.band_idx.product = product_layer
+    product_layer.band_idx._idx = {"nir": "nir", "near_infrared": "nir", "red": "red"}
+
+    func = FunctionWrapper(product_layer, {"expression": "(near_infrared - red) / (near_infrared + red)"})
+    assert isinstance(func._func, Expression)
+    assert func._func.bands == ["nir", "red"]
+    expected = evaluate(data, "(nir - red) / (nir + red)")
+    np.testing.assert_array_equal(func(data).values, expected.values)
+
+    with pytest.raises(ConfigException):
+        FunctionWrapper(product_layer, {"expression": "(nir - red"})
+    with pytest.raises(ConfigException):
+        FunctionWrapper(product_layer, {"expression": "green * 2"})
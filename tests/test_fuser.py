@@ -0,0 +1,65 @@
+import numpy as np
+import xarray
+
+from datacube_ows.fuser import Mosaic, nodata_mask
+
+
+def band_data(values, nodata=-999):
+    arr = np.array(values, dtype="int16")
+    return xarray.Dataset(
+        {"red": (("y", "x"), arr, {"nodata": nodata})},
+        coords={"y": [1.0, 0.0], "x": [0.0, 1.0]}
+    )
+
+
+def test_nodata_mask():
+    assert nodata_mask(np.array([1, -999]), -999).tolist() == [False, True]
+    assert nodata_mask(np.array([1.0, np.nan, -999.0]), -999).tolist() == [False, True, True]
+    assert nodata_mask(np.array([1.0, np.nan]), None).tolist() == [False, True]
+
+
+def test_mosaic_first_valid_wins():
+    mosaic = Mosaic(2)
+    mosaic.add(0, band_data([[1, -999], [-999, -999]]))
+    mosaic.add(0, band_data([[2, 2], [-999, 2]]), valid=np.array([[True, True], [True, False]]))
+    mosaic.add(1, band_data([[3, 3], [3, 3]]))
+    result = mosaic.result(xarray.DataArray([np.datetime64("2020-01-01"), np.datetime64("2020-01-02")], dims="time"))
+    assert result["red"].dtype == np.dtype("int16")
+    assert result["red"].attrs["nodata"] == -999
+    assert result["red"].values[0].tolist() == [[1, 2], [-999, -999]]
+    assert result["red"].values[1].tolist() == [[3, 3], [3, 3]]
+    assert result["red"].dims == ("time", "y", "x")
+
+
+def test_mosaic_fuse_func():
+    def max_fuser(dest, src):
+        np.maximum(dest, src, out=dest)
+
+    mosaic = Mosaic(1, fuse_func=max_fuser)
+    mosaic.add(0, band_data([[1, 5], [-999, 2]]))
+    mosaic.add(0, band_data([[4, 3], [-999, 9]]), valid=np.array([[True, True], [True, False]]))
+    result = mosaic.result(xarray.DataArray([np.datetime64("2020-01-01")], dims="time"))
+    assert result["red"].values[0].tolist() == [[4, 5], [-999, 2]]
+
+
+def test_mosaic_fuse_func_first_dataset():
+    calls = []
+
+    def min_fuser(dest, src):
+        calls.append(dest.copy())
+        np.minimum(dest, src, out=dest)
+
+    mosaic = Mosaic(2, fuse_func=min_fuser)
+    mosaic.add(0, band_data([[1, 5], [7, 2]]))
+    mosaic.add(1, band_data([[3, 3], [3, 3]]))
+    assert calls == []
+    mosaic.add(0, band_data([[4, 3], [8, 9]]))
+    assert len(calls) == 1
+    assert calls[0].tolist() == [[1, 5], [7, 2]]
+    result = mosaic.result(xarray.DataArray([np.datetime64("2020-01-01"), np.datetime64("2020-01-02")], dims="time"))
+    assert result["red"].values[0].tolist() == [[1, 3], [7, 2]]
+    assert result["red"].values[1].tolist() == [[3, 3], [3, 3]]
+
+
+def test_empty_mosaic():
+    assert Mosaic(1).result(xarray.DataArray([np.datetime64("2020-01-01")], dims="time")) is None
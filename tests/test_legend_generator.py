@@ -109,15 +109,21 @@ def test_legend_graphic(make_response):
             self.styles[0].multi_date_handlers = [
             ]
 
+    def fetch_url_legend():
+        # Each case starts with a cold legend URL cache, so the legend is fetched by the request.
+        datacube_ows.legend_generator.LEGEND_URLS.clear()
+
     with patch("datacube_ows.legend_generator.GetLegendGraphicParameters") as lgp, patch("requests.get") as rg:
         lgp.return_value = fakeparams("test_style", None)
         rg.return_value = FakeRequestResult()
+        fetch_url_legend()
         lg = datacube_ows.legend_generator.legend_graphic(None)
 
         assert lg.mimetype == 'image/png'
     with patch("datacube_ows.legend_generator.GetLegendGraphicParameters") as lgp, patch("requests.get") as rg:
         lgp.return_value = fakeparams("test_style", fakeproduct({"url": "test_bad_url"}, dict()))
         rg.return_value = FakeRequestResult(status_code=404)
+        fetch_url_legend()
         try:
             lg = datacube_ows.legend_generator.legend_graphic(None)
             assert False
@@ -127,6 +133,7 @@ def test_legend_graphic(make_response):
     with patch("datacube_ows.legend_generator.GetLegendGraphicParameters") as lgp, patch("requests.get") as rg:
         rg.return_value = FakeRequestResult()
         lgp.return_value = fakeparams("test_style", fakeproduct({"url": "test_good_url"}, dict()))
+        fetch_url_legend()
 
         lg = datacube_ows.legend_generator.legend_graphic(None)
 
@@ -256,3 +263,149 @@ def test_parse_colorramp_legend_tick_labels():
                                 "#1.1s", "prefixes", "pos", ":-)"]
 
 
+
+
+def test_legend_memoised_with_etag():
+    from flask import Flask
+
+    def fake_img(bytesio):
+        from PIL import Image
+        Image.new('RGB', (64, 16)).save(bytesio, format="PNG")
+
+    style = MagicMock()
+    style.single_date_legend.side_effect = fake_img
+    style.legend_override_with_url.return_value = None
+    style.multi_date_handlers = []
+    product = MagicMock()
+    product.style_index = {"a_style": style}
+
+    with Flask("test").test_request_context():
+        legend = datacube_ows.legend_generator.create_legend_for_style(product, "a_style")
+        etag = legend.headers["ETag"]
+        assert legend.status_code == 200
+        assert etag.startswith('"') and etag.endswith('"')
+        # Rendered once, then served from the cache.
+        again = datacube_ows.legend_generator.create_legend_for_style(product, "a_style")
+        assert again.get_data() == legend.get_data()
+        assert again.headers["ETag"] == etag
+        style.single_date_legend.assert_called_once()
+
+        not_modified = datacube_ows.legend_generator.create_legend_for_style(product, "a_style",
+                                                                             if_none_match=etag)
+        assert not_modified.status_code == 304
+        assert not_modified.headers["ETag"] == etag
+        modified = datacube_ows.legend_generator.create_legend_for_style(product, "a_style",
+                                                                         if_none_match='"stale"')
+        assert modified.status_code == 200
+
+
+def test_pregenerate_legends():
+    def fake_img(bytesio):
+        from PIL import Image
+        Image.new('RGB', (64, 16)).save(bytesio, format="PNG")
+
+    def fake_mdh_img(bytesio):
+        fake_img(bytesio)
+        return True
+
+    mdh = MagicMock()
+    mdh.min_count = 2
+    mdh.applies_to.side_effect = lambda n: n == 2
+    mdh.legend.side_effect = fake_mdh_img
+    style = MagicMock()
+    style.show_legend = True
+    style.single_date_legend.side_effect = fake_img
+    style.legend_override_with_url.return_value = None
+    style.multi_date_handlers = [mdh]
+    url_style = MagicMock()
+    url_style.legend_override_with_url.return_value = "http://example.com/legend.png"
+    no_legend = MagicMock()
+    no_legend.show_legend = False
+    layer = MagicMock()
+    layer.styles = [style, url_style, no_legend]
+    cfg = MagicMock()
+    cfg.product_index = {"a_layer": layer}
+
+    assert datacube_ows.legend_generator.pregenerate_legends(cfg) == 3
+    url_style.single_date_legend.assert_not_called()
+    no_legend.single_date_legend.assert_not_called()
+    assert style.single_date_legend.call_count == 2
+    # Already generated
+    assert datacube_ows.legend_generator.legend_png([style], 2) is not None
+    assert style.single_date_legend.call_count == 2
+
+
+def test_legend_url_cache(httpserver):
+    from io import BytesIO
+    from PIL import Image
+    from datacube_ows.legend_generator import LegendUrlCache
+
+    bs = BytesIO()
+    Image.new('RGB', (64, 16)).save(bs, format="PNG")
+    png = bs.getvalue()
+    httpserver.serve_content(png, headers={"Content-Type": "image/png"})
+
+    cache = LegendUrlCache(ttl=60)
+    # A cold miss waits for the fetch.
+    assert cache.get(httpserver.url) == png
+    assert cache.get(httpserver.url) == png
+    assert len(httpserver.requests) == 1
+
+    # Expired entries are served stale while they are refreshed, and kept if the refresh fails.
+    cache.ttl = 0
+    httpserver.serve_content("Not found", code=404)
+    assert cache.get(httpserver.url) == png
+    cache.prefetch([])
+    assert len(httpserver.requests) == 2
+    cache.ttl = 60
+    assert cache.get(httpserver.url) == png
+
+    # Failed fetches are cached too.
+    cache = LegendUrlCache(ttl=60)
+    cache.prefetch([httpserver.url])
+    assert cache.get(httpserver.url) is None
+    assert len(httpserver.requests) == 3
+
+
+def test_prefetch_legend_urls(httpserver):
+    from datacube_ows.legend_generator import LEGEND_URLS, prefetch_legend_urls
+
+    httpserver.serve_content(b"not really a png", headers={"Content-Type": "image/png"})
+    url_style = MagicMock()
+    url_style.legend_override_with_url.return_value = httpserver.url
+    style = MagicMock()
+    style.legend_override_with_url.return_value = None
+    layer = MagicMock()
+    layer.styles = [style, url_style, url_style]
+    cfg = MagicMock()
+    cfg.product_index = {"a_layer": layer}
+
+    LEGEND_URLS.clear()
+    assert prefetch_legend_urls(cfg) == 1
+    assert LEGEND_URLS.get(httpserver.url) == b"not really a png"
+    assert len(httpserver.requests) == 1
+
+
+def test_legend_url_cache_cold_miss():
+    import time
+    from datacube_ows.legend_generator import LegendUrlCache
+
+    def slow_fetch(url, timeout):
+        time.sleep(0.5)
+        return b"late"
+
+    # Slow urls hold up a cold miss for at most the fetch timeout.
+    cache = LegendUrlCache(ttl=60, timeout=0.1)
+    with patch("datacube_ows.legend_generator.fetch_legend_png", side_effect=slow_fetch):
+        start = time.monotonic()
+        assert cache.get("http://slow/legend.png") is None
+        assert 0.05 < time.monotonic() - start < 0.4
+        cache.prefetch([])
+    assert cache.get("http://slow/legend.png") == b"late"
+
+    # Failed fetches are not waited for again until they are retried.
+    cache = LegendUrlCache(ttl=60)
+    with patch("datacube_ows.legend_generator.fetch_legend_png", return_value=None) as fetch:
+        assert cache.get("http://broken/legend.png") is None
+        assert cache.get("http://broken/legend.png") is None
+        assert fetch.call_count == 1
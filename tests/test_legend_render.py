@@ -0,0 +1,78 @@
+import io
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image
+
+from datacube_ows.legend_render import colour_bar, patch_legend, sample_cdict
+from datacube_ows.styles.ramp import ColorRamp, colour_ramp_legend
+
+CDICT = {
+    "red": ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0)),
+    "green": ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0)),
+    "blue": ((0.0, 1.0, 1.0), (1.0, 0.0, 0.0)),
+    "alpha": ((0.0, 1.0, 1.0), (0.5, 1.0, 1.0), (1.0, 0.0, 0.0)),
+}
+
+
+def read_png(bytesio):
+    bytesio.seek(0)
+    return np.asarray(Image.open(bytesio))
+
+
+def test_sample_cdict():
+    rgb = sample_cdict(CDICT, 4)
+    assert rgb.shape == (4, 3)
+    # Blue to red, fading to white (transparent) over the second half.
+    assert rgb[0, 2] > 200 and rgb[0, 0] < 50
+    assert rgb[-1].min() > 180
+    assert rgb[1, 1] < 10 and rgb[2, 1] > rgb[1, 1]
+
+
+def test_colour_bar():
+    bytesio = io.BytesIO()
+    colour_bar(bytesio, CDICT, {0.0: "low", 0.5: "mid", 1.0: "high"}, "Title(units)",
+               width=4, height=1.25, strip_location=[0.05, 0.5, 0.9, 0.15])
+    img = read_png(bytesio)
+    assert img.shape == (125, 400, 4)
+    # Strip runs from x=20 to x=380, and y=44 to y=62.
+    assert tuple(img[53, 25, :3]) == tuple(sample_cdict(CDICT, 360)[5])
+    assert tuple(img[53, 200, :3]) == tuple(sample_cdict(CDICT, 360)[180])
+    # Background is white and tick marks and labels are drawn below the strip.
+    assert img[5, 5].tolist() == [255, 255, 255, 255]
+    assert img[64:68, 20, :3].max() == 0
+    assert (img[70:110, :, :3] < 128).any()
+
+
+def test_patch_legend():
+    bytesio = io.BytesIO()
+    patch_legend(bytesio, [("#ff0000", "Red - a\nred value"), ("#0000ff", "Blue - a blue value")])
+    img = read_png(bytesio)
+    assert img.shape == (125, 300, 4)
+    colours = {tuple(px) for px in img.reshape(-1, 4).tolist()}
+    assert (255, 0, 0, 255) in colours
+    assert (0, 0, 255, 255) in colours
+
+    bytesio = io.BytesIO()
+    patch_legend(bytesio, [], width=2, height=1)
+    assert read_png(bytesio).shape == (100, 200, 4)
+
+
+def test_ramp_legend_renderer_choice():
+    ramp_cfg = {
+        "color_ramp": [
+            {"value": 0.0, "color": "#000000"},
+            {"value": 1.0, "color": "#ff0000"},
+        ],
+    }
+    ramp = ColorRamp(None, dict(ramp_cfg, legend={"tick_count": 2}))
+    with patch("datacube_ows.styles.ramp.pyplot") as pyplot:
+        bytesio = io.BytesIO()
+        colour_ramp_legend(bytesio, {}, ramp, "a_map", "Title")
+        pyplot.assert_not_called()
+    assert read_png(bytesio).shape == (125, 400, 4)
+
+    ramp = ColorRamp(None, dict(ramp_cfg, legend={"rcParams": {"font.weight": "bold"}}))
+    bytesio = io.BytesIO()
+    colour_ramp_legend(bytesio, {}, ramp, "a_map", "Title")
+    assert read_png(bytesio).shape == (125, 400, 4)
@@ -0,0 +1,74 @@
+import datetime
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+import numpy as np
+import xarray
+from affine import Affine
+
+from datacube.utils import geometry
+
+from datacube_ows.low_zoom_mosaic import build_mosaic, mosaic_geobox, mosaic_path, read_mosaic
+
+
+def fake_layer(path):
+    return SimpleNamespace(
+        name="a_layer",
+        low_zoom_mosaic={
+            "path": str(path),
+            "crs": "EPSG:3577",
+            "resolution": [1000.0, 1000.0],
+            "bands": ["red", "green"],
+        },
+        ranges={
+            "bboxes": {
+                "EPSG:3577": {"left": 0.0, "right": 64000.0, "bottom": -48000.0, "top": 0.0}
+            }
+        },
+        data_manual_merge=False,
+        fuse_func=None,
+    )
+
+
+def test_mosaic_geobox(tmpdir):
+    geobox = mosaic_geobox(fake_layer(tmpdir))
+    assert (geobox.width, geobox.height) == (64, 48)
+    assert geobox.affine == Affine(1000.0, 0.0, 0.0, 0.0, -1000.0, 0.0)
+
+
+def test_build_and_read_mosaic(tmpdir):
+    layer = fake_layer(tmpdir)
+    dt = datetime.date(2020, 1, 1)
+    geobox = mosaic_geobox(layer)
+    red = np.arange(64 * 48, dtype="int16").reshape((1, 48, 64))
+    green = np.full((1, 48, 64), -999, dtype="int16")
+    data = xarray.Dataset(
+        {
+            "red": (("time", "y", "x"), red, {"nodata": -999}),
+            "green": (("time", "y", "x"), green, {"nodata": -999}),
+        },
+        coords={"time": [np.datetime64(dt, "ns")]},
+    )
+    stacker = MagicMock()
+    stacker.data.return_value = data
+    with patch("datacube_ows.data.DataStacker") as stacker_cls, \
+            patch("datacube_ows.data.datasets_in_xarray") as n_datasets:
+        stacker_cls.return_value = stacker
+        n_datasets.return_value = 1
+        assert build_mosaic(layer, dt, MagicMock())
+
+    # No mosaic for other dates
+    assert read_mosaic(layer, [datetime.date(2020, 1, 2)], geobox, ["red"]) is None
+    # Or for bands not in the mosaic
+    assert read_mosaic(layer, [dt], geobox, ["blue"]) is None
+
+    # Read a 2x zoomed-in window from the top-left corner of the mosaic
+    req_geobox = geometry.GeoBox(16, 16, Affine(500.0, 0.0, 0.0, 0.0, -500.0, 0.0), geometry.CRS("EPSG:3577"))
+    mosaic = read_mosaic(layer, [dt], req_geobox, ["red", "green"])
+    assert mosaic["red"].shape == (1, 16, 16)
+    assert mosaic["red"].attrs["nodata"] == -999
+    assert mosaic["red"].values[0, 0, 0] == 0
+    assert mosaic["red"].values[0, 3, 5] == 64 + 2
+    assert (mosaic["green"].values == -999).all()
+    assert mosaic.time.values[0] == np.datetime64(dt, "ns")
+    assert mosaic_path(layer, dt).endswith("a_layer/2020-01-01.tif")
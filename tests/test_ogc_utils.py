@@ -44,4 +44,21 @@ def test_get_service_base_url():
 def test_parse_for_base_url():
     url = "https://hello.world.bar:8000/wms/?CheckSomething"
     ret = datacube_ows.ogc_utils.parse_for_base_url(url)
-    assert ret == "hello.world.bar:8000/wms"
\ No newline at end of file
+    assert ret == "hello.world.bar:8000/wms"
+
+def test_etag_matches():
+    assert datacube_ows.ogc_utils.etag_matches('"abc"', '"abc"')
+    assert datacube_ows.ogc_utils.etag_matches('"xyz", W/"abc"', '"abc"')
+    assert datacube_ows.ogc_utils.etag_matches('*', '"abc"')
+    assert not datacube_ows.ogc_utils.etag_matches('"xyz"', '"abc"')
+    assert not datacube_ows.ogc_utils.etag_matches(None, '"abc"')
+    assert not datacube_ows.ogc_utils.etag_matches('"abc"', None)
+
+
+def test_json_digest():
+    from datacube_ows.ogc_utils import json_digest
+    cfg = {"a": [1, 2.5, "x"], "f": datacube_ows.ogc_utils.json_digest, "s": {"b", "a"}}
+    digest = json_digest(cfg)
+    assert digest == json_digest({"a": [1, 2.5, "x"], "f": datacube_ows.ogc_utils.json_digest, "s": {"a", "b"}})
+    assert "0x" not in str(datacube_ows.ogc_utils._digest_default(datacube_ows.ogc_utils.json_digest))
+    assert digest != json_digest({"a": [1, 2.5, "y"], "f": datacube_ows.ogc_utils.json_digest, "s": {"a", "b"}})
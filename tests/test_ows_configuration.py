@@ -36,4 +36,43 @@ def test_band_index():
         "band4": ["band4", "alias4"],
     }
 
-    bidx = BandIndex(prod, cfg, dc)
\ No newline at end of file
+    bidx = BandIndex(prod, cfg, dc)
+
+def test_resolution_ladder():
+    from types import SimpleNamespace
+    from datacube_ows.ogc_utils import ConfigException
+    from datacube_ows.ows_configuration import OWSProductLayer
+
+    def fake_product(name, bands):
+        prod = MagicMock()
+        prod.name = name
+        prod.measurements = {b: {} for b in bands}
+        return prod
+
+    products = {
+        "coarse": fake_product("coarse", ["red", "green"]),
+        "medium": fake_product("medium", ["red", "green"]),
+        "bad": fake_product("bad", ["red"]),
+    }
+    dc = MagicMock()
+    dc.index.products.get_by_name.side_effect = products.get
+
+    lyr = OWSProductLayer.__new__(OWSProductLayer)
+    lyr.name = "a_layer"
+    lyr.product_names = ["native"]
+    lyr.band_idx = SimpleNamespace(native_bands=SimpleNamespace(index=["red", "green"]))
+    lyr.parse_resolution_ladder([
+        {"max_zoom_factor": 150.0, "product": "medium"},
+        {"max_zoom_factor": 50.0, "product": "coarse"},
+    ], dc)
+    assert lyr.ladder_product_names == ["coarse", "medium"]
+    assert lyr.ladder_rung(10.0).product_name == "coarse"
+    assert lyr.ladder_rung(50.0).product_name == "medium"
+    assert lyr.ladder_rung(100.0).product is products["medium"]
+    assert lyr.ladder_rung(500.0) is None
+
+    with pytest.raises(ConfigException) as e:
+        lyr.parse_resolution_ladder([{"max_zoom_factor": 150.0, "product": "bad"}], dc)
+    assert "has no band green" in str(e.value)
+    with pytest.raises(ConfigException):
+        lyr.parse_resolution_ladder([{"max_zoom_factor": 150.0, "product": "missing"}], dc)
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from datacube_ows.seed import tile_range, tile_count, tile_tasks, seed_tile
+from datacube_ows.tile_cache import TileCache
+from datacube_ows.wmts import tile_key, wmts_args_to_wms
+from tests.test_tile_cache import fake_get_map_params
+
+
+def test_tile_range():
+    whole_world = [-180.0, -90.0, 180.0, 90.0]
+    assert tile_range(whole_world, 0) == (0, 0, 0, 0)
+    assert tile_range(whole_world, 3) == (0, 7, 0, 7)
+    # Eastern hemisphere, southern hemisphere
+    assert tile_range([1.0, -80.0, 179.0, -1.0], 1) == (1, 1, 1, 1)
+    assert tile_count(whole_world, range(0, 3)) == 1 + 4 + 16
+
+
+def test_tile_tasks():
+    tasks = list(tile_tasks("lyr", ["s1", "s2"], ["2020-01-01"], [1.0, -80.0, 179.0, -1.0], range(1, 3)))
+    assert len(tasks) == 2 * (1 + 4)
+    assert ("lyr", "s2", "2020-01-01", 1, 1, 1) in tasks
+
+
+@pytest.fixture
+def seed_cfg(tmpdir):
+    cfg = SimpleNamespace(tile_cache=TileCache({"disk_path": str(tmpdir)}), config_digest="cfg1")
+    with patch("datacube_ows.seed.get_config", return_value=cfg), \
+            patch("datacube_ows.wmts.get_config", return_value=cfg), \
+            patch("datacube_ows.wmts.GetMapParameters", side_effect=fake_get_map_params):
+        yield cfg
+
+
+def test_seed_tile_resumes(seed_cfg):
+    task = ("a_layer", "style", "2020-01-01", 3, 2, 5)
+    with patch("datacube_ows.wmts.get_map") as get_map:
+        get_map.return_value = (b"tile", 200, {"ETag": '"etag"'})
+        assert seed_tile(task) == 1
+        assert get_map.call_count == 1
+        wms_args = get_map.call_args[0][0]
+        assert wms_args["layers"] == "a_layer"
+        assert wms_args["width"] == 256
+        # Second run skips the already seeded tile
+        assert seed_tile(task) == 0
+        assert get_map.call_count == 1
+
+
+def test_seed_default_time(seed_cfg):
+    # Seeding the default date also seeds requests that do not specify a date
+    with patch("datacube_ows.wmts.get_map") as get_map:
+        get_map.return_value = (b"tile", 200, {"ETag": '"etag"'})
+        seed_tile(("a_layer", "default_style", "2020-01-02", 3, 2, 5))
+    wmts_args = {"layer": "a_layer", "format": "image/png", "tilematrixset": "WholeWorld_WebMercator",
+                 "tilematrix": "3", "tilerow": "2", "tilecol": "5", "requestid": "req"}
+    key = tile_key(wmts_args, wmts_args_to_wms(wmts_args))
+    assert seed_cfg.tile_cache.disk.get(key) == b"tile"
+    assert seed_cfg.tile_cache.disk.get_etag(key) == '"etag"'
+
+
+def test_seed_metatiles(seed_cfg):
+    seed_cfg.tile_cache.metatile = 2
+    tasks = list(tile_tasks("a_layer", ["style"], ["2020-01-01"], [1.0, -80.0, 179.0, -1.0], [2], metatile=2))
+    # Tiles are listed block by block
+    assert [t[4:] for t in tasks] == [(2, 2), (2, 3), (3, 2), (3, 3)]
+    with patch("datacube_ows.wmts.MetatileParameters"), patch("datacube_ows.wmts.render_map") as render_map:
+        render_map.return_value = ([np.zeros((512, 512), dtype="uint8")] * 4, '"etag"')
+        assert [seed_tile(task) for task in tasks] == [4, 0, 0, 0]
+        assert render_map.call_count == 1
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from datacube_ows.single_flight import SingleFlight, request_key, COALESCED_REQUESTS
+
+
+def test_request_key_ignores_volatile_args():
+    args1 = {"layers": "a", "bbox": "0,0,1,1", "requestid": "1", "referer": "x", "host": "h1"}
+    args2 = {"bbox": "0,0,1,1", "layers": "a", "requestid": "2", "referer": None, "url_root": "http://a/"}
+    assert request_key(args1) == request_key(args2)
+    args2["bbox"] = "0,0,2,2"
+    assert request_key(args1) != request_key(args2)
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight("test")
+    release = threading.Event()
+    started = threading.Event()
+    calls = []
+
+    def render(val):
+        calls.append(val)
+        started.set()
+        release.wait(5)
+        return val * 2
+
+    before = COALESCED_REQUESTS.labels(operation="test")._value.get()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(flights.do, "k", render, 21)
+        assert started.wait(5)
+        followers = [executor.submit(flights.do, "k", render, 21) for _ in range(3)]
+        while COALESCED_REQUESTS.labels(operation="test")._value.get() < before + 3:
+            pass
+        release.set()
+        assert leader.result() == 42
+        assert [f.result() for f in followers] == [42, 42, 42]
+    assert calls == [21]
+    assert len(flights) == 0
+
+    # Not in flight any more, so the next call runs again.
+    release.set()
+    assert flights.do("k", render, 1) == 2
+    assert calls == [21, 1]
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight("test")
+    release = threading.Event()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flights.do, "k", fail)
+        assert started.wait(5)
+        follower = executor.submit(flights.do, "k", fail)
+        while len(flights) and not follower.running():
+            pass
+        release.set()
+        with pytest.raises(ValueError):
+            leader.result()
+        with pytest.raises(ValueError):
+            follower.result()
@@ -0,0 +1,143 @@
+import datetime
+import uuid
+from collections import namedtuple
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+import yaml
+from psycopg2.extras import DateTimeTZRange, NumericRange
+from pytz import utc
+from sqlalchemy.dialects import postgresql
+
+import datacube
+from datacube.api.query import Query
+from datacube.drivers.postgres import PostgresDb
+from datacube.model import MetadataType, DatasetType
+from datacube.storage import BandInfo
+from datacube.utils import geometry
+
+from datacube_ows.slim_search import search_datasets, search_query, SLIM_FIELDS
+
+
+def eo3_product(name="a_product", id_=3):
+    with open(datacube.__path__[0] + "/index/default-metadata-types.yaml") as fp:
+        eo3 = [doc for doc in yaml.safe_load_all(fp) if doc["name"] == "eo3"][0]
+    metadata_type = MetadataType(eo3, PostgresDb.get_dataset_fields(eo3))
+    return DatasetType(metadata_type, {
+        "name": name,
+        "metadata_type": "eo3",
+        "description": "A product",
+        "metadata": {"product": {"name": name}, "properties": {"odc:file_format": "GeoTIFF"}},
+        "measurements": [{"name": "red", "dtype": "int16", "nodata": -999, "units": "1"}],
+    }, id_=id_)
+
+
+def search_terms():
+    return Query(geopolygon=geometry.box(130.0, -30.0, 131.0, -29.0, crs=geometry.CRS("EPSG:4326")),
+                 time=("2020-01-01", "2020-01-02")).search_terms
+
+
+def test_slim_search():
+    product = eo3_product()
+    ds_id = uuid.uuid4()
+    row = namedtuple("DatasetLight", SLIM_FIELDS)(
+        id=ds_id,
+        uris=["s3://bucket/a/b.odc-metadata.yaml"],
+        grid_spatial={
+            "spatial_reference": "EPSG:32653",
+            "geo_ref_points": {
+                "ll": {"x": 100.0, "y": 200.0},
+                "ul": {"x": 100.0, "y": 300.0},
+                "ur": {"x": 200.0, "y": 300.0},
+                "lr": {"x": 200.0, "y": 200.0},
+            },
+        },
+        measurements={"red": {"path": "red.tif"}},
+        time=DateTimeTZRange(datetime.datetime(2020, 1, 1, 1, 0, tzinfo=utc),
+                             datetime.datetime(2020, 1, 1, 1, 0, tzinfo=utc), "[]"),
+        lon=NumericRange(130.0, 131.0, "[]"),
+    )
+    index = MagicMock()
+    index.datasets.search_returning_datasets_light.return_value = iter([row])
+    terms = search_terms()
+    datasets = search_datasets(index, [product], terms, limit=5)
+
+    # Only fragments of the metadata document are selected, through the index API.
+    args, kwargs = index.datasets.search_returning_datasets_light.call_args
+    assert args == (SLIM_FIELDS,)
+    assert kwargs["custom_offsets"] == {"grid_spatial": ["grid_spatial", "projection"],
+                                        "measurements": ["measurements"]}
+    assert kwargs["product"] == "a_product"
+    assert kwargs["time"] == terms["time"]
+    assert kwargs["limit"] == 5
+    index.datasets.search.assert_not_called()
+
+    ds, = datasets
+    assert ds.id == ds_id
+    assert ds.type is product
+    assert ds.extent.boundingbox == geometry.BoundingBox(100.0, 200.0, 200.0, 300.0)
+    assert ds.center_time == datetime.datetime(2020, 1, 1, 1, 0, tzinfo=utc)
+
+    # Slim datasets can be grouped and loaded like full datasets.
+    band = BandInfo(ds, "red")
+    assert band.uri == "s3://bucket/a/red.tif"
+    assert band.crs == geometry.CRS("EPSG:32653")
+    assert band.format == "GeoTIFF"
+    assert band.driver_data is None
+    grouped = datacube.Datacube.group_datasets(datasets, "solar_day")
+    assert grouped.values[0] == (ds,)
+
+
+def test_full_search():
+    products = [eo3_product("prod_a", 3), eo3_product("prod_b", 4)]
+    ids = [uuid.uuid4() for i in range(3)]
+    index = MagicMock()
+    index.datasets.search.side_effect = [iter([ids[0], ids[1]]), iter([ids[2]])]
+    terms = search_terms()
+    assert search_datasets(index, products, terms, slim=False) == ids
+    for call, product in zip(index.datasets.search.call_args_list, products):
+        assert call[1]["product"] == product.name
+        assert call[1]["time"] == terms["time"]
+
+    # The search stops at the limit.
+    index.datasets.search.reset_mock()
+    index.datasets.search.side_effect = [iter([ids[0], ids[1]]), iter([ids[2]])]
+    assert search_datasets(index, products, terms, slim=False, limit=2) == ids[:2]
+    assert index.datasets.search.call_count == 1
+    assert index.datasets.search.call_args[1]["limit"] == 2
+
+
+def test_batched_search():
+    products = [eo3_product("prod_a", 3), eo3_product("prod_b", 4)]
+    terms = Query(geopolygon=geometry.box(130.0, -30.0, 131.0, -29.0, crs=geometry.CRS("EPSG:4326"))).search_terms
+    times = [Query(time=t).search_terms["time"] for t in (("2020-01-01", "2020-01-02"), ("2020-01-05", "2020-01-06"))]
+    query = search_query(products, terms, times, slim=False)
+    sql = str(query.compile(dialect=postgresql.dialect()))
+    assert "agdc.dataset.dataset_type_ref IN " in sql
+    assert "agdc.dataset.archived IS NULL" in sql
+    assert " OR " in sql
+    # Full metadata documents
+    assert "AS grid_spatial" not in sql
+    sql = str(search_query(products, terms, times).compile(dialect=postgresql.dialect()))
+    assert "AS grid_spatial" in sql
+    assert "AS uris" in sql
+    # Only fragments of the metadata document are selected
+    assert "agdc.dataset.metadata," not in sql
+
+    ids = [uuid.uuid4() for i in range(3)]
+    rows = [
+        SimpleNamespace(id=ds_id, dataset_type_ref=dstr, uris=["file:///tmp/%d.yaml" % i], metadata={"id": str(ds_id)})
+        for i, (ds_id, dstr) in enumerate(zip(ids, [4, 3, 4]))
+    ]
+    conn = MagicMock()
+    conn.execute.return_value = rows
+    index = MagicMock()
+    with patch("datacube_ows.slim_search.get_index_sqlconn") as get_conn:
+        get_conn.return_value = conn
+        datasets = search_datasets(index, products, terms, time_ranges=times, slim=False)
+    # One query for all products and times
+    conn.execute.assert_called_once()
+    index.datasets.search.assert_not_called()
+    assert [ds.type.name for ds in datasets] == ["prod_b", "prod_a", "prod_b"]
+    assert [ds.id for ds in datasets] == ids
+    assert datasets[0].uris == ["file:///tmp/0.yaml"]
@@ -1,5 +1,6 @@
 import datetime
 
+import datacube_ows.band_utils
 import datacube_ows.styles.colormap
 import datacube_ows.styles.component
 import datacube_ows.styles.hybrid
@@ -7,6 +8,7 @@ import datacube_ows.styles.ramp
 from datacube_ows.styles import StyleDef
 
 from datacube_ows.ows_configuration import BandIndex, OWSProductLayer
+from datacube_ows.ogc_utils import ConfigException
 
 from xarray import DataArray, Dataset, concat
 from unittest.mock import patch
@@ -467,4 +469,240 @@ def test_createcolordata_remask():
     
 
 
+def test_preserve_dtype_component(product_layer, style_cfg_lin):
+    style_cfg_lin["scale_range"] = [0, 3000]
+    coords = {"y": [2.0, 1.0, 0.0], "x": [0.0, 1.0]}
+    data = Dataset({
+        band: (("y", "x"), np.array([[0, 1500], [3000, 4000], [-999, 750]], dtype="int16"))
+        for band in ("red", "green", "blue")
+    }, coords=coords)
+    extent_mask = DataArray(np.array([[True, True], [True, True], [False, True]]), dims=("y", "x"), coords=coords)
 
+    style_def = StyleDef(product_layer, style_cfg_lin)
+    expected = style_def.transform_single_date_data(data.copy(), None, extent_mask)
+
+    product_layer.preserve_dtype = True
+    style_def = StyleDef(product_layer, style_cfg_lin)
+    dtypes = []
+    compress_band = style_def.compress_band
+
+    def spy_compress_band(component_name, imgband_data):
+        dtypes.append(imgband_data.dtype)
+        return compress_band(component_name, imgband_data)
+
+    style_def.compress_band = spy_compress_band
+    result = style_def.transform_single_date_data(data.copy(), None, extent_mask)
+    assert dtypes == [np.dtype("float32")] * 3
+    for band in ("red", "green", "blue"):
+        assert result[band].dtype == np.dtype("uint8")
+        np.testing.assert_array_equal(result[band].values, expected[band].values)
+    assert result["red"].values[2, 0] == 0
+
+
+def test_numpy_kernel_component(product_layer, style_cfg_lin):
+    style_cfg_lin["scale_range"] = [0, 3000]
+    style_cfg_lin["components"] = {
+        "red": {"red": 0.5, "green": 0.5},
+        "green": {"green": 1.0, "scale_range": [100, 2000]},
+        "blue": {"blue": 0.8, "red": 0.2},
+        "alpha": {"blue": 0.05},
+    }
+    coords = {"y": [2.0, 1.0, 0.0], "x": [0.0, 1.0]}
+    data = Dataset({
+        band: (("y", "x"), np.array([[0, 1500], [3000, 4000], [-999, 750]], dtype="int16") + i * 37)
+        for i, band in enumerate(("red", "green", "blue"))
+    }, coords=coords)
+    extent_mask = DataArray(np.array([[True, True], [True, False], [True, True]]), dims=("y", "x"), coords=coords)
+
+    style_def = StyleDef(product_layer, style_cfg_lin)
+    assert style_def.kernel is None
+    expected = style_def.transform_single_date_data(data.copy(), None, extent_mask)
+
+    style_cfg_lin["numpy_kernel"] = True
+    style_def = StyleDef(product_layer, style_cfg_lin)
+    assert style_def.kernel.bands == ["red", "green", "blue"]
+    np.testing.assert_array_equal(style_def.kernel.weights,
+                                  [[0.5, 0.5, 0.0], [0.0, 1.0, 0.0], [0.2, 0.0, 0.8], [0.0, 0.0, 0.05]])
+    result = style_def.transform_single_date_data(data.copy(), None, extent_mask)
+    for band in ("red", "green", "blue", "alpha"):
+        assert result[band].dtype == np.dtype("uint8")
+        assert result[band].dims == ("y", "x")
+        np.testing.assert_array_equal(result[band].values, expected[band].values)
+    assert result["red"].values[1, 1] == 0
+
+
+def test_numpy_kernel_requires_linear_components(product_layer, style_cfg_lin):
+    style_cfg_lin["numpy_kernel"] = True
+    style_cfg_lin["components"]["red"] = {
+        "function": "datacube_ows.band_utils.constant",
+        "kwargs": {"const": 1.0, "band": "red"},
+    }
+    style_cfg_lin["additional_bands"] = []
+    with pytest.raises(ConfigException) as excinfo:
+        StyleDef(product_layer, style_cfg_lin)
+    assert "numpy_kernel" in str(excinfo.value)
+
+
+def test_preserve_dtype_ramp(product_layer):
+    cfg = {
+        "name": "test_style",
+        "title": "Test Style",
+        "abstract": "This is a Test Style for Datacube WMS",
+        "needed_bands": ["red", "green"],
+        "index_function": {
+            "function": "datacube_ows.band_utils.norm_diff",
+            "kwargs": {"band1": "red", "band2": "green"},
+        },
+        "range": [-1.0, 1.0],
+    }
+    coords = {"y": [1.0, 0.0], "x": [0.0, 1.0]}
+    data = Dataset({
+        "red": (("y", "x"), np.array([[100, 300], [200, 0]], dtype="uint16")),
+        "green": (("y", "x"), np.array([[300, 100], [200, 0]], dtype="uint16")),
+    }, coords=coords)
+    extent_mask = DataArray(np.array([[True, True], [True, False]]), dims=("y", "x"), coords=coords)
+    style_def = StyleDef(product_layer, cfg)
+    expected = style_def.apply_masks_and_index(data.copy(), None, extent_mask)
+
+    product_layer.preserve_dtype = True
+    style_def = StyleDef(product_layer, cfg)
+    index = style_def.apply_masks_and_index(data.copy(), None, extent_mask)
+    assert index.dtype == np.dtype("float32")
+    np.testing.assert_allclose(index.values, expected.values)
+    assert np.isnan(index.values[1, 1])
+
+
+def test_ramp_lut(product_layer):
+    cfg = {
+        "name": "test_style",
+        "title": "Test Style",
+        "abstract": "This is a Test Style for Datacube WMS",
+        "needed_bands": ["red"],
+        "index_function": {
+            "function": "datacube_ows.band_utils.single_band",
+            "kwargs": {"band": "red"},
+        },
+        "color_ramp": [
+            {"value": -1.0, "color": "#FF0000", "alpha": 0.0},
+            {"value": 0.0, "color": "#00FF00", "alpha": 0.5},
+            {"value": 2.0, "color": "#0000FF", "alpha": 1.0},
+        ],
+    }
+    index = DataArray(np.array([[-5.0, -1.0, -0.3], [0.0, 1.234, np.nan], [2.0, 7.0, 0.5]]), dims=("y", "x"))
+    expected = StyleDef(product_layer, cfg).color_ramp.apply(index)
+
+    cfg["lut_size"] = 65536
+    ramp = StyleDef(product_layer, cfg).color_ramp
+    assert ramp.lut.shape == (4, 65537)
+    result = ramp.apply(index)
+    for band in ("red", "green", "blue", "alpha"):
+        assert result[band].dtype == np.dtype("uint8")
+        assert result[band].dims == ("y", "x")
+        np.testing.assert_allclose(result[band].values, expected[band].values, atol=1)
+        # NaN is transparent black
+        assert result[band].values[1, 2] == 0
+    assert result["red"].values[0, 0] == 255
+    assert result["blue"].values[2, 1] == 255
+
+    cfg["lut_size"] = 1
+    with pytest.raises(ConfigException):
+        StyleDef(product_layer, cfg)
+
+
+def test_colormap_lut(product_layer_alpha_map, style_cfg_map):
+    style_cfg_map["value_map"]["foo"] = [
+        {"title": "Nodata", "abstract": "", "flags": {"nodata": True}, "color": "#000000", "mask": True},
+        {"title": "Cloud", "abstract": "", "flags": {"cloud": True}, "color": "#C2C1C0"},
+        {"title": "Water", "abstract": "", "flags": {"water": True}, "color": "#4F81BD", "alpha": 0.5},
+        {"title": "Dry", "abstract": "", "flags": {"water": False}, "color": "#FFFFFF", "alpha": 0.0},
+    ]
+    flags_def = {
+        "nodata": {"bits": 0, "values": {"0": False, "1": True}},
+        "cloud": {"bits": 6, "values": {"0": False, "1": True}},
+        "water": {"bits": 7, "values": {"0": False, "1": True}},
+    }
+    # Masked (nodata) values are no longer water, so are transparent.
+    values = np.array([[0, 128, 64], [192, 1, 129]])
+    expected = {
+        "red": [[255, 79, 194], [194, 255, 255]],
+        "green": [[255, 129, 193], [193, 255, 255]],
+        "blue": [[255, 189, 192], [192, 255, 255]],
+        "alpha": [[0, 127, 255], [255, 0, 0]],
+    }
+    for dtype in ("uint8", "int32"):
+        data = Dataset({"foo": (("y", "x"), values.astype(dtype), {"flags_definition": flags_def})})
+        style_def = StyleDef(product_layer_alpha_map, style_cfg_map)
+        result = style_def.transform_single_date_data(data, None, None)
+        for band, vals in expected.items():
+            assert result[band].dtype == np.dtype("uint8")
+            np.testing.assert_array_equal(result[band].values, vals)
+    # The uint8 lookup table is compiled once, over all 256 values.
+    style_def = StyleDef(product_layer_alpha_map, style_cfg_map)
+    data = Dataset({"foo": (("y", "x"), values.astype("uint8"), {"flags_definition": flags_def})})
+    style_def.transform_single_date_data(data, None, None)
+    rgba, matched = style_def._luts[style_def.lut_key("foo", data["foo"])]
+    assert rgba.shape == (4, 256)
+    with patch("datacube_ows.styles.colormap.make_mask") as fmm:
+        style_def.transform_single_date_data(data, None, None)
+        fmm.assert_not_called()
+
+    # With preserve_dtype, masked data is still looked up in its native type.
+    product_layer_alpha_map.preserve_dtype = True
+    style_def = StyleDef(product_layer_alpha_map, style_cfg_map)
+    extent_mask = DataArray(np.array([[True, False, True], [True, True, True]]), dims=("y", "x"))
+    result = style_def.transform_single_date_data(data.copy(), None, extent_mask)
+    assert list(style_def._luts) == [style_def.lut_key("foo", data["foo"])]
+    for band, vals in expected.items():
+        vals = np.array(vals)
+        vals[0, 1] = 0
+        np.testing.assert_array_equal(result[band].values, vals)
+
+    # Tables are not shared between value maps or flag definitions.
+    other_map = dict(style_cfg_map, name="other_style")
+    other_map["value_map"] = {"foo": [{"title": "Any", "abstract": "", "flags": {"cloud": False}, "color": "#FF0000"}]}
+    other_def = StyleDef(product_layer_alpha_map, other_map)
+    assert other_def.lut_key("foo", data["foo"]) != style_def.lut_key("foo", data["foo"])
+    other_flags = dict(flags_def, cloud={"bits": 5, "values": {"0": False, "1": True}})
+    other_data = Dataset({"foo": (("y", "x"), values.astype("uint8"), {"flags_definition": other_flags})})
+    assert style_def.lut_key("foo", other_data["foo"]) != style_def.lut_key("foo", data["foo"])
+
+
+def test_streaming_multi_date(product_layer):
+    cfg = {
+        "name": "test_style",
+        "title": "Test Style",
+        "abstract": "This is a Test Style for Datacube WMS",
+        "needed_bands": ["red", "green"],
+        "index_function": {"expression": "(red - green) / (red + green)"},
+        "range": [-1.0, 1.0],
+        "multi_date": [
+            {
+                "allowed_count_range": [2, 2],
+                "aggregator_function": {"function": "datacube_ows.band_utils.multi_date_delta"},
+                "range": [-1.0, 1.0],
+            },
+        ],
+    }
+    times = np.array(["2020-01-01", "2020-01-02"], dtype="datetime64[ns]")
+    data = Dataset({
+        "red": (("time", "y", "x"), np.array([[[100, 300], [200, 0]], [[500, 300], [200, 7]]], dtype="float64")),
+        "green": (("time", "y", "x"), np.array([[[300, 100], [200, 0]], [[100, 200], [600, 7]]], dtype="float64")),
+    }, coords={"time": times, "y": [1.0, 0.0], "x": [0.0, 1.0]})
+    extent_mask = DataArray(np.array([[[True, True], [True, True]], [[True, True], [False, True]]]),
+                            dims=("time", "y", "x"), coords=data.coords)
+    style_def = StyleDef(product_layer, cfg)
+    assert style_def.multi_date_handlers[0].streaming_aggregator is None
+    expected = style_def.transform_data(data.copy(), None, extent_mask)
+
+    cfg["multi_date"][0].pop("aggregator_function")
+    cfg["multi_date"][0]["streaming_aggregator"] = "delta"
+    style_def = StyleDef(product_layer, cfg)
+    mdh = style_def.multi_date_handlers[0]
+    assert isinstance(mdh.streaming_aggregator, datacube_ows.band_utils.StreamingDelta)
+    result = style_def.transform_data(data.copy(), None, extent_mask)
+    for band in ("red", "green", "blue", "alpha"):
+        np.testing.assert_array_equal(result[band].values, expected[band].values)
+
+    cfg["multi_date"][0]["streaming_aggregator"] = {"function": "datacube_ows.band_utils.StreamingMean"}
+    style_def = StyleDef(product_layer, cfg)
+    assert isinstance(style_def.multi_date_handlers[0].streaming_aggregator, datacube_ows.band_utils.StreamingMean)
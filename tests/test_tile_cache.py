@@ -0,0 +1,299 @@
+import os
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from datacube_ows.ogc_exceptions import WMSException
+from datacube_ows.tile_cache import TileCache, TileKey, MemoryTileStore, DiskTileStore
+from datacube_ows.wmts import wmts_args_to_wms, wms_args_to_tile_key, tile_key
+
+
+def key(layer="layer", row=0, col=0):
+    return TileKey(layer, "style", "2020-01-01", "WholeWorld_WebMercator", 5, row, col, "cfg1")
+
+
+def fake_get_map_params(args):
+    # Stand-in for GetMapParameters, resolving the default style and date of "a_layer".
+    if args.get("layers") != "a_layer":
+        raise WMSException("Layer %s is not defined" % args.get("layers"), WMSException.LAYER_NOT_DEFINED)
+    return SimpleNamespace(
+        product=SimpleNamespace(name="a_layer"),
+        style=SimpleNamespace(name=args.get("styles") or "default_style"),
+        times=[args.get("time") or "2020-01-02"],
+    )
+
+
+@pytest.fixture
+def tile_key_cfg():
+    cfg = MagicMock()
+    cfg.config_digest = "cfg1"
+    with patch("datacube_ows.wmts.get_config", return_value=cfg), \
+            patch("datacube_ows.wmts.GetMapParameters", side_effect=fake_get_map_params):
+        yield cfg
+
+
+def test_memory_lru_eviction():
+    store = MemoryTileStore(max_bytes=20)
+    store.put(key(col=1), b"a" * 8)
+    store.put(key(col=2), b"b" * 8)
+    # Touch tile 1 so tile 2 is least recently used
+    assert store.get(key(col=1)) == b"a" * 8
+    store.put(key(col=3), b"c" * 8)
+    assert store.get(key(col=2)) is None
+    assert store.get(key(col=1)) is not None
+    assert store.get(key(col=3)) is not None
+    assert store.size == 16
+
+
+def test_memory_oversized_tile_not_cached():
+    store = MemoryTileStore(max_bytes=4)
+    store.put(key(), b"too big")
+    assert store.get(key()) is None
+    assert store.size == 0
+
+
+def test_two_tier_cache(tmpdir):
+    cache = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir)})
+    assert cache.get(key()) is None
+    assert cache.misses == 1
+    cache.put(key(), b"tile")
+    assert cache.get(key()) == b"tile"
+    assert cache.hits == 1
+
+    # New worker: empty memory tier, shared disk tier
+    cache2 = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir)})
+    assert cache2.get(key()) == b"tile"
+    assert len(cache2.memory) == 1
+
+
+def test_disk_eviction(tmpdir):
+    cache = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir), "disk_max_bytes": 20})
+    for i in range(5):
+        cache.put(key(col=i), b"x" * 8)
+    assert cache.disk.size <= 20
+    assert cache.disk.contains(key(col=4))
+
+
+def test_disk_size_tracking(tmpdir):
+    store = DiskTileStore(str(tmpdir), 30, rescan_seconds=0)
+    store._scanner.join()
+    with patch.object(store, "_tile_files", side_effect=AssertionError("rescanned")):
+        # Overwriting a tile replaces its size rather than adding to it.
+        store.put(key(col=0), b"x" * 8)
+        store.put(key(col=0), b"x" * 4)
+        assert store.size == 4
+        store.put(key(col=1), b"x" * 8)
+        store.put(key(col=2), b"x" * 8)
+        # Reads make a tile most recently used, so tile 1 is evicted first, without a rescan.
+        assert store.get(key(col=0)) == b"x" * 4
+        store.put(key(col=3), b"x" * 12)
+    assert store.size <= 27
+    assert not store.contains(key(col=1))
+    assert store.contains(key(col=0))
+    assert store.contains(key(col=3))
+
+    # Tiles written by another worker are picked up by the background scan.
+    other = DiskTileStore(str(tmpdir), 30, rescan_seconds=0)
+    other._scanner.join()
+    other.put(key(col=4), b"x" * 10)
+    store.scan()
+    assert store.size == sum(os.path.getsize(f) for f in store._tile_files())
+    assert store.size <= 27
+
+
+def test_invalidate_layer(tmpdir):
+    cache = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir)})
+    cache.put(key(layer="a"), b"tile_a")
+    cache.put(key(layer="b"), b"tile_b")
+    cache.invalidate_layer("a")
+    assert cache.get(key(layer="a")) is None
+    assert cache.get(key(layer="b")) == b"tile_b"
+    assert cache.disk.size == len(b"tile_b")
+
+
+def test_from_cfg():
+    assert TileCache.from_cfg(None) is None
+    assert isinstance(TileCache.from_cfg({"memory_max_bytes": 100}), TileCache)
+
+
+@pytest.mark.parametrize("zoom,row,col", [(0, 0, 0), (7, 85, 112), (14, 9876, 15001)])
+def test_wms_tile_key_roundtrip(tile_key_cfg, zoom, row, col):
+    wmts_args = {
+        "layer": "a_layer",
+        "style": "a_style",
+        "format": "image/png",
+        "time": "2020-01-01",
+        "tilematrixset": "urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible",
+        "tilematrix": str(zoom),
+        "tilerow": str(row),
+        "tilecol": str(col),
+        "requestid": "xyzzy",
+    }
+    wms_args = wmts_args_to_wms(wmts_args)
+    assert wms_args_to_tile_key(wms_args) == tile_key(wmts_args, wms_args)
+    assert tile_key(wmts_args, wms_args) == TileKey("a_layer", "a_style", "2020-01-01", "WholeWorld_WebMercator",
+                                                    zoom, row, col, "cfg1")
+
+
+def test_tile_key_resolves_request(tile_key_cfg):
+    wmts_args = {
+        "layer": "a_layer",
+        "format": "image/png",
+        "tilematrixset": "WholeWorld_WebMercator",
+        "tilematrix": "3",
+        "tilerow": "2",
+        "tilecol": "1",
+        "requestid": "req",
+    }
+    default_key = tile_key(wmts_args, wmts_args_to_wms(wmts_args))
+    explicit_args = dict(wmts_args, style="default_style", time="2020-01-02")
+    assert tile_key(explicit_args, wmts_args_to_wms(explicit_args)) == default_key
+
+    tile_key_cfg.config_digest = "cfg2"
+    assert tile_key(wmts_args, wmts_args_to_wms(wmts_args)) != default_key
+
+    # Unknown layers are rejected before the cache is used.
+    bad_args = dict(wmts_args, layer="../../etc")
+    with pytest.raises(WMSException):
+        tile_key(bad_args, wmts_args_to_wms(bad_args))
+
+    tile_key_cfg.tile_cache = None
+    assert tile_key(wmts_args, wmts_args_to_wms(wmts_args)) is None
+
+
+def test_wms_tile_key_not_aligned(tile_key_cfg):
+    args = {
+        "crs": "EPSG:3857",
+        "format": "image/png",
+        "width": "256",
+        "height": "256",
+        "layers": "a_layer",
+        "styles": "",
+        "bbox": "100.0,100.0,200000.0,200000.0",
+    }
+    assert wms_args_to_tile_key(args) is None
+    args["bbox"] = "0,0,1,1"
+    args["crs"] = "EPSG:4326"
+    assert wms_args_to_tile_key(args) is None
+
+
+def test_metatile_args():
+    from datacube_ows.wmts import metatile_args, tile_span
+    wms_args = {"layers": "a_layer", "width": "256", "height": "256", "bbox": "ignored"}
+    n, mrow, mcol, meta_args = metatile_args(key(row=6, col=9)._replace(zoom=5), wms_args, 4)
+    assert (n, mrow, mcol) == (4, 4, 8)
+    assert meta_args["width"] == meta_args["height"] == "1024"
+    assert meta_args["layers"] == "a_layer"
+    minx, miny, maxx, maxy = map(float, meta_args["bbox"].split(","))
+    assert maxx - minx == pytest.approx(4 * tile_span(5))
+    assert maxy - miny == pytest.approx(4 * tile_span(5))
+    # Blocks are limited to the size of the tile matrix at low zoom levels.
+    n, mrow, mcol, meta_args = metatile_args(key(row=1, col=0)._replace(zoom=1), wms_args, 4)
+    assert (n, mrow, mcol) == (2, 0, 0)
+    assert meta_args["width"] == "512"
+
+
+def test_split_metatile():
+    import numpy as np
+    from PIL import Image
+    from io import BytesIO
+    from datacube_ows.wmts import split_metatile
+    band = np.zeros((512, 512), dtype="uint8")
+    band[256:, :256] = 7
+    tiles = split_metatile(key(row=2, col=4), [band, band], 2, 2, 4)
+    assert set(tiles.keys()) == {key(row=r, col=c) for r in (2, 3) for c in (4, 5)}
+    img = np.array(Image.open(BytesIO(tiles[key(row=3, col=4)])))
+    assert img.shape == (256, 256, 2)
+    assert (img == 7).all()
+    img = np.array(Image.open(BytesIO(tiles[key(row=2, col=4)])))
+    assert (img == 0).all()
+
+
+def test_metatile_cfg():
+    from datacube_ows.ogc_utils import ConfigException
+    assert TileCache({"metatile": 4}).metatile == 4
+    assert TileCache({}).metatile == 1
+    with pytest.raises(ConfigException):
+        TileCache({"metatile": 0})
+
+
+def test_tile_etags(tmpdir):
+    cache = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir)})
+    cache.put(key(col=1), b"tile", '"etag1"')
+    cache.put(key(col=2), b"tile")
+    assert cache.get_etag(key(col=1)) == '"etag1"'
+    assert cache.get_etag(key(col=2)) is None
+
+    # ETags are stored alongside tiles on disk
+    cache2 = TileCache({"memory_max_bytes": 1024, "disk_path": str(tmpdir)})
+    assert cache2.get(key(col=1)) == b"tile"
+    assert cache2.memory.get_etag(key(col=1)) == '"etag1"'
+
+    # Replaced and invalidated tiles lose their ETags
+    cache2.put(key(col=1), b"new tile")
+    assert cache2.get_etag(key(col=1)) is None
+    cache.put(key(col=2), b"tile", '"etag2"')
+    cache.invalidate_layer("layer")
+    assert cache.get_etag(key(col=2)) is None
+
+
+def test_cached_tile_conditional_get():
+    from datacube_ows.wmts import content_etag, get_map_cached
+    cfg = MagicMock()
+    cfg.response_headers.side_effect = lambda d: dict(d)
+    cfg.tile_cache = TileCache({"memory_max_bytes": 1024})
+    cfg.tile_cache.put(key(col=1), b"tile1", '"etag1"')
+    cfg.tile_cache.put(key(col=2), b"tile2")
+    with patch("datacube_ows.wmts.get_config", return_value=cfg), \
+            patch("datacube_ows.wmts.get_map") as get_map:
+        body, status, headers = get_map_cached(key(col=1), {})
+        assert (body, status, headers["ETag"]) == (b"tile1", 200, '"etag1"')
+        body, status, headers = get_map_cached(key(col=1), {"if_none_match": '"etag1"'})
+        assert (body, status, headers) == ("", 304, {"ETag": '"etag1"'})
+        # Tiles cached without an ETag are tagged by content
+        _, status, headers = get_map_cached(key(col=2), {})
+        assert headers["ETag"] == content_etag(b"tile2")
+        _, status, _ = get_map_cached(key(col=2), {"if_none_match": content_etag(b"tile2")})
+        assert status == 304
+        get_map.assert_not_called()
+
+        # Rendered tiles are cached with their ETags
+        get_map.return_value = (b"tile3", 200, {"Content-Type": "image/png", "ETag": '"etag3"'})
+        get_map_cached(key(col=3), {"layers": "layer"})
+        assert cfg.tile_cache.get_etag(key(col=3)) == '"etag3"'
+
+
+def test_metatile_conditional_get():
+    from datacube_ows.wmts import get_map_cached, tile_etag
+    cfg = MagicMock()
+    cfg.response_headers.side_effect = lambda d: dict(d)
+    cfg.tile_cache = TileCache({"memory_max_bytes": 1024, "metatile": 2})
+    params = MagicMock()
+    params.times = [datetime(2020, 1, 1)]
+    params.style.masks = []
+    params.zf = 10.0
+    params.product.min_zoom = 1.0
+    params.product.max_datasets_wms = 5
+    with patch("datacube_ows.wmts.get_config", return_value=cfg), \
+            patch("datacube_ows.wmts.MetatileParameters", return_value=params), \
+            patch("datacube_ows.data.cube"), \
+            patch("datacube_ows.data.DataStacker") as stacker_cls, \
+            patch("datacube_ows.data.datasets_in_xarray", return_value=1), \
+            patch("datacube_ows.data.map_etag", return_value='"meta"'):
+        stacker = stacker_cls.return_value
+        stacker.count_datasets_over.return_value = None
+        stacker.data.side_effect = RuntimeError("read")
+        etag = tile_etag('"meta"', key(col=1))
+        # The client already has the tile: 304 without reading or rendering the metatile.
+        body, status, headers = get_map_cached(key(col=1), {"if_none_match": etag})
+        assert (body, status, headers) == ("", 304, {"ETag": etag})
+        stacker.datasets.assert_called_once()
+        stacker.data.assert_not_called()
+        assert cfg.tile_cache.get(key(col=1)) is None
+
+        # The ETag of another tile in the block does not match.
+        with pytest.raises(RuntimeError):
+            get_map_cached(key(col=0), {"if_none_match": etag})
+        stacker.data.assert_called()
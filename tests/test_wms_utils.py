@@ -32,3 +32,40 @@ def test_parse_wms_time_strings_with_present():
     start, end = datacube_ows.wms_utils.parse_wms_time_strings('2018-01-10/PRESENT'.split('/'))
     assert start == dt.datetime(2018, 1, 10, 0, 0)
     assert (dt.datetime.utcnow() - end).total_seconds() < 60
+
+
+def test_overview_decimation():
+    assert datacube_ows.wms_utils.overview_decimation(500.0, 300.0) == 1
+    assert datacube_ows.wms_utils.overview_decimation(300.0, 300.0) == 1
+    assert datacube_ows.wms_utils.overview_decimation(200.0, 300.0) == 1
+    assert datacube_ows.wms_utils.overview_decimation(150.0, 300.0) == 2
+    assert datacube_ows.wms_utils.overview_decimation(30.0, 300.0) == 8
+
+
+def test_decimated_geobox():
+    from affine import Affine
+    from datacube.utils import geometry
+    geobox = geometry.GeoBox(256, 250, Affine(10.0, 0.0, 1000.0, 0.0, -10.0, 5000.0), geometry.CRS("EPSG:3857"))
+    assert datacube_ows.wms_utils.decimated_geobox(geobox, 1) is geobox
+    dec = datacube_ows.wms_utils.decimated_geobox(geobox, 4)
+    assert (dec.width, dec.height) == (64, 63)
+    assert dec.affine == Affine(40.0, 0.0, 1000.0, 0.0, -40.0, 5000.0)
+
+
+def test_resample_image_band():
+    from affine import Affine
+    from datacube.utils import geometry
+    import numpy as np
+    geobox = geometry.GeoBox(256, 256, Affine(10.0, 0.0, 1000.0, 0.0, -10.0, 5000.0), geometry.CRS("EPSG:3857"))
+    arr = np.tile(np.arange(0, 256, 16, dtype="uint8"), (16, 1))
+    assert datacube_ows.wms_utils.resample_image_band(arr, geobox, geobox) is arr
+    dec = datacube_ows.wms_utils.decimated_geobox(geobox, 16)
+    up = datacube_ows.wms_utils.resample_image_band(arr, dec, geobox)
+    assert up.shape == (256, 256)
+    assert up.dtype == np.dtype("uint8")
+    # Values at block centres are kept, and blended in between rather than repeated in blocks.
+    assert abs(int(up[8, 8]) - int(arr[0, 0])) <= 1
+    assert abs(int(up[8 + 16 * 3, 8 + 16 * 5]) - int(arr[3, 5])) <= 1
+    row = up[8 + 16 * 3, 8 + 16 * 5: 8 + 16 * 6]
+    assert len(np.unique(row)) > 2
+    assert arr[3, 5] <= row.min() < row.max() <= arr[3, 6]